@@ -0,0 +1,144 @@
+# Palette analysis of encoded images, shared by the service and bulk.py
+#
+# analyze_buffer plans the decode from the image's header, then analyzes the image whole,
+# tile by tile or frame by frame, so that a file gets the same palette from /analyze,
+# /analyze_urls and bulk.py for the same options.
+import contextlib
+import hashlib
+import itertools
+import logging
+import os
+import time
+
+import cv2
+
+from decoders import can_decode_tiles, decode_frames, decode_image, decode_tiles
+from palette import (ANALYSIS_SIZE, PALETTE_VERSION, PaletteError, extract_frames_palette, extract_palette,
+                     extract_tiled_palette)
+from probe import ProbeError, detect_format, probe_image, reduced_decode_scale
+
+# Images announcing frames of more pixels in their header are rejected before decoding (the
+# frames of animations are sampled, up to max_frames of them). HEIF and AVIF are not probed.
+MAX_IMAGE_PIXELS = int(os.getenv("MAX_IMAGE_PIXELS") or 100_000_000)
+# Still images of at least TILED_MIN_PIXELS are analyzed in tiles when they can be (TIFF with
+# tifffile, TIFF / PNG / WebP with pyvips), which allows up to MAX_TILED_PIXELS
+TILED_MIN_PIXELS = int(os.getenv("TILED_MIN_PIXELS") or 25_000_000)
+MAX_TILED_PIXELS = int(os.getenv("MAX_TILED_PIXELS") or 2_000_000_000)
+# Frames sampled from animations and videos by default, and at most
+FRAME_STRIDE = int(os.getenv("FRAME_STRIDE") or 1)
+MAX_ANALYZED_FRAMES = int(os.getenv("MAX_ANALYZED_FRAMES") or 100)
+
+
+def decode_mask(buffer, max_pixels=None):
+    """Grayscale mask of an encoded image, probed and limited like the images analyzed.
+
+    Returns mask, error, status like the option parsers.
+    """
+    try:
+        info = probe_image(buffer)
+    except ProbeError as error:
+        return None, {"error": f"mask: {error}"}, 400
+    if info is not None and info['width'] * info['height'] > MAX_IMAGE_PIXELS:
+        pixels = info['width'] * info['height']
+        return None, {"error": f"Masks are limited to {MAX_IMAGE_PIXELS} pixels, this one has {pixels}"}, 413
+    mask = decode_image(buffer, max_pixels, info)[0]
+    if mask is None:
+        return None, {"error": "mask is not a readable image"}, 400
+    return cv2.cvtColor(mask[:, :, :3], cv2.COLOR_BGR2GRAY), None, None
+
+
+def analyze_buffer(buffer, options, frame_options, threads=None, mask_buffer=None, cache=None, store=None):
+    """Palette of an encoded image (or animation, video) in buffer.
+
+    options are extract_palette's keyword arguments (n_colors, quality, crop, ...) and
+    frame_options frame_stride, max_frames and per_frame. Results are looked up in and
+    added to cache (a palette cache, see make_cache) and store (a ResultsStore) when given.
+    Returns (colors, percents, frame_palettes), error, status, error being a JSON object;
+    frame_palettes is None for still images.
+    """
+    params = {**options, **frame_options}
+    if cache is not None or store is not None:
+        # The same image always gets the same palette, skip decoding and clustering on a cache hit
+        image_hash = hashlib.sha256(buffer).hexdigest()
+        cache_key = ':'.join([f'v{PALETTE_VERSION}', image_hash] + [f'{key}={value}' for key, value in sorted(params.items())])
+        if mask_buffer is not None:
+            params['mask'] = hashlib.sha256(mask_buffer).hexdigest()
+            cache_key += ':mask=' + params['mask']
+        cached = cache.get(cache_key) if cache is not None else None
+        if cached is None and store is not None:
+            cached = store.get(cache_key)
+            if cached is not None and cache is not None:
+                cache.set(cache_key, cached)
+        if cached is not None:
+            return cached, None, None
+    analysis_start_time = time.time()
+    # Plan the decode from the header alone: refuse decompression bombs before
+    # anything is allocated, and let the decoder downscale large opaque images
+    try:
+        info = probe_image(buffer)
+    except ProbeError as error:
+        return None, {"error": str(error)}, 400
+    tiled = False
+    if info is not None:
+        pixels = info['width'] * info['height']
+        logging.info('Probed %s %sx%s, %s channels, %s frames', info['format'], info['width'],
+                     info['height'], info['channels'], info['frames'])
+        # Large still images are read and analyzed tile by tile when a tile reader can
+        tiled = info['frames'] == 1 and pixels >= TILED_MIN_PIXELS and can_decode_tiles(info['format'])
+        limit = MAX_TILED_PIXELS if tiled else MAX_IMAGE_PIXELS
+        if pixels > limit:
+            return None, {"error": f"Images are limited to {limit} pixels, this one has {pixels}"}, 413
+    scale = 1 if tiled else reduced_decode_scale(info, ANALYSIS_SIZE, options['crop'])
+    max_pixels = None
+    if scale > 1:
+        max_pixels = info['width'] * info['height'] / scale ** 2
+        if options['crop']:
+            x, y, w, h = options['crop']
+            options = dict(options, crop=(x // scale, y // scale, max(1, w // scale), max(1, h // scale)))
+
+    mask = None
+    if mask_buffer is not None:
+        # Stretched over the image later on, so it needs no more pixels than the decoded image
+        mask, error, status = decode_mask(mask_buffer, max_pixels or (info['width'] * info['height'] if info else None))
+        if error:
+            return None, error, status
+
+    decode_start_time = time.time()
+    frame_palettes = None
+    try:
+        if tiled:
+            # Memory bounded by the tile size rather than the image size. Unsupported options are
+            # rejected before the first tile is read to find out whether the file can be tiled.
+            if options['trim']:
+                raise PaletteError('trim is not supported for images this large')
+            with contextlib.closing(decode_tiles(buffer, info)) as tiles:
+                first_tile = next(tiles, None)
+                if first_tile is not None:
+                    colors, percents = extract_tiled_palette(
+                        itertools.chain([first_tile], tiles), info['width'], info['height'], threads=threads, mask=mask, **options)
+            if first_tile is None:
+                # None of the tile readers can read this one (e.g. old-style JPEG or subsampled
+                # YCbCr TIFFs), it is decoded whole instead when it is small enough
+                if pixels > MAX_IMAGE_PIXELS:
+                    return None, {"error": f"This image cannot be read in tiles, it is limited to {MAX_IMAGE_PIXELS} pixels and has {pixels}"}, 413
+                tiled = False
+        if not tiled and (info is not None and info['frames'] > 1 or info is None and detect_format(buffer) == 'video'):
+            # One shared histogram over the sampled frames, clustered once at the end
+            frames = decode_frames(buffer, info, frame_options['frame_stride'], frame_options['max_frames'], max_pixels)
+            with contextlib.closing(frames):
+                colors, percents, frame_palettes = extract_frames_palette(
+                    frames, threads=threads, mask=mask, per_frame=frame_options['per_frame'], **options)
+        elif not tiled:
+            img_np, decoder = decode_image(buffer, max_pixels, info)
+            logging.info('Decoding the file with %s took: %s seconds', decoder, time.time() - decode_start_time)
+            if img_np is None:
+                return None, {"error": "image is not a readable image"}, 400
+            colors, percents = extract_palette(img_np, threads=threads, mask=mask, **options)
+    except PaletteError as error:
+        return None, {"error": str(error)}, 400
+    result = (colors, percents, frame_palettes)
+    if cache is not None:
+        cache.set(cache_key, result)
+    if store is not None:
+        store.put(cache_key, image_hash, params, result, time.time() - analysis_start_time)
+    return result, None, None
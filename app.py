@@ -1,32 +1,59 @@
 # Importing required libraries
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, make_response
 from flask_cors import CORS
-import cv2
-import numpy as np
-from sklearn.cluster import KMeans
-import json
+from werkzeug.exceptions import RequestEntityTooLarge
 import webcolors
 import logging
 import time
+import contextlib
+from concurrent.futures import FIRST_COMPLETED, wait
+import functools
+import hashlib
+import hmac
+import io
+import itertools
+import math
+import mmap
 import psycopg2
 import psycopg2.extras
 from dotenv import load_dotenv
 import os
+# Before the modules below, which read their settings when they are imported
+load_dotenv()  # take environment variables from .env.
 from colormath.color_objects import sRGBColor, LabColor, CMYKColor
 from colormath.color_conversions import convert_color
+from profiling import profiled
+from log_config import setup_logging
+from cache import make_cache
+from results_store import ResultsStore, connection_pool
+from responses import binary_mimetype, json_response, palette_columns, palette_rows, record_columns, table_response
+from fetch import FETCH_CONCURRENCY, FetchError, fetch, fetch_pool
+from decoders import decoder_stats
+from palette import COLOR_SPACES, DEFAULT_QUALITY, DEFAULT_SPACE, MAX_COLORS, QUALITY_SETTINGS, palette_emd, sinkhorn_emd
+import analysis
+from analysis import FRAME_STRIDE, MAX_ANALYZED_FRAMES
 
 
-load_dotenv()  # take environment variables from .env.
-
-
-logging.basicConfig(level=logging.INFO)
+setup_logging()
 
 # Instantiating Flask app
 app = Flask(__name__)
 CORS(app)
 
-def connect_db():
-    return psycopg2.connect(
+# Larger requests are rejected with a 413 before their body is read
+app.config['MAX_CONTENT_LENGTH'] = int(os.getenv("MAX_CONTENT_LENGTH") or 64 * 1024 * 1024)
+# URIs accepted by one /analyze_urls request
+MAX_FETCH_URIS = int(os.getenv("MAX_FETCH_URIS") or 100)
+# Results of one /search request
+MAX_SEARCH_RESULTS = int(os.getenv("MAX_SEARCH_RESULTS") or 100)
+
+# Version of the reference color data, bump it whenever the color tables are reloaded
+# so that cached closest color responses are invalidated
+DATASET_VERSION = os.getenv("DATASET_VERSION") or "1"
+CACHE_MAX_AGE = int(os.getenv("CACHE_MAX_AGE") or 86400)
+
+def db_params():
+    return dict(
         dbname=os.getenv("DB_NAME"),
         user=os.getenv("DB_USER"),
         password=os.getenv("DB_PASSWORD"),
@@ -34,23 +61,8 @@ def connect_db():
         port=os.getenv("DB_PORT")
     )
 
-def rgb_to_cmyk(r, g, b):
-    logging.info(f'RGB values received: {r}, {g}, {b}')
-
-    r = r / 255.0
-    g = g / 255.0
-    b = b / 255.0
-
-    k = 1 - max(r, g, b)
-    c = (1 - r - k) / (1 - k) if k != 1 else 0
-    m = (1 - g - k) / (1 - k) if k != 1 else 0
-    y = (1 - b - k) / (1 - k) if k != 1 else 0
-
-    c, m, y, k = [x * 100 for x in [c, m, y, k]]
-
-    logging.info(f'CMYK values calculated: {c}, {m}, {y}, {k}')
-    
-    return c, m, y, k
+def connect_db():
+    return psycopg2.connect(**db_params())
 
 # Function to convert RGB to CMYK
 def rgb_to_cmyk(r, g, b):
@@ -78,111 +90,95 @@ def extract_color_from_request():
         except ValueError:
             return None, None, None, {"error": "Invalid hex color code"}, 400
 
-    return r, g, b, None, None
-
-# Function to get color palette from image
-def get_color_palette(image, n_colors):
-    # If the image has an alpha (transparency) channel, filter out transparent pixels
-    if image.shape[2] == 4:
-        logging.info('transparent image possibly being analyzed...')
-        non_transparent_pixels = image[:, :, 3] > 30
-        
-        # Filter out the transparent pixels before converting to RGB
-        image_rgb = cv2.cvtColor(image, cv2.COLOR_BGRA2RGB)
-        non_transparent_rgb_pixels = image_rgb[non_transparent_pixels]
-
-    else:
-        # Resize the image
-        image_rgb = cv2.resize(image, (700, 700))
-        image_rgb = cv2.cvtColor(image_rgb, cv2.COLOR_BGR2RGB)
-        non_transparent_rgb_pixels = image_rgb.reshape(-1, 3)
-
-    # Perform KMeans to find the most dominant colors
-    kmeans = KMeans(n_clusters=n_colors, n_init=9)
-    kmeans.fit(non_transparent_rgb_pixels)
-    
-    # Get the RGB values of the cluster centers
-    colors = kmeans.cluster_centers_
-
-    # Get the labels for all pixels
-    labels = kmeans.labels_
-
-    # Count the occurrence of each label
-    label_counts = np.bincount(labels)
-    total_count = np.sum(label_counts)
-
-    # Calculate the percentage of each color
-    color_percentages = label_counts / total_count
-
-    # Prepare the color palette
-    palette = []
-    for i, percent in enumerate(color_percentages):
-        color_rgb = colors[i].tolist()
-        color_hex = webcolors.rgb_to_hex([int(c) for c in color_rgb])
-        color_info = {
-            'r': int(color_rgb[0]),
-            'g': int(color_rgb[1]),
-            'b': int(color_rgb[2]),
-            'html_code': color_hex,
-            'percent': percent*100,
-        }
-        palette.append(color_info)
-    return palette
-
-# Defining route for color analysis
-
-
-@app.route('/analyze', methods=['POST'])
-def analyze():
-    logging.info('Starting analysis...')
-    start_time = time.time()
-
-    # check if the post request has the file part
-    if 'image' not in request.files:
-        return 'No file part', 400
-    file = request.files['image']
-
-    # if user does not select file, browser also
-    # submit an empty part without filename
-    if file.filename == '':
-        return 'No selected file', 400
-
-    if file:
-        file_start_time = time.time()
-        logging.info('Reading the file...')
-
-        # Read the file as bytes
-        filestr = file.read()
-        logging.info(
-            f'Reading the file took: {time.time() - file_start_time} seconds')
+    if not all(0 <= value <= 255 for value in (r, g, b)):
+        return None, None, None, {"error": "r, g and b must be between 0 and 255"}, 400
 
-        # Convert the bytes to a numpy array
-        npimg = np.frombuffer(filestr, np.uint8)
-
-        # Convert the data to an image
-        img_np = cv2.imdecode(npimg, cv2.IMREAD_UNCHANGED)
-
-        # Get the color palette
-        palette = get_color_palette(img_np, 13)
-
-        # Return the palette as a JSON response
-        logging.info(f'Entire analysis took: {time.time() - start_time} seconds')
-        return json.dumps(palette)                
-
-@app.route('/closest_color_lab', methods=['GET'])
-def get_closest_color():
-    logging.info('Starting closest color lab query...')
-    start_time = time.time()
-
-    r, g, b, error, status = extract_color_from_request()
-    if error:
-        return jsonify(error), status
+    return r, g, b, None, None
 
+# Strong ETag of a closest color response: ?hex=ff0000 and ?r=255&g=0&b=0 share the same tag,
+# the negotiated format is part of it since each representation needs its own tag
+def color_etag(r, g, b):
+    key = f'{DATASET_VERSION}:{request.path}:{r:02x}{g:02x}{b:02x}:{binary_mimetype() or "json"}'
+    return hashlib.sha1(key.encode()).hexdigest()
+
+# Palette options of an /analyze request, as keyword arguments for extract_palette
+def extract_analysis_options_from_request():
+    quality = request.args.get('quality', DEFAULT_QUALITY)
+    if quality not in QUALITY_SETTINGS:
+        return None, {"error": f"quality must be one of {', '.join(QUALITY_SETTINGS)}"}, 400
+
+    # n_colors=auto picks the palette size from the image, up to max_colors
+    n_colors = request.args.get('n_colors', '13')
+    max_colors = request.args.get('max_colors', 13, type=int)
+    n_colors = None if n_colors == 'auto' else int(n_colors) if n_colors.isdigit() else 0
+    if n_colors is not None and not 1 <= n_colors <= MAX_COLORS or not 1 <= max_colors <= MAX_COLORS:
+        return None, {"error": f"n_colors must be 'auto' or between 1 and {MAX_COLORS}, max_colors between 1 and {MAX_COLORS}"}, 400
+
+    # Color space to cluster in, lab and oklab group colors the way they are perceived
+    space = request.args.get('space', DEFAULT_SPACE)
+    if space not in COLOR_SPACES:
+        return None, {"error": f"space must be one of {', '.join(COLOR_SPACES)}"}, 400
+
+    # Post-processing, swatches closer than merge_delta_e are merged and those under min_percent dropped
+    merge_delta_e = request.args.get('merge_delta_e', type=float)
+    min_percent = request.args.get('min_percent', type=float)
+    if merge_delta_e is not None and merge_delta_e < 0 or min_percent is not None and not 0 <= min_percent <= 100:
+        return None, {"error": "merge_delta_e must be positive and min_percent between 0 and 100"}, 400
+
+    # Region of interest, crop=x,y,w,h in pixels and/or trim=1 to cut away a uniform border
+    crop = request.args.get('crop')
+    if crop is not None:
+        crop = crop.split(',')
+        if len(crop) != 4 or not all(value.isdigit() for value in crop) or int(crop[2]) == 0 or int(crop[3]) == 0:
+            return None, {"error": "crop must be x,y,width,height in pixels"}, 400
+        crop = tuple(int(value) for value in crop)
+    trim = request.args.get('trim', '0') not in ('0', 'false', '')
+
+    options = {'n_colors': n_colors, 'max_colors': max_colors, 'quality': quality, 'space': space,
+               'merge_delta_e': merge_delta_e, 'min_percent': min_percent, 'crop': crop, 'trim': trim}
+    return options, None, None
+
+# Multi-frame inputs (animations, multi-page TIFFs, videos): every frame_stride-th frame is
+# analyzed, up to max_frames, and per_frame=1 adds the palette of each analyzed frame
+def extract_frame_options_from_request():
+    frame_stride = request.args.get('frame_stride', FRAME_STRIDE, type=int)
+    max_frames = request.args.get('max_frames', MAX_ANALYZED_FRAMES, type=int)
+    if frame_stride < 1 or not 1 <= max_frames <= MAX_ANALYZED_FRAMES:
+        return None, {"error": f"frame_stride must be positive and max_frames between 1 and {MAX_ANALYZED_FRAMES}"}, 400
+    per_frame = request.args.get('per_frame', '0') not in ('0', 'false', '')
+    return {'frame_stride': frame_stride, 'max_frames': max_frames, 'per_frame': per_frame}, None, None
+
+# Decorator adding ETag / Cache-Control handling to the closest color routes
+def http_cached(view):
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        r, g, b, error, _ = extract_color_from_request()
+        if error:
+            return view(*args, **kwargs)
+
+        etag = color_etag(r, g, b)
+
+        if request.if_none_match.contains(etag):
+            response = app.response_class(status=304)
+        else:
+            response = make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+        response.set_etag(etag)
+        response.cache_control.public = True
+        response.cache_control.max_age = CACHE_MAX_AGE
+        response.vary.add('Accept')
+        return response
+
+    return wrapper
+
+# Closest color in the lab table, as a dict or None
+def query_closest_color_lab(r, g, b):
     # Convert RGB to LAB
     rgb = sRGBColor(r, g, b, is_upscaled=True)
     lab = convert_color(rgb, LabColor)
 
-    conn = conn = connect_db()
+    conn = connect_db()
     cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
 
     # Update the SQL command to compare the LAB values
@@ -205,28 +201,15 @@ def get_closest_color():
     cur.close()
     conn.close()
 
-    if result is None:
-        return jsonify({"error": "No matching color found"}), 404
-    
-    logging.info(f'The result: {jsonify(dict(result))}')
-    logging.info(f'Entire closest_color request took: {time.time() - start_time} seconds')
-    return jsonify(dict(result))
-
-
-@app.route('/closest_color_lab_old', methods=['GET'])
-def get_closest_color_old():
-    logging.info('Starting closest color lab query...')
-    start_time = time.time()
-
-    r, g, b, error, status = extract_color_from_request()
-    if error:
-        return jsonify(error), status
+    return dict(result) if result is not None else None
 
+# Closest color in the old lab table, as a dict or None
+def query_closest_color_lab_old(r, g, b):
     # Convert RGB to LAB
     rgb = sRGBColor(r, g, b, is_upscaled=True)
     lab = convert_color(rgb, LabColor)
 
-    conn = conn = connect_db()
+    conn = connect_db()
     cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
 
     # Update the SQL command to compare the LAB values
@@ -243,27 +226,14 @@ def get_closest_color_old():
     """, (lab.lab_l, lab.lab_a, lab.lab_b))
 
     result = cur.fetchone()
-    logging.info(result)
     cur.close()
     conn.close()
 
-    if result is None:
-        return jsonify({"error": "No matching color found"}), 404
-    logging.info(f'The result: {jsonify(dict(result))}')
-    logging.info(f'Entire closest_color old request took: {time.time() - start_time} seconds')
-    return jsonify(dict(result))
+    return dict(result) if result is not None else None
 
-@app.route('/closest_color_rgb', methods=['GET'])
-def get_closest_color_rgb():
-    logging.info('Starting closest color rgb query...')
-    start_time = time.time()
-
-    logging.info(extract_color_from_request)
-    r, g, b, error, status = extract_color_from_request()
-    if error:
-        return jsonify(error), status
-
-    conn = conn = connect_db()
+# Closest color in the rgb table, as a dict or None
+def query_closest_color_rgb(r, g, b):
+    conn = connect_db()
     cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
 
     cur.execute("""
@@ -283,8 +253,389 @@ def get_closest_color_rgb():
     cur.close()
     conn.close()
 
-    logging.info(f'Entire closest_color request took: {time.time() - start_time} seconds')
-    return jsonify(dict(result))
+    return dict(result) if result is not None else None
+
+# Closest color lookups are pure functions of the 24-bit color and the table queried,
+# so results are memoized in front of the database (per DATASET_VERSION in shared caches)
+closest_color_cache = make_cache(
+    'closest_color',
+    maxsize=int(os.getenv("CLOSEST_COLOR_CACHE_SIZE") or 65536),
+    ttl=float(os.getenv("CLOSEST_COLOR_CACHE_TTL") or 0),
+    version=DATASET_VERSION,
+)
+
+# Palettes of analyzed images, keyed by a hash of the uploaded file
+palette_cache = make_cache(
+    'palette',
+    maxsize=int(os.getenv("PALETTE_CACHE_SIZE") or 1024),
+    ttl=float(os.getenv("PALETTE_CACHE_TTL") or 0),
+    item_size=8192,
+)
+
+# Optional durable store of the palettes in Postgres, looked up when palette_cache misses
+results_store = ResultsStore(
+    connection_pool(
+        max_connections=int(os.getenv("RESULTS_STORE_POOL_SIZE") or 8),
+        connect_timeout=int(os.getenv("RESULTS_STORE_CONNECT_TIMEOUT") or 2),
+        **db_params()),
+    batch_size=int(os.getenv("RESULTS_STORE_BATCH_SIZE") or 100),
+    flush_interval=float(os.getenv("RESULTS_STORE_FLUSH_INTERVAL") or 1.0),
+) if (os.getenv("RESULTS_STORE") or '0') not in ('0', 'false') else None
+
+# Tables are created at startup (once in the gunicorn master when the app is preloaded), or
+# with `flask --app app migrate-results-store` where the service's role may not create them
+if results_store is not None and (os.getenv("RESULTS_STORE_MIGRATE") or '1') not in ('0', 'false'):
+    results_store.migrate()
+
+
+@app.cli.command('migrate-results-store')
+def migrate_results_store():
+    """Create the results store's tables and indexes."""
+    if results_store is None or not results_store.migrate():
+        raise SystemExit('The results store is disabled or unavailable')
+
+def cached_closest_color(query, r, g, b):
+    key = f'{query.__name__}:{(r << 16) | (g << 8) | b}'
+    result = closest_color_cache.get(key)
+    if result is None:
+        result = query(r, g, b)
+        closest_color_cache.set(key, result)
+    return result
+
+@app.errorhandler(RequestEntityTooLarge)
+def upload_too_large(error):
+    # Raised by Werkzeug from the Content-Length header, before the body is read
+    return jsonify({"error": f"Uploads are limited to {app.config['MAX_CONTENT_LENGTH']} bytes"}), 413
+
+@contextlib.contextmanager
+def upload_buffer(file):
+    """Contents of an uploaded file as a read-only buffer, without copying them.
+
+    Werkzeug spools uploads in a SpooledTemporaryFile: small ones stay in a BytesIO which is
+    viewed in place, larger ones roll over to a temporary file which is memory mapped.
+    Arrays made from the buffer must not outlive the with block. None gives None.
+    """
+    if file is None:
+        yield None
+        return
+    stream = getattr(file.stream, '_file', file.stream)
+    if isinstance(stream, io.BytesIO):
+        with stream.getbuffer() as view:
+            yield view
+        return
+    try:
+        fileno = stream.fileno()
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        # Not backed by a file, e.g. a custom stream factory
+        yield file.read()
+        return
+    if os.fstat(fileno).st_size == 0:
+        yield b''
+        return
+    with mmap.mmap(fileno, 0, access=mmap.ACCESS_READ) as view:
+        yield view
+
+def analyze_buffer(buffer, options, frame_options, threads=None, mask_buffer=None):
+    # analysis.analyze_buffer with the palette cache and the results store of the service
+    return analysis.analyze_buffer(buffer, options, frame_options, threads, mask_buffer, palette_cache, results_store)
+
+
+# Defining route for color analysis
+
+
+@app.route('/analyze', methods=['POST'])
+@profiled
+def analyze():
+    logging.info('Starting analysis...')
+    start_time = time.time()
+
+    # check if the post request has the file part
+    if 'image' not in request.files:
+        return 'No file part', 400
+    file = request.files['image']
+
+    # if user does not select file, browser also
+    # submit an empty part without filename
+    if file.filename == '':
+        return 'No selected file', 400
+
+    if file:
+        options, error, status = extract_analysis_options_from_request()
+        if error:
+            return jsonify(error), status
+
+        # Optional binary mask image, only pixels where it is nonzero are analyzed
+        mask_file = request.files.get('mask')
+
+        frame_options, error, status = extract_frame_options_from_request()
+        if error:
+            return jsonify(error), status
+
+        # Clustering threads, optionally fewer than the default
+        threads = request.args.get('threads', type=int)
+        if threads is not None:
+            threads = min(max(threads, 1), os.cpu_count() or 1)
+
+        # Hash and decode straight from the uploads' buffers, without reading them into bytes.
+        # Animations and videos are decoded while they are analyzed, so both happen in there.
+        with upload_buffer(file) as buffer, upload_buffer(mask_file) as mask_buffer:
+            result, error, status = analyze_buffer(buffer, options, frame_options, threads, mask_buffer)
+        if error:
+            return jsonify(error), status
+
+        colors, percents, frame_palettes = result
+        if frame_options['per_frame'] and frame_palettes is None:
+            # A still image is a single frame
+            frame_palettes = [(colors, percents)]
+
+        # Return the palette as a binary table when the client accepts one, otherwise as JSON,
+        # either one object per color or parallel arrays. Frame palettes are only in JSON.
+        mimetype = binary_mimetype()
+        if mimetype:
+            response = table_response(palette_columns(colors, percents), mimetype)
+        else:
+            to_json = palette_columns if request.args.get('format') == 'columnar' else palette_rows
+            if frame_options['per_frame']:
+                response = json_response({'palette': to_json(colors, percents),
+                                          'frames': [to_json(*palette) for palette in frame_palettes]})
+            else:
+                response = json_response(to_json(colors, percents))
+        logging.info('Entire analysis took: %s seconds', time.time() - start_time)
+        return response
+
+@app.route('/analyze_urls', methods=['POST'])
+@profiled
+def analyze_urls():
+    logging.info('Starting batch analysis...')
+    start_time = time.time()
+
+    body = request.get_json(silent=True)
+    uris = body.get('uris') if isinstance(body, dict) else None
+    if not isinstance(uris, list) or not 1 <= len(uris) <= MAX_FETCH_URIS or not all(isinstance(uri, str) for uri in uris):
+        return jsonify({"error": f"Send a JSON object with a list of 1 to {MAX_FETCH_URIS} uris"}), 400
+
+    options, error, status = extract_analysis_options_from_request()
+    if error:
+        return jsonify(error), status
+    frame_options, error, status = extract_frame_options_from_request()
+    if error:
+        return jsonify(error), status
+    threads = request.args.get('threads', type=int)
+    if threads is not None:
+        threads = min(max(threads, 1), os.cpu_count() or 1)
+
+    # Downloads run in the fetch pool, at most FETCH_CONCURRENCY at a time for this request,
+    # while this thread decodes and clusters the images in the order they arrive
+    max_size = app.config['MAX_CONTENT_LENGTH']
+    results = [None] * len(uris)
+    pending = {}
+    next_index = 0
+    while next_index < len(uris) or pending:
+        while next_index < len(uris) and len(pending) < FETCH_CONCURRENCY:
+            pending[fetch_pool.submit(fetch, uris[next_index], max_size)] = next_index
+            next_index += 1
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            index = pending.pop(future)
+            item = {'uri': uris[index]}
+            results[index] = item
+            # A URI that fails in any way gets its own error, the others are still analyzed
+            try:
+                buffer = future.result()
+                with contextlib.closing(buffer) if isinstance(buffer, mmap.mmap) else contextlib.nullcontext():
+                    result, error, status = analyze_buffer(buffer, options, frame_options, threads)
+            except FetchError as fetch_error:
+                item.update(error=str(fetch_error), status=fetch_error.status)
+                continue
+            except Exception:
+                logging.exception('Analysis of %s failed', uris[index])
+                item.update(error='Internal error', status=500)
+                continue
+            if error:
+                item.update(error=error['error'], status=status)
+            else:
+                colors, percents, frame_palettes = result
+                item['palette'] = palette_rows(colors, percents)
+                if frame_options['per_frame']:
+                    item['frames'] = [palette_rows(*palette) for palette in frame_palettes or [(colors, percents)]]
+
+    logging.info('Batch analysis of %s images took: %s seconds', len(uris), time.time() - start_time)
+    return json_response(results)
+
+# (colors, percents) of a palette in the JSON form /analyze returns, or None when it is not one
+def palette_from_json(palette):
+    try:
+        colors = [[float(color[channel]) for channel in 'rgb'] for color in palette]
+        percents = [float(color['percent']) for color in palette]
+    except (TypeError, KeyError, ValueError):
+        return None
+    # JSON allows NaN and Infinity, which would fail the distance computations, and channels
+    # out of 0-255 overflow the Sinkhorn kernel
+    if not all(math.isfinite(value) for value in percents):
+        return None
+    if not all(0 <= value <= 255 for value in itertools.chain(*colors)):
+        return None
+    if not 1 <= len(colors) <= MAX_COLORS or min(percents) < 0 or sum(percents) <= 0:
+        return None
+    return colors, percents
+
+# Reverse palette search over the results store: images with a swatch close to a color,
+# or with a palette close to a given one
+def search_limit_from_request():
+    k = request.args.get('k', 10, type=int)
+    if not 1 <= k <= MAX_SEARCH_RESULTS:
+        return None, {"error": f"k must be between 1 and {MAX_SEARCH_RESULTS}"}, 400
+    if results_store is None:
+        return None, {"error": "Search requires the results store, set RESULTS_STORE=1"}, 503
+    return k, None, None
+
+def search_response(results):
+    return json_response([{'image_sha256': result['image_sha256'], 'distance': result['distance'],
+                           'params': result['params'], 'palette': palette_rows(result['colors'], result['percents'])}
+                          for result in results])
+
+@app.route('/search/by_color', methods=['GET'])
+@profiled
+def search_by_color():
+    r, g, b, error, status = extract_color_from_request()
+    if error:
+        return jsonify(error), status
+    k, error, status = search_limit_from_request()
+    if error:
+        return jsonify(error), status
+    min_percent = request.args.get('min_percent', 0, type=float)
+    try:
+        results = results_store.search_by_color((r, g, b), k, min_percent)
+    except psycopg2.Error as error:
+        logging.error('Search by color failed: %s', error)
+        return jsonify({"error": "Search is unavailable"}), 503
+    return search_response(results)
+
+@app.route('/search/by_palette', methods=['POST'])
+@profiled
+def search_by_palette():
+    # Body: a palette as returned by /analyze, [{r, g, b, percent}, ...]
+    palette = request.get_json(silent=True)
+    if isinstance(palette, dict):
+        palette = palette.get('palette')
+    palette = palette_from_json(palette)
+    if palette is None:
+        return jsonify({"error": f"Send a palette of 1 to {MAX_COLORS} {{r, g, b, percent}} objects"}), 400
+    colors, percents = palette
+    k, error, status = search_limit_from_request()
+    if error:
+        return jsonify(error), status
+    try:
+        results = results_store.search_by_palette(colors, percents, k)
+    except psycopg2.Error as error:
+        logging.error('Search by palette failed: %s', error)
+        return jsonify({"error": "Search is unavailable"}), 503
+    return search_response(results)
+
+@app.route('/compare_palettes', methods=['POST'])
+@profiled
+def compare_palettes():
+    # Body: {"a": palette, "b": palette}, palettes as returned by /analyze
+    body = request.get_json(silent=True)
+    palettes = [palette_from_json(body.get(name)) for name in 'ab'] if isinstance(body, dict) else [None]
+    if None in palettes:
+        return jsonify({"error": f"Send palettes a and b of 1 to {MAX_COLORS} {{r, g, b, percent}} objects each"}), 400
+    (colors, percents), (other_colors, other_percents) = palettes
+    return json_response({
+        'emd': palette_emd(colors, percents, other_colors, other_percents),
+        'sinkhorn': float(sinkhorn_emd(colors, percents, [(other_colors, other_percents)])[0]),
+    })
+
+@app.route('/closest_color_lab', methods=['GET'])
+@profiled
+@http_cached
+def get_closest_color():
+    logging.info('Starting closest color lab query...')
+    start_time = time.time()
+
+    r, g, b, error, status = extract_color_from_request()
+    if error:
+        return jsonify(error), status
+
+    result = cached_closest_color(query_closest_color_lab, r, g, b)
+
+    if result is None:
+        return jsonify({"error": "No matching color found"}), 404
+    
+    logging.info('The result: %s', result)
+    logging.info('Entire closest_color request took: %s seconds', time.time() - start_time)
+    mimetype = binary_mimetype()
+    if mimetype:
+        return table_response(record_columns(result), mimetype)
+    return json_response(result, sort_keys=True)
+
+
+@app.route('/closest_color_lab_old', methods=['GET'])
+@profiled
+@http_cached
+def get_closest_color_old():
+    logging.info('Starting closest color lab query...')
+    start_time = time.time()
+
+    r, g, b, error, status = extract_color_from_request()
+    if error:
+        return jsonify(error), status
+
+    result = cached_closest_color(query_closest_color_lab_old, r, g, b)
+
+    if result is None:
+        return jsonify({"error": "No matching color found"}), 404
+    logging.info('The result: %s', result)
+    logging.info('Entire closest_color old request took: %s seconds', time.time() - start_time)
+    mimetype = binary_mimetype()
+    if mimetype:
+        return table_response(record_columns(result), mimetype)
+    return json_response(result, sort_keys=True)
+
+@app.route('/closest_color_rgb', methods=['GET'])
+@profiled
+@http_cached
+def get_closest_color_rgb():
+    logging.info('Starting closest color rgb query...')
+    start_time = time.time()
+
+    r, g, b, error, status = extract_color_from_request()
+    if error:
+        return jsonify(error), status
+
+    result = cached_closest_color(query_closest_color_rgb, r, g, b)
+
+    if result is None:
+        return jsonify({"error": "No matching color found"}), 404
+    logging.info('Entire closest_color request took: %s seconds', time.time() - start_time)
+    mimetype = binary_mimetype()
+    if mimetype:
+        return table_response(record_columns(result), mimetype)
+    return json_response(result, sort_keys=True)
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return json_response({
+        'closest_color_cache': closest_color_cache.stats(),
+        'palette_cache': palette_cache.stats(),
+        'decoders': decoder_stats(),
+        'results_store': results_store.stats() if results_store is not None else None,
+    })
+
+
+@app.route('/cache/clear', methods=['POST'])
+def clear_cache():
+    # Call after reloading the reference color tables (together with a DATASET_VERSION bump)
+    secret = os.getenv("ADMIN_SECRET")
+    token = request.headers.get('X-Admin-Token')
+    if not secret or token is None or not hmac.compare_digest(token.encode(), secret.encode()):
+        return jsonify({"error": "Forbidden"}), 403
+    # Both are cleared even when the first one fails
+    cleared = [closest_color_cache.clear(), palette_cache.clear()]
+    if not all(cleared):
+        return jsonify({"error": "The cache is unavailable", "cleared": False}), 503
+    return jsonify({"cleared": True})
 
 
 @app.route('/test', methods=['GET'])
@@ -0,0 +1,281 @@
+# Benchmark harness for palette extraction and closest color matching
+import argparse
+import json
+import logging
+import os
+import platform
+import resource
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from app import app, closest_color_cache, connect_db
+from palette import extract_palette, get_color_palette, palette_delta_e, seed_cache
+
+logging.basicConfig(level=logging.INFO)
+
+DEFAULT_SIZES = [0.3, 2, 12, 48]
+DEFAULT_KINDS = ['gradient', 'noise', 'poster', 'photo']
+
+# Palette extraction algorithms to time: name -> (kwargs for extract_palette, keep warm start seeds)
+# The first one is the reference the others' palettes are compared to
+ALGORITHMS = {
+    'kmeans-best': ({'quality': 'best'}, False),
+    'kmeans-balanced': ({'quality': 'balanced'}, False),
+    'kmeans-fast': ({'quality': 'fast'}, False),
+    'kmeans-balanced-warm': ({'quality': 'balanced'}, True),
+}
+
+# Closest color backends to time: name -> (routes, whether the in-process cache is kept warm)
+MATCHERS = {
+    'sql': (['/closest_color_lab', '/closest_color_rgb'], False),
+    'lru': (['/closest_color_lab', '/closest_color_rgb'], True),
+}
+
+
+def image_dimensions(megapixels):
+    # 4:3 landscape, the most common camera aspect ratio
+    width = int(round((megapixels * 1e6 * 4 / 3) ** 0.5))
+    height = int(round(width * 3 / 4))
+    return width, height
+
+
+def make_image(kind, megapixels, alpha=False, seed=0):
+    """Generate a reproducible synthetic BGR(A) image, as cv2.imdecode would return it."""
+    rng = np.random.default_rng(seed)
+    width, height = image_dimensions(megapixels)
+
+    if kind == 'gradient':
+        x = np.linspace(0, 255, width, dtype=np.float32)
+        y = np.linspace(0, 255, height, dtype=np.float32)
+        image = np.empty((height, width, 3), np.uint8)
+        image[:, :, 0] = x[None, :]
+        image[:, :, 1] = y[:, None]
+        image[:, :, 2] = 255 - (x[None, :] + y[:, None]) / 2
+    elif kind == 'noise':
+        image = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+    elif kind == 'poster':
+        # A handful of flat colors laid out in large blocks
+        colors = rng.integers(0, 256, (5, 3), dtype=np.uint8)
+        blocks = rng.integers(0, len(colors), (6, 8))
+        image = cv2.resize(colors[blocks], (width, height), interpolation=cv2.INTER_NEAREST)
+    elif kind == 'photo':
+        # Smooth low frequency color fields with sensor-like grain on top
+        field = rng.integers(0, 256, (6, 8, 3), dtype=np.uint8)
+        image = cv2.resize(field, (width, height), interpolation=cv2.INTER_CUBIC)
+        grain = rng.normal(0, 6, (height, width, 1)).astype(np.int16)
+        image = np.clip(image.astype(np.int16) + grain, 0, 255).astype(np.uint8)
+    else:
+        raise ValueError(f'Unknown image kind: {kind}')
+
+    if alpha:
+        # Transparent border around an opaque center, like a cut-out product shot
+        a = np.zeros((height, width, 1), np.uint8)
+        a[height // 8:-height // 8 or None, width // 8:-width // 8 or None] = 255
+        image = np.concatenate([image, a], axis=2)
+    return image
+
+
+def summarize(durations, peak_bytes, items=1):
+    durations = np.asarray(durations)
+    return {
+        'runs': len(durations),
+        'mean_s': float(durations.mean()),
+        'p50_s': float(np.percentile(durations, 50)),
+        'p99_s': float(np.percentile(durations, 99)),
+        'throughput_per_s': float(items * len(durations) / durations.sum()),
+        'peak_memory_mb': peak_bytes / 2**20,
+    }
+
+
+def time_calls(fn, repeat, warmup=1):
+    for _ in range(warmup):
+        fn()
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        durations.append(time.perf_counter() - start)
+    # Memory is traced in a separate run, tracing slows down allocations too much to time them
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return durations, peak
+
+
+def bench_palettes(kinds, sizes, repeat, n_colors, seed):
+    results = {}
+    for kind in kinds:
+        for megapixels in sizes:
+            for alpha in (False, True):
+                image = make_image(kind, megapixels, alpha=alpha, seed=seed)
+                reference = None
+                for algorithm, (kwargs, warm) in ALGORITHMS.items():
+                    name = f'palette/{algorithm}/{kind}{"_rgba" if alpha else ""}/{megapixels}mp'
+                    logging.info('Benchmarking %s', name)
+                    palettes = []
+
+                    def run():
+                        if not warm:
+                            seed_cache.clear()
+                        palettes.append(extract_palette(image, n_colors, **kwargs))
+
+                    durations, peak = time_calls(run, repeat)
+                    results[name] = summarize(durations, peak)
+                    colors, percents = palettes[-1]
+                    if reference is None:
+                        reference = colors
+                    # How far this palette is from the reference algorithm's, in ΔE
+                    results[name]['delta_e'] = palette_delta_e(colors, percents, reference)
+    return results
+
+
+def bench_thread_sweep(megapixels, repeat, n_colors, seed):
+    """Trade clustering threads per request against concurrent requests on all cores.
+
+    For each power of two t up to the core count, runs cores // t concurrent requests
+    with t OpenMP threads each, giving the throughput vs latency curve.
+    """
+    cores = os.cpu_count() or 1
+    image = make_image('photo', megapixels, seed=seed)
+    results = {}
+    threads = 1
+    # Every run starts cold: the same image would otherwise be warm started from the
+    # centers of the warmup (or of concurrent runs) and skip most of the clustering
+    seed_cache.clear()
+    maxsize, seed_cache.maxsize = seed_cache.maxsize, 0
+    try:
+        while threads <= cores:
+            concurrency = max(1, cores // threads)
+
+            def task():
+                start = time.perf_counter()
+                get_color_palette(image, n_colors, threads=threads)
+                return time.perf_counter() - start
+
+            name = f'threads/{threads}x{concurrency}/photo/{megapixels}mp'
+            logging.info('Benchmarking %s', name)
+            with ThreadPoolExecutor(concurrency) as pool:
+                list(pool.map(lambda _: task(), range(concurrency)))  # warmup
+                tracemalloc.start()
+                start = time.perf_counter()
+                durations = list(pool.map(lambda _: task(), range(concurrency * repeat)))
+                wall = time.perf_counter() - start
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+            results[name] = summarize(durations, peak)
+            # Requests overlap, so throughput is over wall clock time rather than summed latencies
+            results[name]['throughput_per_s'] = len(durations) / wall
+            threads *= 2
+    finally:
+        seed_cache.maxsize = maxsize
+    return results
+
+
+def bench_matchers(n_queries, repeat, seed):
+    rng = np.random.default_rng(seed)
+    colors = rng.integers(0, 256, (n_queries, 3)).tolist()
+    client = app.test_client()
+    results = {}
+
+    try:
+        connect_db().close()
+    except Exception as error:
+        logging.warning('Skipping matcher benchmarks, database unavailable: %s', error)
+        return results
+
+    for backend, (routes, cached) in MATCHERS.items():
+        for route in routes:
+            def run():
+                for r, g, b in colors:
+                    if not cached:
+                        closest_color_cache.clear()
+                    client.get(route, query_string={'r': r, 'g': g, 'b': b})
+
+            name = f'match/{backend}{route}'
+            logging.info('Benchmarking %s', name)
+            durations, peak = time_calls(run, repeat)
+            results[name] = summarize(durations, peak, items=n_queries)
+            results[name]['p50_s'] /= n_queries
+            results[name]['p99_s'] /= n_queries
+            results[name]['mean_s'] /= n_queries
+    return results
+
+
+def compare_to_baseline(results, baseline, tolerance):
+    """Return a list of human readable regressions of results against a baseline report."""
+    regressions = []
+    for name, current in results['benchmarks'].items():
+        previous = baseline.get('benchmarks', {}).get(name)
+        if previous is None:
+            continue
+        for metric in ('p50_s', 'p99_s', 'peak_memory_mb'):
+            if previous[metric] > 0 and current[metric] > previous[metric] * (1 + tolerance):
+                regressions.append(
+                    f'{name} {metric}: {previous[metric]:.4g} -> {current[metric]:.4g} '
+                    f'(+{(current[metric] / previous[metric] - 1) * 100:.1f}%)')
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark palette extraction and closest color matching.')
+    parser.add_argument('--sizes', type=float, nargs='+', default=DEFAULT_SIZES, help='Image sizes in megapixels.')
+    parser.add_argument('--kinds', nargs='+', choices=DEFAULT_KINDS, default=DEFAULT_KINDS, help='Synthetic image kinds.')
+    parser.add_argument('--repeat', type=int, default=3, help='Timed runs per case.')
+    parser.add_argument('--n-colors', type=int, default=13, help='Palette size passed to get_color_palette.')
+    parser.add_argument('--queries', type=int, default=200, help='Colors per closest color run.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for synthetic data.')
+    parser.add_argument('--skip-palette', action='store_true', help='Do not benchmark palette extraction.')
+    parser.add_argument('--thread-sweep', action='store_true', help='Also sweep clustering threads vs concurrent requests.')
+    parser.add_argument('--skip-match', action='store_true', help='Do not benchmark closest color matching.')
+    parser.add_argument('--output', help='Write the JSON report to this file instead of stdout.')
+    parser.add_argument('--baseline', help='JSON report to compare against; exits with 1 on regressions.')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed relative slowdown against the baseline.')
+    args = parser.parse_args(argv)
+
+    benchmarks = {}
+    if not args.skip_palette:
+        benchmarks.update(bench_palettes(args.kinds, args.sizes, args.repeat, args.n_colors, args.seed))
+    if args.thread_sweep:
+        benchmarks.update(bench_thread_sweep(args.sizes[0], args.repeat, args.n_colors, args.seed))
+    if not args.skip_match:
+        benchmarks.update(bench_matchers(args.queries, args.repeat, args.seed))
+
+    results = {
+        'meta': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'opencv': cv2.__version__,
+            'machine': platform.machine(),
+            'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            'args': vars(args),
+        },
+        'benchmarks': benchmarks,
+    }
+
+    report = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report)
+    else:
+        print(report)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare_to_baseline(results, baseline, args.tolerance)
+        for regression in regressions:
+            logging.error('Regression: %s', regression)
+        if regressions:
+            return 1
+        logging.info('No regressions against %s', args.baseline)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,261 @@
+# Offline palette extraction over directory trees or manifests, without going through HTTP
+#
+#   python bulk.py /data/images --output palettes.jsonl
+#   python bulk.py --manifest files.txt --output palettes.parquet --workers 16
+#
+# Images are analyzed by a process pool, one KMeans thread per process, with the same pipeline
+# as /analyze (animations by their sampled frames, large images in tiles). Results are
+# written in batches of --checkpoint-every images. The output doubles as the checkpoint:
+# rerunning the same command skips the files already in it, so an interrupted run resumes.
+import argparse
+import contextlib
+import hashlib
+import itertools
+import json
+import logging
+import mmap
+import multiprocessing
+import os
+import sys
+import time
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # only needed for Parquet output
+    pyarrow = None
+
+from analysis import FRAME_STRIDE, MAX_ANALYZED_FRAMES, analyze_buffer
+from palette import COLOR_SPACES, DEFAULT_QUALITY, DEFAULT_SPACE, MAX_COLORS, QUALITY_SETTINGS
+from responses import palette_rows
+
+logging.basicConfig(level=logging.INFO)
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.webp', '.tif', '.tiff', '.bmp', '.heic', '.heif', '.avif'}
+STAGES = ('read', 'analyze')
+# Options left out of run's options and frame_options, the defaults of /analyze
+DEFAULT_OPTIONS = {'n_colors': 13, 'max_colors': 13, 'quality': DEFAULT_QUALITY, 'space': DEFAULT_SPACE,
+                   'merge_delta_e': None, 'min_percent': None, 'crop': None, 'trim': False}
+DEFAULT_FRAME_OPTIONS = {'frame_stride': FRAME_STRIDE, 'max_frames': MAX_ANALYZED_FRAMES, 'per_frame': False}
+
+if pyarrow is not None:
+    PARQUET_SCHEMA = pyarrow.schema([
+        ('path', pyarrow.string()),
+        ('sha256', pyarrow.string()),
+        ('palette', pyarrow.list_(pyarrow.struct([
+            ('r', pyarrow.int64()), ('g', pyarrow.int64()), ('b', pyarrow.int64()),
+            ('html_code', pyarrow.string()), ('percent', pyarrow.float64())]))),
+        ('error', pyarrow.string()),
+    ] + [(f'{stage}_s', pyarrow.float64()) for stage in STAGES])
+
+
+def find_images(paths):
+    """Image files under paths (files or directories), in a stable order."""
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for directory, directories, files in os.walk(path):
+            directories.sort()
+            for name in sorted(files):
+                if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS:
+                    yield os.path.join(directory, name)
+
+
+def read_manifest(manifest):
+    # One path per line, - for stdin
+    with (sys.stdin if manifest == '-' else open(manifest)) as f:
+        for line in f:
+            if line.strip():
+                yield line.strip()
+
+
+@contextlib.contextmanager
+def mapped_file(path):
+    # Read-only memory map of the file at path, empty files (which mmap refuses) as b''
+    with open(path, 'rb') as f:
+        if not os.fstat(f.fileno()).st_size:
+            yield b''
+            return
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        yield buffer
+    finally:
+        buffer.close()
+
+
+def analyze_file(path, options, frame_options=None, mask_path=None):
+    """Palette of the image at path as an output record, with the time spent in each stage.
+
+    Any failure is recorded in the record's error rather than raised, so that one bad file
+    does not stop a run.
+    """
+    record = {'path': path, 'sha256': None, 'palette': None, 'error': None}
+    timings = dict.fromkeys(STAGES, 0.0)
+    start = time.perf_counter()
+    try:
+        with mapped_file(path) as buffer, \
+                (mapped_file(mask_path) if mask_path else contextlib.nullcontext()) as mask_buffer:
+            record['sha256'] = hashlib.sha256(buffer).hexdigest()
+            timings['read'] = time.perf_counter() - start
+
+            start = time.perf_counter()
+            result, error, _ = analyze_buffer(buffer, {**DEFAULT_OPTIONS, **options},
+                                              {**DEFAULT_FRAME_OPTIONS, **(frame_options or {})},
+                                              threads=1, mask_buffer=mask_buffer)
+            timings['analyze'] = time.perf_counter() - start
+        if error:
+            record['error'] = error['error']
+        else:
+            record['palette'] = palette_rows(*result[:2])
+    except Exception as error:
+        logging.exception('Analyzing %s failed', path)
+        record['error'] = str(error) or type(error).__name__
+    record.update({f'{stage}_s': seconds for stage, seconds in timings.items()})
+    return record
+
+
+def _analyze_task(task):
+    return analyze_file(*task)
+
+
+class JsonlOutput:
+    """One JSON object per line, appended and fsynced at every checkpoint."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def done(self):
+        if not os.path.exists(self.path):
+            return set()
+        paths = set()
+        with open(self.path, 'r+b') as f:
+            complete = 0
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break  # cut off by an interruption, rewritten below
+                paths.add(json.loads(line)['path'])
+                complete += len(line)
+            f.truncate(complete)
+        return paths
+
+    def write(self, records):
+        with open(self.path, 'a') as f:
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+
+class ParquetOutput:
+    """A directory of Parquet files, one per checkpoint, readable as a single dataset."""
+
+    def __init__(self, path):
+        if pyarrow is None:
+            raise SystemExit('Parquet output requires the pyarrow package')
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.parts = len([name for name in os.listdir(path) if name.endswith('.parquet')])
+
+    def done(self):
+        if not self.parts:
+            return set()
+        return set(pyarrow.parquet.read_table(self.path, columns=['path'])['path'].to_pylist())
+
+    def write(self, records):
+        # Written under a temporary name and renamed, so a part is either complete or absent
+        # (dot files are ignored when the directory is read as a dataset)
+        name = f'part-{self.parts:05d}.parquet'
+        temporary = os.path.join(self.path, f'.{name}.tmp')
+        pyarrow.parquet.write_table(pyarrow.Table.from_pylist(records, schema=PARQUET_SCHEMA), temporary)
+        os.replace(temporary, os.path.join(self.path, name))
+        self.parts += 1
+
+
+def run(files, output, options, workers, checkpoint_every, chunksize, frame_options=None, mask_path=None):
+    """Analyze files into output, skipping those already in it, and return a report."""
+    done = output.done()
+    tasks = ((path, options, frame_options, mask_path) for path in files if path not in done)
+    totals = dict.fromkeys(STAGES, 0.0)
+    analyzed, errors, batch = 0, 0, []
+    start = time.perf_counter()
+
+    try:
+        with multiprocessing.Pool(workers) as pool:
+            for record in pool.imap_unordered(_analyze_task, tasks, chunksize):
+                analyzed += 1
+                errors += record['error'] is not None
+                for stage in STAGES:
+                    totals[stage] += record[f'{stage}_s']
+                batch.append(record)
+                if len(batch) >= checkpoint_every:
+                    output.write(batch)
+                    batch = []
+                    logging.info('Checkpoint: %s images, %.1f images/s', analyzed, analyzed / (time.perf_counter() - start))
+    finally:
+        # Also when the run is interrupted, so that the records received are not analyzed again
+        if batch:
+            output.write(batch)
+
+    wall = time.perf_counter() - start
+    return {
+        'analyzed': analyzed,
+        'errors': errors,
+        'already_done': len(done),
+        'workers': workers,
+        'wall_s': wall,
+        'images_per_s': analyzed / wall if wall else 0.0,
+        # Mean seconds per image spent in each stage, measured in the worker processes
+        'stage_mean_s': {stage: seconds / analyzed if analyzed else 0.0 for stage, seconds in totals.items()},
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Extract palettes of image files in bulk.')
+    parser.add_argument('paths', nargs='*', help='Image files or directories, walked recursively.')
+    parser.add_argument('--manifest', help='File with one image path per line, - for stdin.')
+    parser.add_argument('--output', required=True, help='.jsonl file, or .parquet directory of checkpoint parts.')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Worker processes.')
+    parser.add_argument('--checkpoint-every', type=int, default=1000, help='Images per output write.')
+    parser.add_argument('--chunksize', type=int, default=16, help='Images handed to a worker at a time.')
+    parser.add_argument('--n-colors', default='13', help="Palette size, or 'auto'.")
+    parser.add_argument('--max-colors', type=int, default=13, help='Upper bound for --n-colors auto.')
+    parser.add_argument('--quality', choices=QUALITY_SETTINGS, default=DEFAULT_QUALITY)
+    parser.add_argument('--space', choices=COLOR_SPACES, default=DEFAULT_SPACE)
+    parser.add_argument('--merge-delta-e', type=float, help='Merge swatches closer than this ΔE.')
+    parser.add_argument('--min-percent', type=float, help='Drop swatches covering less of the image.')
+    parser.add_argument('--crop', help='Analyze only the region x,y,width,height in pixels.')
+    parser.add_argument('--trim', action='store_true', help='Cut away a uniform border first.')
+    parser.add_argument('--mask', help='Mask image, only pixels where it is nonzero are analyzed.')
+    parser.add_argument('--frame-stride', type=int, default=FRAME_STRIDE, help='Analyze every nth frame of animations.')
+    parser.add_argument('--max-frames', type=int, default=MAX_ANALYZED_FRAMES, help='Frames analyzed at most.')
+    args = parser.parse_args(argv)
+
+    if not args.paths and not args.manifest:
+        parser.error('give image paths, a --manifest or both')
+    n_colors = None if args.n_colors == 'auto' else int(args.n_colors) if args.n_colors.isdigit() else 0
+    if n_colors is not None and not 1 <= n_colors <= MAX_COLORS or not 1 <= args.max_colors <= MAX_COLORS:
+        parser.error(f"--n-colors must be 'auto' or between 1 and {MAX_COLORS}, --max-colors between 1 and {MAX_COLORS}")
+    crop = args.crop.split(',') if args.crop else None
+    if crop is not None and (len(crop) != 4 or not all(value.isdigit() for value in crop) or int(crop[2]) == 0 or int(crop[3]) == 0):
+        parser.error('--crop must be x,y,width,height in pixels')
+    if args.frame_stride < 1 or not 1 <= args.max_frames <= MAX_ANALYZED_FRAMES:
+        parser.error(f'--frame-stride must be positive and --max-frames between 1 and {MAX_ANALYZED_FRAMES}')
+    options = {'n_colors': n_colors, 'max_colors': args.max_colors, 'quality': args.quality, 'space': args.space,
+               'merge_delta_e': args.merge_delta_e, 'min_percent': args.min_percent,
+               'crop': tuple(int(value) for value in crop) if crop else None, 'trim': args.trim}
+    frame_options = {'frame_stride': args.frame_stride, 'max_frames': args.max_frames, 'per_frame': False}
+
+    files = find_images(args.paths)
+    if args.manifest:
+        files = itertools.chain(files, find_images(read_manifest(args.manifest)))
+    output = ParquetOutput(args.output) if args.output.endswith('.parquet') else JsonlOutput(args.output)
+
+    report = run(files, output, options, max(args.workers, 1), max(args.checkpoint_every, 1), max(args.chunksize, 1),
+                 frame_options, args.mask)
+    print(json.dumps(report, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,304 @@
+# Cache backends: in-process LRU, host-wide shared memory and Redis
+#
+# All backends share the same interface: get(key) -> value or None, set(key, value),
+# clear() -> whether the cache was emptied, and stats(). Keys are strings. The shared backends store values serialized
+# with pack/unpack, so values are limited to what msgpack can carry plus numpy arrays.
+import decimal
+import fcntl
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+
+import msgpack
+import numpy as np
+
+try:
+    import redis
+except ImportError:  # only needed for CACHE_BACKEND=redis
+    redis = None
+
+NDARRAY_EXT = 1
+
+
+def _pack_default(obj):
+    if isinstance(obj, np.ndarray):
+        header = msgpack.packb((obj.dtype.str, obj.shape))
+        return msgpack.ExtType(NDARRAY_EXT, header + obj.tobytes())
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, decimal.Decimal):
+        # Rendered as a string in responses anyway
+        return str(obj)
+    raise TypeError(f'Cannot cache object of type {type(obj).__name__}')
+
+
+def _unpack_ext(code, data):
+    if code == NDARRAY_EXT:
+        unpacker = msgpack.Unpacker()
+        unpacker.feed(data)
+        dtype, shape = unpacker.unpack()
+        return np.frombuffer(data, dtype, offset=unpacker.tell()).reshape(shape)
+    return msgpack.ExtType(code, data)
+
+
+def pack(value):
+    return msgpack.packb(value, default=_pack_default)
+
+
+def unpack(data):
+    # Tuples come back as lists
+    return msgpack.unpackb(data, ext_hook=_unpack_ext)
+
+
+class LRUCache:
+    """Bounded, thread-safe least recently used cache with an optional time to live.
+
+    ttl is in seconds, 0 keeps entries until they are evicted or the cache is cleared.
+    None is used as the "missing" marker, so None values are never stored.
+    """
+
+    def __init__(self, maxsize=65536, ttl=0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, expires = entry
+                if not expires or expires > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        if value is None or self.maxsize <= 0:
+            return
+        expires = time.monotonic() + self.ttl if self.ttl else 0
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+        return True
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'backend': 'memory',
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+            }
+
+
+class SharedMemoryCache:
+    """Direct mapped cache in a memory mapped file, shared by every process on the host.
+
+    The file holds up to `slots` fixed size slots; a key always maps to the same slot and
+    replaces whatever was there. Values that do not fit in a slot are not cached. The
+    process creating the file sizes it to at most a fraction of the free space of its file
+    system, since writing to pages of a tmpfs that is full kills the writer with SIGBUS;
+    the others map it at that size.
+    Slots are guarded by POSIX byte range locks across processes and by a lock within
+    the process, since range locks do not exclude threads of the same process. Keys are
+    hashed together with version, so entries written for another version never match.
+    """
+
+    # key digest, expiry (0 = never), payload length
+    HEADER = struct.Struct('<16sdI')
+    # Share of the free space a new file may take, leaving room for the other caches
+    MAX_SPACE_SHARE = 0.25
+
+    def __init__(self, path, slots=65536, slot_size=1024, ttl=0, version=''):
+        self.path = path
+        self.version = version
+        self.slots = slots
+        self.slot_size = slot_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        # Sized once, under a lock against workers starting together: resizing a file that
+        # others have mapped would leave them pointing past its end
+        fcntl.lockf(self._fd, fcntl.LOCK_EX)
+        try:
+            size = os.fstat(self._fd).st_size
+            if not size or size % slot_size:
+                space = os.statvfs(path)
+                fitting = int(space.f_bavail * space.f_frsize * self.MAX_SPACE_SHARE) // slot_size
+                if fitting < slots:
+                    logging.warning('Cache %s reduced to %s slots to fit the free space of its file system', path, fitting)
+                size = max(1, min(slots, fitting)) * slot_size
+                os.ftruncate(self._fd, size)
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN)
+        self.slots = size // slot_size
+        self._mmap = mmap.mmap(self._fd, size)
+
+    def _slot(self, key):
+        digest = hashlib.blake2b(f'{self.version}:{key}'.encode(), digest_size=16).digest()
+        return digest, int.from_bytes(digest[:8], 'little') % self.slots * self.slot_size
+
+    def get(self, key):
+        digest, offset = self._slot(key)
+        with self._lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_SH, self.slot_size, offset)
+            try:
+                stored, expires, length = self.HEADER.unpack_from(self._mmap, offset)
+                data = None
+                if stored == digest and (not expires or expires > time.time()):
+                    start = offset + self.HEADER.size
+                    data = self._mmap[start:start + length]
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, self.slot_size, offset)
+            if data is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return unpack(data)
+
+    def set(self, key, value):
+        if value is None:
+            return
+        data = pack(value)
+        if len(data) > self.slot_size - self.HEADER.size:
+            return
+        digest, offset = self._slot(key)
+        # Wall clock, monotonic clocks are not comparable between processes
+        expires = time.time() + self.ttl if self.ttl else 0
+        with self._lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, self.slot_size, offset)
+            try:
+                self.HEADER.pack_into(self._mmap, offset, digest, expires, len(data))
+                start = offset + self.HEADER.size
+                self._mmap[start:start + len(data)] = data
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, self.slot_size, offset)
+
+    def clear(self):
+        empty = bytes(self.HEADER.size)
+        with self._lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX)
+            try:
+                for offset in range(0, self.slots * self.slot_size, self.slot_size):
+                    self._mmap[offset:offset + self.HEADER.size] = empty
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN)
+        return True
+
+    def stats(self):
+        # Hits and misses are counted per process
+        lookups = self.hits + self.misses
+        return {
+            'backend': 'shm',
+            'slots': self.slots,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+        }
+
+
+class RedisCache:
+    """Cache in a Redis compatible server, shared by every process that can reach it.
+
+    Entries are namespaced by prefix and version and expire through Redis' own TTL;
+    eviction is left to the server's maxmemory policy. Commands time out after timeout
+    seconds, and connection errors are logged and treated as misses so that an
+    unavailable cache never fails (or stalls) a request.
+    """
+
+    def __init__(self, url, prefix, ttl=0, version='', timeout=0.25):
+        if redis is None:
+            raise RuntimeError('CACHE_BACKEND=redis requires the redis package')
+        self.client = redis.Redis.from_url(url, socket_timeout=timeout, socket_connect_timeout=timeout)
+        self.prefix = prefix
+        self.key_prefix = f'{prefix}{version}:'
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        try:
+            data = self.client.get(self.key_prefix + key)
+        except redis.RedisError as error:
+            logging.warning('Cache get failed: %s', error)
+            data = None
+        if data is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return unpack(data)
+
+    def set(self, key, value):
+        if value is None:
+            return
+        try:
+            self.client.set(self.key_prefix + key, pack(value), ex=int(self.ttl) or None)
+        except redis.RedisError as error:
+            logging.warning('Cache set failed: %s', error)
+
+    def clear(self):
+        # Entries of every version, those of older ones would otherwise linger until evicted
+        try:
+            keys = list(self.client.scan_iter(match=self.prefix + '*', count=1000))
+            for i in range(0, len(keys), 1000):
+                self.client.delete(*keys[i:i + 1000])
+        except redis.RedisError as error:
+            logging.warning('Cache clear failed: %s', error)
+            return False
+        return True
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'backend': 'redis',
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+        }
+
+
+def make_cache(name, maxsize, ttl=0, item_size=1024, version=''):
+    """Create the cache called name with the backend selected by CACHE_BACKEND.
+
+    CACHE_BACKEND is 'memory' (default, per process LRU), 'shm' (memory mapped file under
+    CACHE_SHM_DIR, default /dev/shm) or 'redis' (server at CACHE_URL, commands timing out
+    after CACHE_TIMEOUT seconds, default 0.25). maxsize is the number of entries (slots
+    for 'shm', unused for 'redis') and item_size the slot size in bytes for 'shm'. The
+    shared backends outlive the processes, their keys include version so that entries
+    of a previous version are never returned.
+    """
+    backend = os.getenv('CACHE_BACKEND') or 'memory'
+    if backend == 'memory':
+        return LRUCache(maxsize=maxsize, ttl=ttl)
+    if backend == 'shm':
+        directory = os.getenv('CACHE_SHM_DIR') or '/dev/shm'
+        return SharedMemoryCache(os.path.join(directory, f'image-colors-{name}.cache'),
+                                 slots=maxsize, slot_size=item_size, ttl=ttl, version=version)
+    if backend == 'redis':
+        return RedisCache(os.getenv('CACHE_URL') or 'redis://localhost:6379/0',
+                          prefix=f'image-colors:{name}:', ttl=ttl, version=version,
+                          timeout=float(os.getenv('CACHE_TIMEOUT') or 0.25))
+    raise ValueError(f'Unknown CACHE_BACKEND: {backend}')
@@ -0,0 +1,446 @@
+# Image decoder registry
+#
+# decode_image detects the format from the magic bytes and tries the decoders registered
+# for it, fastest first, until one succeeds: cv2 for the common formats, then pyvips and
+# Pillow (with the pillow-heif plugin for HEIF / AVIF) when they are installed. Every
+# decoder honours the same contract: it returns a uint8 BGR or BGRA array, as
+# cv2.imdecode(..., IMREAD_UNCHANGED) does for 8-bit color images, of at most max_pixels
+# pixels (give or take the rounding of the reduced dimensions), or raises / returns None.
+import io
+import itertools
+import logging
+import mmap
+import os
+import tempfile
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from probe import detect_format
+
+try:
+    import PIL.Image
+except ImportError:  # Pillow is optional
+    PIL = None
+
+try:
+    import pillow_heif
+    pillow_heif.register_heif_opener()
+except ImportError:
+    pillow_heif = None
+
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+
+try:
+    import pyvips
+except (ImportError, OSError):  # OSError when the libvips shared library is missing
+    pyvips = None
+
+# cv2.imdecode flags by shrink factor, JPEGs are then decoded at a fraction of the cost. The
+# color modes would apply the EXIF orientation, which IMREAD_UNCHANGED does not: it is ignored
+# by all of them so that crop and mask coordinates do not depend on the image size.
+REDUCED_DECODE_FLAGS = {
+    1: cv2.IMREAD_UNCHANGED,
+    2: cv2.IMREAD_REDUCED_COLOR_2 | cv2.IMREAD_IGNORE_ORIENTATION,
+    4: cv2.IMREAD_REDUCED_COLOR_4 | cv2.IMREAD_IGNORE_ORIENTATION,
+    8: cv2.IMREAD_REDUCED_COLOR_8 | cv2.IMREAD_IGNORE_ORIENTATION,
+}
+
+
+def shrink_factor(width, height, max_pixels):
+    # Smallest of 1, 2, 4 or 8 that brings width x height within max_pixels, 8 when none does
+    for factor in (1, 2, 4):
+        if width * height / factor ** 2 <= max_pixels:
+            return factor
+    return 8
+
+
+def fit_pixels(image, max_pixels):
+    # Exact downscale for what the decoder's own reduction left over
+    height, width = image.shape[:2]
+    if not max_pixels or width * height <= max_pixels:
+        return image
+    scale = (max_pixels / (width * height)) ** 0.5
+    size = (max(1, int(width * scale)), max(1, int(height * scale)))
+    if width - size[0] <= 1 and height - size[1] <= 1:
+        # Only the rounding up of the reduced decodes, not worth a resize
+        return image
+    return cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+
+
+def to_bgr(image):
+    # 8-bit BGR or BGRA from gray, gray + alpha, BGR or BGRA (any integer depth)
+    if image.dtype == np.uint16:
+        image = (image >> 8).astype(np.uint8)
+    if image.ndim == 2:
+        return cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+    if image.shape[2] == 2:
+        return np.dstack([cv2.cvtColor(image[:, :, 0], cv2.COLOR_GRAY2BGR), image[:, :, 1]])
+    return image
+
+
+def decode_cv2(buffer, max_pixels=None, info=None):
+    factor = 1
+    # The reduced modes need the size from the header and drop the alpha channel
+    if max_pixels and info is not None and info['channels'] in (1, 3):
+        factor = shrink_factor(info['width'], info['height'], max_pixels)
+    image = cv2.imdecode(np.frombuffer(buffer, np.uint8), REDUCED_DECODE_FLAGS[factor])
+    if image is None:
+        return None
+    return fit_pixels(to_bgr(image), max_pixels)
+
+
+def pillow_to_bgr(image):
+    # CMYK, palette and 16-bit images are converted by Pillow, CMYK JPEGs included
+    alpha = image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info
+    array = np.asarray(image.convert('RGBA' if alpha else 'RGB'))
+    return cv2.cvtColor(array, cv2.COLOR_RGBA2BGRA if alpha else cv2.COLOR_RGB2BGR)
+
+
+def decode_pillow(buffer, max_pixels=None, info=None):
+    image = PIL.Image.open(io.BytesIO(buffer))
+    if max_pixels:
+        factor = shrink_factor(image.width, image.height, max_pixels)
+        if factor > 1:
+            # DCT scaling for JPEGs, ignored by the other formats
+            image.draft(None, (image.width // factor, image.height // factor))
+    return fit_pixels(pillow_to_bgr(image), max_pixels)
+
+
+def pyvips_srgb(image):
+    # 8-bit sRGB (or gray), still lazy
+    if image.interpretation not in ('srgb', 'b-w'):
+        image = image.colourspace('srgb')
+    if image.format != 'uchar':
+        image = image.cast('uchar')
+    return image
+
+
+def pyvips_to_bgr(image):
+    # Computes a pyvips image (from pyvips_srgb) into a BGR(A) array
+    array = np.ndarray(buffer=image.write_to_memory(), dtype=np.uint8,
+                       shape=(image.height, image.width, image.bands))
+    if image.bands == 3:
+        return cv2.cvtColor(array, cv2.COLOR_RGB2BGR)
+    if image.bands == 4:
+        return cv2.cvtColor(array, cv2.COLOR_RGBA2BGRA)
+    return to_bgr(array[:, :, 0] if image.bands == 1 else array)
+
+
+def decode_pyvips(buffer, max_pixels=None, info=None):
+    image = pyvips.Image.new_from_buffer(buffer, '')  # lazy, only reads the header
+    if max_pixels and image.width * image.height > max_pixels:
+        scale = (max_pixels / (image.width * image.height)) ** 0.5
+        # Shrinks on load for JPEG, WebP and HEIF
+        image = pyvips.Image.thumbnail_buffer(buffer, max(1, int(image.width * scale)),
+                                              height=max(1, int(image.height * scale)), size='down')
+    return pyvips_to_bgr(pyvips_srgb(image))
+
+
+# Decoders that are installed, by name
+DECODERS = {'cv2': decode_cv2}
+if pyvips is not None:
+    DECODERS['pyvips'] = decode_pyvips
+if PIL is not None:
+    DECODERS['pillow'] = decode_pillow
+
+# Decoders to try by format, in order of preference; None is for unrecognized formats
+FORMAT_DECODERS = {
+    'jpeg': ['cv2', 'pyvips', 'pillow'],
+    'png': ['cv2', 'pyvips', 'pillow'],
+    'webp': ['cv2', 'pyvips', 'pillow'],
+    'tiff': ['cv2', 'pyvips', 'pillow'],
+    'bmp': ['cv2', 'pillow'],
+    'gif': ['cv2', 'pillow', 'pyvips'],
+    'heif': ['pyvips', 'pillow', 'cv2'],
+    'avif': ['pyvips', 'pillow', 'cv2'],
+    None: ['cv2', 'pyvips', 'pillow'],
+}
+
+_stats = {name: {'calls': 0, 'failures': 0, 'seconds': 0.0} for name in DECODERS}
+_stats_lock = threading.Lock()
+
+
+def record_decode(name, seconds, failed):
+    with _stats_lock:
+        stats = _stats.setdefault(name, {'calls': 0, 'failures': 0, 'seconds': 0.0})
+        stats['calls'] += 1
+        stats['seconds'] += seconds
+        stats['failures'] += failed
+
+
+def decode_image(buffer, max_pixels=None, info=None):
+    """Decode an encoded image with the first decoder that can, as (image, decoder name).
+
+    info is the probe_image result when there is one, it lets cv2 shrink at decode time.
+    Returns (None, None) when the buffer is empty or no decoder can read it.
+    """
+    if not len(buffer):
+        return None, None
+    format = info['format'] if info is not None else detect_format(buffer)
+    for name in FORMAT_DECODERS.get(format, FORMAT_DECODERS[None]):
+        decoder = DECODERS.get(name)
+        if decoder is None:
+            continue
+        start = time.perf_counter()
+        try:
+            image = decoder(buffer, max_pixels, info)
+        except Exception as error:
+            logging.warning('Decoding %s with %s failed: %s', format, name, error)
+            image = None
+        record_decode(name, time.perf_counter() - start, image is None)
+        if image is not None:
+            return image, name
+    return None, None
+
+
+def read_pieces(readers, kind, format, *args):
+    """Yield the frames or tiles of the first of the (name, reader) pairs that yields any.
+
+    Readers that are not installed (None) are skipped, and one that fails before its first
+    piece falls back to the next. Only the time spent in the readers is recorded, not the
+    time the caller spends between pieces. Returns whether any reader yielded.
+    """
+    for name, reader in readers:
+        if reader is None:
+            continue
+        pieces = reader(*args)
+        seconds, count = 0.0, 0
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    piece = next(pieces)
+                except StopIteration:
+                    break
+                finally:
+                    seconds += time.perf_counter() - start
+                count += 1
+                yield piece
+        except Exception as error:
+            if count:
+                raise
+            logging.warning('Decoding %s %s with %s failed: %s', format, kind, name, error)
+        finally:
+            pieces.close()
+            record_decode(name, seconds, not count)
+        if count:
+            return True
+    return False
+
+
+# Frames decoded together by cv2.imdecodeanimation, it has no way to resume where it stopped
+ANIMATION_BATCH = 16
+
+
+def pillow_frames(buffer, format, stride, max_frames, max_pixels):
+    # Pillow decodes one frame at a time, compositing GIF and APNG frames like a browser
+    image = PIL.Image.open(io.BytesIO(buffer))
+    for index in range(0, getattr(image, 'n_frames', 1), stride)[:max_frames]:
+        image.seek(index)
+        yield fit_pixels(pillow_to_bgr(image), max_pixels)
+
+
+def cv2_frames(buffer, format, stride, max_frames, max_pixels):
+    if format == 'video':
+        yield from cv2_video_frames(buffer, stride, max_frames, max_pixels)
+        return
+    data = np.frombuffer(buffer, np.uint8)
+    if format == 'tiff':
+        # Pages are independent, decode just the sampled ones
+        for index in itertools.islice(itertools.count(0, stride), max_frames):
+            ok, pages = cv2.imdecodemulti(data, cv2.IMREAD_UNCHANGED, range=(index, index + 1))
+            if not ok or not pages:
+                return
+            yield fit_pixels(to_bgr(pages[0]), max_pixels)
+        return
+
+    yielded = 0
+    for start in itertools.count(0, ANIMATION_BATCH):
+        ok, animation = cv2.imdecodeanimation(data, start, ANIMATION_BATCH)
+        if not ok and start == 0:
+            raise ValueError('cv2 cannot decode this animation')
+        for index, frame in enumerate(animation.frames if ok else [], start):
+            if index % stride == 0 and yielded < max_frames:
+                yielded += 1
+                yield fit_pixels(to_bgr(frame), max_pixels)
+        if not ok or len(animation.frames) < ANIMATION_BATCH or yielded >= max_frames:
+            return
+
+
+def cv2_video_frames(buffer, stride, max_frames, max_pixels):
+    # VideoCapture only reads from files, so the clip is spooled to one
+    with tempfile.NamedTemporaryFile() as file:
+        file.write(buffer)
+        file.flush()
+        capture = cv2.VideoCapture(file.name)
+        try:
+            if not capture.isOpened():
+                raise ValueError('cv2 cannot open this video')
+            index = yielded = 0
+            # grab() skips frames without converting them
+            while yielded < max_frames and capture.grab():
+                if index % stride == 0:
+                    ok, frame = capture.retrieve()
+                    if ok:
+                        yielded += 1
+                        yield fit_pixels(frame, max_pixels)
+                index += 1
+        finally:
+            capture.release()
+
+
+# Frame readers that are installed by name, and by format in order of preference
+FRAME_READERS = {'cv2': cv2_frames}
+if PIL is not None:
+    FRAME_READERS['pillow'] = pillow_frames
+
+FORMAT_FRAME_READERS = {
+    'gif': ['pillow', 'cv2'],
+    'png': ['pillow', 'cv2'],
+    'webp': ['pillow', 'cv2'],
+    'avif': ['cv2', 'pillow'],
+    'heif': ['pillow'],
+    'tiff': ['cv2', 'pillow'],
+    'video': ['cv2'],
+}
+
+
+def decode_frames(buffer, info=None, stride=1, max_frames=100, max_pixels=None):
+    """Iterate over every stride-th frame of an animation, multi-page file or video, up to max_frames.
+
+    Frames are BGR(A) images of at most max_pixels pixels like those of decode_image, and
+    are decoded one at a time (or a few for cv2 animations) so memory does not grow with
+    the length of the input. Falls back to the next reader when one fails before its
+    first frame; a single frame image yields just that frame.
+    """
+    format = info['format'] if info is not None else detect_format(buffer)
+    readers = [(name, FRAME_READERS.get(name)) for name in FORMAT_FRAME_READERS.get(format, [])]
+    if (yield from read_pieces(readers, 'frames', format, buffer, format, stride, max_frames, max_pixels)):
+        return
+
+    image, _ = decode_image(buffer, max_pixels, info)
+    if image is not None:
+        yield image
+
+
+# Pixels per tile (or strip) read by the tile readers, which bounds their memory use
+TILE_PIXELS = int(os.getenv("TILE_PIXELS") or 1_000_000)
+
+
+def pyvips_tiles(buffer):
+    # Sequential access streams the decode, only the current strip of rows is in memory
+    image = pyvips_srgb(pyvips.Image.new_from_buffer(buffer, '', access='sequential'))
+    rows = max(1, TILE_PIXELS // image.width)
+    for y in range(0, image.height, rows):
+        yield 0, y, pyvips_to_bgr(image.crop(0, y, image.width, min(rows, image.height - y)))
+
+
+def tiff_to_bgr(tile):
+    # tifffile segments are RGB(A) or gray with a samples axis
+    if tile.shape[2] >= 3:
+        tile = tile[:, :, [2, 1, 0, 3][:min(tile.shape[2], 4)]]
+    return to_bgr(tile[:, :, 0] if tile.shape[2] == 1 else tile)
+
+
+def tiff_converter(page):
+    # Function from the segments of page to tiff_to_bgr's input, for the photometric
+    # interpretations that are not already gray or RGB
+    photometric = page.photometric
+    if photometric in (tifffile.PHOTOMETRIC.MINISBLACK, tifffile.PHOTOMETRIC.RGB):
+        return lambda tile: tile
+    if photometric == tifffile.PHOTOMETRIC.MINISWHITE:
+        return lambda tile: np.iinfo(tile.dtype).max - tile
+    if photometric == tifffile.PHOTOMETRIC.PALETTE:
+        # The color map has 16-bit entries, some writers put 8-bit values in them
+        colormap = page.colormap.T
+        colormap = (colormap >> 8 if colormap.max() > 255 else colormap).astype(np.uint8)
+        return lambda tile: colormap[tile[:, :, 0]]
+    if photometric == tifffile.PHOTOMETRIC.YCBCR:
+        if page.compression in (tifffile.COMPRESSION.JPEG, tifffile.COMPRESSION.OJPEG):
+            return lambda tile: tile  # the JPEG decoder already returns RGB
+        if tuple(page.subsampling or (1, 1)) != (1, 1) or page.dtype != np.uint8:
+            raise ValueError('Unsupported subsampled YCbCr TIFF')
+        return lambda tile: cv2.cvtColor(np.ascontiguousarray(tile[:, :, [0, 2, 1]]), cv2.COLOR_YCrCb2RGB)
+    if photometric == tifffile.PHOTOMETRIC.SEPARATED and page.samplesperpixel >= 4:
+        # CMYK inks, without color management like Pillow's conversion
+        def cmyk_to_rgb(tile):
+            cmyk = tile[:, :, :4].astype(np.float32) / np.iinfo(tile.dtype).max
+            return np.rint((1 - cmyk[:, :, :3]) * (1 - cmyk[:, :, 3:]) * 255).astype(np.uint8)
+        return cmyk_to_rgb
+    raise ValueError(f'Unsupported TIFF photometric {photometric}')
+
+
+def tifffile_tiles(buffer):
+    # tifffile reads from anything with read and seek, so an mmap is not copied
+    handle = buffer if isinstance(buffer, mmap.mmap) else io.BytesIO(buffer)
+    with tifffile.TiffFile(handle) as tiff:
+        # The first full resolution page, as probed, skipping thumbnails stored before it
+        page = next((page for page in tiff.pages if not page.is_reduced), None)
+        if page is None:
+            raise ValueError('TIFF without a full resolution page')
+        if page.samplesperpixel > 1 and page.planarconfig != tifffile.PLANARCONFIG.CONTIG:
+            raise ValueError('Unsupported planar TIFF')
+        if page.dtype not in (np.uint8, np.uint16):
+            raise ValueError(f'Unsupported TIFF sample type {page.dtype}')
+        convert = tiff_converter(page)
+        # Tiles or strips, decoded one at a time; tiles on the edges are padded beyond the
+        # image. Strips are often a single row, consecutive ones are batched up to TILE_PIXELS.
+        strips, strips_y = [], 0
+        for segment, (_, _, y, x, _), _ in page.segments(maxworkers=1, buffersize=TILE_PIXELS * 4):
+            if segment is None:
+                continue
+            tile = segment[0]
+            if not page.is_tiled:
+                if not strips:
+                    strips_y = y
+                strips.append(tile)
+                if sum(len(strip) for strip in strips) * tile.shape[1] < TILE_PIXELS:
+                    continue
+                tile, strips, x, y = np.concatenate(strips), [], 0, strips_y
+            yield x, y, tiff_to_bgr(convert(tile))
+        if strips:
+            yield 0, strips_y, tiff_to_bgr(convert(np.concatenate(strips)))
+
+
+# Tile readers that are installed by name, and by format in order of preference
+TILE_READERS = {}
+if tifffile is not None:
+    TILE_READERS['tifffile'] = tifffile_tiles
+if pyvips is not None:
+    TILE_READERS['pyvips'] = pyvips_tiles
+
+FORMAT_TILE_READERS = {
+    'tiff': ['tifffile', 'pyvips'],
+    'png': ['pyvips'],
+    'webp': ['pyvips'],
+}
+
+
+def can_decode_tiles(format):
+    return any(name in TILE_READERS for name in FORMAT_TILE_READERS.get(format, []))
+
+
+def decode_tiles(buffer, info):
+    """Iterate over (x, y, tile) pieces of a large image, tiles being BGR(A) like decode_image's.
+
+    Only one tile or strip of about TILE_PIXELS pixels is decoded at a time, so memory does
+    not depend on the size of the image. Falls back to the next reader when one fails
+    before its first tile.
+    """
+    readers = [(name, TILE_READERS.get(name)) for name in FORMAT_TILE_READERS.get(info['format'], [])]
+    yield from read_pieces(readers, 'tiles', info['format'], buffer)
+
+
+def decoder_stats():
+    # Calls, failures and time per decoder in this process
+    with _stats_lock:
+        return {
+            name: dict(stats, mean_ms=stats['seconds'] / stats['calls'] * 1000 if stats['calls'] else 0.0)
+            for name, stats in _stats.items()
+        }
@@ -3,5 +3,5 @@
 if [ "$ENV" = 'TEST' ]; then
     python -m unittest tests
 else 
-    exec gunicorn --bind :8080 --workers 1 --threads 1 --timeout 120 app:app
+    exec gunicorn --config gunicorn.conf.py app:app
 fi
\ No newline at end of file
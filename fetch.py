@@ -0,0 +1,152 @@
+# Fetching images by URI for /analyze_urls
+#
+# Supported schemes:
+# - file:// paths under FETCH_FILE_ROOT (disabled when unset), memory mapped rather than read
+# - s3://bucket/key from S3_ENDPOINT_URL (AWS when unset, or MinIO and the like), with boto3
+# - http(s):// from the hosts listed in FETCH_ALLOWED_HOSTS (disabled when empty)
+#
+# Downloads run in one thread pool of FETCH_CONCURRENCY threads shared by all requests of
+# the process, and the S3 / HTTP clients keep that many pooled connections.
+import mmap
+import os
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import boto3
+    import botocore.config
+    import botocore.exceptions
+except ImportError:  # only needed for s3:// URIs
+    boto3 = None
+
+try:
+    import urllib3
+except ImportError:  # http(s):// falls back to urllib without connection pooling
+    urllib3 = None
+
+FETCH_CONCURRENCY = int(os.getenv("FETCH_CONCURRENCY") or 8)
+FETCH_TIMEOUT = float(os.getenv("FETCH_TIMEOUT") or 30)
+
+fetch_pool = ThreadPoolExecutor(FETCH_CONCURRENCY, thread_name_prefix='fetch')
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+class FetchError(Exception):
+    """A URI that cannot be fetched; status is the HTTP status to report for it."""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def _client(name, factory):
+    # Clients are created on first use and shared, they are thread-safe
+    with _clients_lock:
+        if name not in _clients:
+            _clients[name] = factory()
+        return _clients[name]
+
+
+def fetch_file(uri, max_size):
+    root = os.getenv("FETCH_FILE_ROOT")
+    if not root:
+        raise FetchError('file:// URIs are disabled', 403)
+    root = os.path.realpath(root)
+    path = os.path.realpath(urllib.parse.unquote(urllib.parse.urlsplit(uri).path))
+    if os.path.commonpath([root, path]) != root:
+        raise FetchError('Path is outside of FETCH_FILE_ROOT', 403)
+    try:
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size > max_size:
+                raise FetchError(f'File is larger than {max_size} bytes', 413)
+            if size == 0:
+                return b''
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except OSError as error:
+        raise FetchError(f'Cannot read file: {error.strerror}', 404)
+
+
+def fetch_s3(uri, max_size):
+    if boto3 is None:
+        raise FetchError('s3:// URIs require the boto3 package', 501)
+    parts = urllib.parse.urlsplit(uri)
+    client = _client('s3', lambda: boto3.client(
+        's3', endpoint_url=os.getenv("S3_ENDPOINT_URL") or None,
+        config=botocore.config.Config(max_pool_connections=FETCH_CONCURRENCY, connect_timeout=FETCH_TIMEOUT,
+                                      read_timeout=FETCH_TIMEOUT, s3={'addressing_style': 'path'})))
+    try:
+        response = client.get_object(Bucket=parts.netloc, Key=parts.path.lstrip('/'))
+    except botocore.exceptions.ClientError as error:
+        status = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode') or 502
+        raise FetchError(f'S3 error: {error.response.get("Error", {}).get("Code")}', 404 if status == 404 else 502)
+    except botocore.exceptions.BotoCoreError as error:
+        raise FetchError(f'S3 error: {error}', 502)
+    with response['Body'] as body:
+        if response.get('ContentLength', 0) > max_size:
+            raise FetchError(f'Object is larger than {max_size} bytes', 413)
+        return body.read()
+
+
+class _NoRedirectHandler(urllib.request.HTTPRedirectHandler):
+    # Redirects could lead outside of FETCH_ALLOWED_HOSTS, they are reported as errors instead
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+_no_redirect_opener = urllib.request.build_opener(_NoRedirectHandler)
+
+
+def fetch_http(uri, max_size):
+    allowed = {host.strip() for host in (os.getenv("FETCH_ALLOWED_HOSTS") or '').split(',') if host.strip()}
+    if urllib.parse.urlsplit(uri).netloc not in allowed:
+        raise FetchError('Host is not in FETCH_ALLOWED_HOSTS', 403)
+
+    if urllib3 is not None:
+        pool = _client('http', lambda: urllib3.PoolManager(maxsize=FETCH_CONCURRENCY, timeout=FETCH_TIMEOUT))
+        try:
+            response = pool.request('GET', uri, preload_content=False, redirect=False)
+        except urllib3.exceptions.HTTPError as error:
+            raise FetchError(f'Download failed: {error}', 502)
+        try:
+            if response.status != 200:
+                raise FetchError(f'Download failed with status {response.status}', 404 if response.status == 404 else 502)
+            data = response.read(max_size + 1)
+        except (urllib3.exceptions.HTTPError, OSError) as error:
+            raise FetchError(f'Download failed: {error}', 502)
+        finally:
+            response.release_conn()
+    else:
+        try:
+            with _no_redirect_opener.open(uri, timeout=FETCH_TIMEOUT) as response:
+                data = response.read(max_size + 1)
+        except urllib.error.HTTPError as error:
+            raise FetchError(f'Download failed with status {error.code}', 404 if error.code == 404 else 502)
+        except (urllib.error.URLError, OSError) as error:
+            raise FetchError(f'Download failed: {error}', 502)
+    if len(data) > max_size:
+        raise FetchError(f'Download is larger than {max_size} bytes', 413)
+    return data
+
+
+FETCHERS = {'file': fetch_file, 's3': fetch_s3, 'http': fetch_http, 'https': fetch_http}
+
+
+def fetch(uri, max_size):
+    """Contents of the image at uri, as bytes or a read-only mmap (close it when done).
+
+    Raises FetchError for unsupported or disabled schemes, missing objects, failed
+    downloads and contents over max_size bytes.
+    """
+    try:
+        fetcher = FETCHERS.get(urllib.parse.urlsplit(uri).scheme)
+        if fetcher is None:
+            raise FetchError(f'Unsupported URI scheme, use one of {", ".join(FETCHERS)}')
+        return fetcher(uri, max_size)
+    except ValueError as error:  # malformed URIs, e.g. an unclosed IPv6 host
+        raise FetchError(f'Invalid URI: {error}')
@@ -0,0 +1,49 @@
+# Gunicorn configuration, every setting can be overridden from the environment
+#
+# /analyze is CPU bound (decode + KMeans) while the closest color routes mostly wait on
+# the database, so we run about one worker process per core for the clustering and a
+# few threads per worker to overlap the database round trips.
+import os
+
+
+def cpu_count():
+    # Cores this container may actually run on, not the host total
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def env_int(name, default):
+    return int(os.getenv(name) or default)
+
+
+bind = f'0.0.0.0:{os.getenv("PORT") or 8080}'
+workers = env_int('WEB_CONCURRENCY', cpu_count())
+worker_class = 'gthread'
+threads = env_int('GUNICORN_THREADS', 4)
+timeout = env_int('GUNICORN_TIMEOUT', 120)
+graceful_timeout = env_int('GUNICORN_GRACEFUL_TIMEOUT', 30)
+keepalive = env_int('GUNICORN_KEEPALIVE', 5)
+
+# Recycle workers now and then to bound memory growth from fragmentation, with jitter so
+# that they don't all restart at once
+max_requests = env_int('GUNICORN_MAX_REQUESTS', 1000)
+max_requests_jitter = env_int('GUNICORN_MAX_REQUESTS_JITTER', 100)
+
+# Import the app once in the master so the module level state (color data, caches) is
+# shared copy-on-write by the forked workers
+preload_app = os.getenv('GUNICORN_PRELOAD', '1') != '0'
+
+# Cap the OpenMP / BLAS thread pools of each worker so that workers x threads does not
+# oversubscribe the cores. This must happen before numpy / sklearn are imported, which is
+# why it is done here and not in the app.
+cpu_threads = str(env_int('WORKER_CPU_THREADS', max(1, cpu_count() // workers)))
+for variable in ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'NUMEXPR_NUM_THREADS'):
+    os.environ.setdefault(variable, cpu_threads)
+
+
+def post_fork(server, worker):
+    # The log listener thread does not survive the fork, start one in each worker
+    from log_config import setup_logging
+    setup_logging()
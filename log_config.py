@@ -0,0 +1,111 @@
+# Logging setup: sampled, queue backed and optionally JSON structured
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+
+from flask import g, has_request_context, request
+
+_listener = None
+
+
+class RouteSamplingFilter(logging.Filter):
+    """Keep only a fraction of INFO/DEBUG records per route; warnings and errors always pass.
+
+    rates maps a request path (e.g. '/closest_color_lab') to the kept fraction, '*'
+    sets the default for every other path. Requests are sampled rather than records: the
+    decision is drawn once per request and kept on flask.g, so a request's INFO/DEBUG
+    records are logged all together or not at all. Records outside a request are never sampled.
+    """
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+        self.default_rate = rates.get('*', 1.0)
+
+    def filter(self, record):
+        if not has_request_context():
+            record.route = None
+            return True
+        record.route = request.path
+        if record.levelno >= logging.WARNING:
+            return True
+        if 'log_sampled' not in g:
+            rate = self.rates.get(record.route, self.default_rate)
+            g.log_sampled = rate >= 1.0 or random.random() < rate
+        return g.log_sampled
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    # The stock QueueHandler formats the message in the calling thread; leave that
+    # to the listener so the request thread only pays for the enqueue.
+    def prepare(self, record):
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        if getattr(record, 'route', None):
+            entry['route'] = record.route
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+def parse_sample_rates(value):
+    # "/closest_color_lab=0.01,/analyze=1,*=0.5" -> {'/closest_color_lab': 0.01, ...}
+    rates = {}
+    for item in (value or '').split(','):
+        if '=' in item:
+            route, rate = item.rsplit('=', 1)
+            rates[route.strip()] = float(rate)
+    return rates
+
+
+def setup_logging():
+    """Route all logging through a queue to a background listener thread.
+
+    Configured from the environment: LOG_LEVEL (default INFO), LOG_FORMAT ('json' or
+    'text', default 'text') and LOG_SAMPLE_RATES (see parse_sample_rates).
+    """
+    global _listener
+    stop_logging()
+
+    stream_handler = logging.StreamHandler()
+    if os.getenv('LOG_FORMAT', 'text') == 'json':
+        stream_handler.setFormatter(JsonFormatter())
+    else:
+        stream_handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = DeferredQueueHandler(log_queue)
+    queue_handler.addFilter(RouteSamplingFilter(parse_sample_rates(os.getenv('LOG_SAMPLE_RATES'))))
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel((os.getenv('LOG_LEVEL') or 'INFO').upper())
+
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+
+
+def stop_logging():
+    # Flush and stop the listener thread, e.g. at exit or before re-configuring after a fork
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(stop_logging)
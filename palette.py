@@ -0,0 +1,622 @@
+# Palette extraction: the dominant colors of an image and their share of the pixels
+import logging
+import os
+
+import cv2
+import numpy as np
+from scipy.optimize import linprog
+from sklearn.cluster import KMeans
+from threadpoolctl import threadpool_limits
+
+from cache import LRUCache
+from responses import palette_rows
+
+# OpenMP threads KMeans may use per request, None leaves it to OMP_NUM_THREADS
+KMEANS_THREADS = int(os.getenv("KMEANS_THREADS") or 0) or None
+
+# KMeans settings per quality level. 'best' is the original nine k-means++ restarts;
+# the others run a single pass started from centers seeded by histogram_seeds (or from the
+# palette of a similar image) and stop earlier on convergence.
+QUALITY_SETTINGS = {
+    'fast': {'n_init': 1, 'max_iter': 50, 'tol': 1e-3, 'seeded': True},
+    'balanced': {'n_init': 1, 'max_iter': 300, 'tol': 1e-4, 'seeded': True},
+    'best': {'n_init': 9, 'max_iter': 300, 'tol': 1e-4, 'seeded': False},
+}
+# 'best' until the seeded levels get as close to it as its own restarts are to each other
+DEFAULT_QUALITY = os.getenv("PALETTE_QUALITY") or 'best'
+
+# Color space pixels are clustered in by default, see COLOR_SPACES
+DEFAULT_SPACE = os.getenv("PALETTE_SPACE") or 'rgb'
+
+# Post-processing defaults: swatches closer than this ΔE are merged (2.3 is about a just
+# noticeable difference) and swatches under this percentage of the pixels are dropped
+MERGE_DELTA_E = float(os.getenv("PALETTE_MERGE_DELTA_E") or 2.3)
+MIN_PERCENT = float(os.getenv("PALETTE_MIN_PERCENT") or 0.1)
+
+# Adaptive palette size: candidate colors closer than this ΔE are merged, and candidates
+# covering less than this share of the pixels are dropped, before counting the colors
+ADAPTIVE_DELTA_E = float(os.getenv("ADAPTIVE_DELTA_E") or 10)
+ADAPTIVE_MIN_SHARE = float(os.getenv("ADAPTIVE_MIN_PERCENT") or 0.5) / 100
+MAX_COLORS = 64
+
+# Part of the keys palettes are cached and stored under: bump it with any change that gives
+# the same image and options a different palette, so that older results are not returned
+PALETTE_VERSION = 1
+
+# Opaque images are downsampled to ANALYSIS_SIZE x ANALYSIS_SIZE pixels before clustering
+ANALYSIS_SIZE = 700
+
+# Pixels sampled from images analyzed in tiles, see extract_tiled_palette
+TILED_SAMPLE_PIXELS = int(os.getenv("TILED_SAMPLE_PIXELS") or 4_000_000)
+
+# Cluster centers of recently analyzed images by color_signature, to warm start
+# the clustering of near duplicates
+seed_cache = LRUCache(maxsize=int(os.getenv("PALETTE_SEED_CACHE_SIZE") or 4096))
+
+
+class PaletteError(ValueError):
+    # Raised for requests that cannot be analyzed, e.g. an empty region of interest
+    pass
+
+
+# Function to get the pixels to cluster as an (n, 3) RGB array
+# mask optionally selects the pixels to keep (nonzero), on top of the alpha channel
+def image_pixels(image, mask=None):
+    # If the image has an alpha (transparency) channel, filter out transparent pixels
+    if image.shape[2] == 4:
+        logging.info('transparent image possibly being analyzed...')
+        non_transparent_pixels = image[:, :, 3] > 30
+        if mask is not None:
+            non_transparent_pixels &= mask > 0
+
+        # Filter out the transparent pixels before converting to RGB
+        image_rgb = cv2.cvtColor(image, cv2.COLOR_BGRA2RGB)
+        pixels = image_rgb[non_transparent_pixels]
+
+    elif mask is not None:
+        # Same downsampling as below, the mask follows without blending its edges
+        image_rgb = cv2.cvtColor(cv2.resize(image, (ANALYSIS_SIZE, ANALYSIS_SIZE)), cv2.COLOR_BGR2RGB)
+        pixels = image_rgb[cv2.resize(mask, (ANALYSIS_SIZE, ANALYSIS_SIZE), interpolation=cv2.INTER_NEAREST) > 0]
+
+    else:
+        # Resize the image
+        image_rgb = cv2.resize(image, (ANALYSIS_SIZE, ANALYSIS_SIZE))
+        image_rgb = cv2.cvtColor(image_rgb, cv2.COLOR_BGR2RGB)
+        pixels = image_rgb.reshape(-1, 3)
+
+    if len(pixels) == 0:
+        raise PaletteError('No pixels left to analyze')
+    return pixels
+
+
+def trim_box(image, tolerance=24):
+    """Bounding box (x, y, w, h) of the content inside a uniform border such as a frame or wall.
+
+    The background is the median color of the outermost rows and columns; rows and
+    columns where less than 5% of the pixels differ from it by more than tolerance
+    (in any channel) are trimmed. Works on a subsampled copy of at most ~256px a side.
+    """
+    height, width = image.shape[:2]
+    step = max(1, max(height, width) // 256)
+    small = image[::step, ::step, :3].astype(np.int16)
+    border = np.concatenate([small[0], small[-1], small[:, 0], small[:, -1]])
+    content = np.abs(small - np.median(border, axis=0)).max(axis=2) > tolerance
+
+    rows = np.flatnonzero(content.mean(axis=1) > 0.05)
+    cols = np.flatnonzero(content.mean(axis=0) > 0.05)
+    if len(rows) == 0 or len(cols) == 0:
+        return 0, 0, width, height
+    top, left = rows[0] * step, cols[0] * step
+    bottom, right = min(height, (rows[-1] + 1) * step), min(width, (cols[-1] + 1) * step)
+    return left, top, right - left, bottom - top
+
+
+def select_region(image, crop=None, trim=False, mask=None):
+    """Restrict image (and mask) to the crop box (x, y, w, h) and then to the trimmed content.
+
+    A mask of a different size than the image is stretched to it. Crops are views, so
+    the pixels outside the region are never copied.
+    """
+    if mask is not None and mask.shape[:2] != image.shape[:2]:
+        mask = cv2.resize(mask, (image.shape[1], image.shape[0]), interpolation=cv2.INTER_NEAREST)
+
+    boxes = [crop] if crop else []
+    if trim:
+        boxes.append(None)
+    for box in boxes:
+        x, y, w, h = box or trim_box(image)
+        image = image[y:y + h, x:x + w]
+        mask = mask[y:y + h, x:x + w] if mask is not None else None
+        if image.size == 0:
+            raise PaletteError('The selected region is empty')
+    return image, mask
+
+
+def color_signature(image):
+    # 4x4 thumbnail at 3 bits per channel: equal for re-encodes, resizes and other near duplicates
+    thumbnail = cv2.resize(image[:, :, :3], (4, 4), interpolation=cv2.INTER_AREA)
+    return (thumbnail >> 5).tobytes().hex()
+
+
+def histogram_index(pixels):
+    # Bin of each pixel in a 4096 bin (4 bits per channel) color histogram
+    bins = pixels.astype(np.int32) >> 4
+    return (bins[:, 0] << 8) | (bins[:, 1] << 4) | bins[:, 2]
+
+
+def color_histogram(pixels):
+    # Mean color and pixel count of each occupied bin of a 4096 bin (4 bits per channel) histogram
+    index = histogram_index(pixels)
+    counts = np.bincount(index, minlength=4096)
+    occupied = np.flatnonzero(counts)
+    sums = np.stack([np.bincount(index, weights=pixels[:, c], minlength=4096)[occupied] for c in range(3)], axis=1)
+    return sums / counts[occupied, None], counts[occupied]
+
+
+def histogram_seeds(pixels, n_colors, threads=None):
+    """Initial centers from a weighted KMeans over the color histogram of the pixels.
+
+    Clustering the few thousand occupied bins is much cheaper than a k-means++ restart over
+    all pixels and lands close to the final centers, so it can afford the restarts that keep
+    it out of poor local optima. Returns None when there are fewer occupied bins than colors.
+    """
+    means, counts = color_histogram(pixels)
+    if len(means) <= n_colors:
+        return None
+    return fit_kmeans(KMeans(n_clusters=n_colors, n_init=10), means, threads, sample_weight=counts).cluster_centers_
+
+
+def distinct_seeds(seeds, n_colors):
+    """seeds without duplicates, or None when fewer than n_colors of them are distinct.
+
+    Duplicate initial centers leave clusters empty, which KMeans keeps relocating at a
+    cost of many times a cold start. Images with fewer distinct colors than n_colors
+    (posters, flat art, mostly transparent images) end up with such centers. With
+    n_colors=None, any number of distinct seeds will do.
+    """
+    if seeds is None:
+        return None
+    unique = np.unique(seeds, axis=0)
+    if n_colors is None:
+        return unique if len(unique) else None
+    return seeds if len(unique) >= n_colors else None
+
+
+def merge_similar_colors(colors, weights, delta_e):
+    """Repeatedly merge the two closest colors (in Lab) while they are less than delta_e apart.
+
+    Merged colors are the weight averaged RGB of the pair. Returns the remaining colors and
+    weights, and for each input color the index of the color it ended up in.
+    """
+    colors = np.array(colors, dtype=np.float64)
+    weights = np.array(weights, dtype=np.float64)
+    lab = rgb_to_lab(colors)
+    distances = np.linalg.norm(lab[:, None, :] - lab[None, :, :], axis=2)
+    np.fill_diagonal(distances, np.inf)
+    alive = np.ones(len(colors), dtype=bool)
+    target = np.arange(len(colors))
+
+    while alive.sum() > 1:
+        i, j = np.unravel_index(np.argmin(distances), distances.shape)
+        if distances[i, j] >= delta_e:
+            break
+        # Fold j into i and update i's row and column of the distance matrix
+        total = weights[i] + weights[j]
+        colors[i] = (colors[i] * weights[i] + colors[j] * weights[j]) / total if total else colors[i]
+        weights[i] = total
+        alive[j] = False
+        target[target == j] = i
+        lab[i] = rgb_to_lab(colors[i])
+        row = np.linalg.norm(lab - lab[i], axis=1)
+        row[~alive] = np.inf
+        row[i] = np.inf
+        distances[i, :] = row
+        distances[:, i] = row
+        distances[j, :] = np.inf
+        distances[:, j] = np.inf
+
+    remap = np.cumsum(alive) - 1
+    return colors[alive], weights[alive], remap[target]
+
+
+class FrameHistogram:
+    """Color histogram accumulated over the frames of an animation or video.
+
+    Keeps the pixel count and color sums of the 4096 bins of color_histogram, so memory
+    stays the same however many frames are added.
+    """
+
+    def __init__(self):
+        self.counts = np.zeros(4096)
+        self.sums = np.zeros((4096, 3))
+
+    def add(self, pixels):
+        index = histogram_index(pixels)
+        self.counts += np.bincount(index, minlength=4096)
+        for c in range(3):
+            self.sums[:, c] += np.bincount(index, weights=pixels[:, c], minlength=4096)
+
+    def colors(self):
+        # Same as color_histogram over all the pixels added
+        occupied = np.flatnonzero(self.counts)
+        return self.sums[occupied] / self.counts[occupied, None], self.counts[occupied]
+
+
+def adaptive_seeds(centers, weights, max_colors, threads=None):
+    """Pick the palette size for a color histogram and initial centers for it.
+
+    Clusters the histogram (bin colors and pixel counts, see color_histogram) into at most
+    max_colors candidates, drops the negligible ones and merges the ones closer than
+    ADAPTIVE_DELTA_E; what remains are the seeds.
+    """
+    if len(centers) > max_colors:
+        kmeans = fit_kmeans(KMeans(n_clusters=max_colors, n_init=10), centers, threads, sample_weight=weights)
+        centers = kmeans.cluster_centers_
+        weights = np.bincount(kmeans.labels_, weights=weights, minlength=max_colors)
+
+    keep = weights >= weights.sum() * ADAPTIVE_MIN_SHARE
+    centers, weights, _ = merge_similar_colors(centers[keep], weights[keep], ADAPTIVE_DELTA_E)
+    return centers
+
+
+# Function to get the dominant colors of an image as (cluster centers, pixel share) arrays
+# threads caps the OpenMP threads of the clustering, defaults to KMEANS_THREADS
+# n_colors=None picks the number of colors adaptively, up to max_colors
+# space is the color space to cluster in, the returned colors are always sRGB
+# merge_delta_e and min_percent are passed on to postprocess_palette
+# crop, trim and mask select the pixels to analyze, see select_region
+def extract_palette(image, n_colors, threads=None, quality=None, max_colors=13, space=None,
+                    merge_delta_e=None, min_percent=None, crop=None, trim=False, mask=None):
+    settings = QUALITY_SETTINGS[quality or DEFAULT_QUALITY]
+    space = space or DEFAULT_SPACE
+    image, mask = select_region(image, crop, trim, mask)
+    pixels = image_pixels(image, mask)
+    if len(pixels) < (n_colors or 1):
+        raise PaletteError(f'Only {len(pixels)} pixels to analyze, fewer than n_colors')
+
+    init, n_init = 'k-means++', settings['n_init']
+    # The signature ignores the mask, so masked images are not warm started
+    seed_key = f'{color_signature(image)}:{n_colors or f"auto{max_colors}"}:{space}' if mask is None else None
+    seeds = distinct_seeds(seed_cache.get(seed_key), n_colors) if seed_key else None
+    if seeds is None:
+        if n_colors is None:
+            seeds = adaptive_seeds(*color_histogram(pixels), max_colors, threads)
+        elif settings['seeded']:
+            seeds = distinct_seeds(histogram_seeds(pixels, n_colors, threads), n_colors)
+    if n_colors is None:
+        n_colors = len(seeds)
+    if seeds is not None and settings['seeded']:
+        init, n_init = seeds, 1
+
+    # Seeds are sRGB like the pixels, move both to the clustering space. float32 halves
+    # the memory of the converted pixels and speeds up KMeans.
+    samples = pixels
+    if COLOR_SPACES[space]:
+        to_space, from_space = COLOR_SPACES[space]
+        samples = to_space(pixels).astype(np.float32)
+        if not isinstance(init, str):
+            init = to_space(init).astype(np.float32)
+
+    # Perform KMeans to find the most dominant colors
+    kmeans = KMeans(n_clusters=n_colors, init=init, n_init=n_init, max_iter=settings['max_iter'], tol=settings['tol'])
+    fit_kmeans(kmeans, samples, threads)
+
+    # Get the RGB values of the cluster centers
+    colors = kmeans.cluster_centers_
+    if COLOR_SPACES[space]:
+        colors = np.clip(from_space(colors.astype(np.float64)), 0, 255)
+    if seed_key and distinct_seeds(colors, len(colors)) is not None:
+        seed_cache.set(seed_key, colors)
+
+    # Get the labels for all pixels
+    labels = kmeans.labels_
+
+    # Count the occurrence of each label
+    label_counts = np.bincount(labels, minlength=n_colors)
+    total_count = np.sum(label_counts)
+
+    # Calculate the percentage of each color
+    color_percentages = label_counts / total_count
+
+    return postprocess_palette(colors, color_percentages, merge_delta_e, min_percent)
+
+
+def fit_kmeans(kmeans, samples, threads=None, sample_weight=None):
+    # threads caps the OpenMP threads of the fit, defaults to KMEANS_THREADS
+    threads = threads or KMEANS_THREADS
+    if threads:
+        # The OpenMP thread count is per calling thread, so this doesn't affect concurrent requests
+        with threadpool_limits(limits=threads, user_api='openmp'):
+            return kmeans.fit(samples, sample_weight=sample_weight)
+    return kmeans.fit(samples, sample_weight=sample_weight)
+
+
+def cluster_histogram(means, counts, n_colors, threads=None, quality=None, max_colors=13, space=None):
+    """Dominant colors of a color histogram as (sRGB colors, pixel share) arrays.
+
+    A weighted KMeans over the occupied bins instead of the pixels, used when the pixels
+    are only available one frame at a time. With a few thousand bins at most it can afford
+    the restarts of histogram_seeds whatever the quality.
+    """
+    settings = QUALITY_SETTINGS[quality or DEFAULT_QUALITY]
+    space = space or DEFAULT_SPACE
+    init, n_init = 'k-means++', 10
+    if n_colors is None:
+        init, n_init = adaptive_seeds(means, counts, max_colors, threads), 1
+        n_colors = len(init)
+    if len(means) <= n_colors:
+        # Every occupied bin is a color of its own
+        return means, counts / counts.sum()
+
+    samples = means
+    if COLOR_SPACES[space]:
+        to_space, from_space = COLOR_SPACES[space]
+        samples = to_space(means)
+        if not isinstance(init, str):
+            init = to_space(init)
+    kmeans = KMeans(n_clusters=n_colors, init=init, n_init=n_init, max_iter=settings['max_iter'], tol=settings['tol'])
+    fit_kmeans(kmeans, samples, threads, sample_weight=counts)
+
+    colors = kmeans.cluster_centers_
+    if COLOR_SPACES[space]:
+        colors = np.clip(from_space(colors), 0, 255)
+    return colors, np.bincount(kmeans.labels_, weights=counts, minlength=n_colors) / counts.sum()
+
+
+# Function to get the dominant colors over the frames of an animation or video, frames being
+# an iterable of BGR(A) images that is consumed once. Returns (colors, shares, frame palettes),
+# the frame palettes being a (colors, shares) pair per frame when per_frame is set, or None.
+# The other options are those of extract_palette; the region is selected in every frame.
+def extract_frames_palette(frames, n_colors, threads=None, quality=None, max_colors=13, space=None,
+                           merge_delta_e=None, min_percent=None, crop=None, trim=False, mask=None,
+                           per_frame=False):
+    histogram = FrameHistogram()
+    frame_palettes = [] if per_frame else None
+    decoded = 0
+    for frame in frames:
+        decoded += 1
+        frame, frame_mask = select_region(frame, crop, trim, mask)
+        try:
+            pixels = image_pixels(frame, frame_mask)
+        except PaletteError:
+            # e.g. a fully transparent frame, the other frames may still have pixels
+            continue
+        histogram.add(pixels)
+        if per_frame:
+            palette = cluster_histogram(*color_histogram(pixels), n_colors, threads, quality, max_colors, space)
+            frame_palettes.append(postprocess_palette(*palette, merge_delta_e, min_percent))
+
+    if not decoded:
+        raise PaletteError('No frames could be decoded')
+    if not histogram.counts.any():
+        raise PaletteError('No pixels left to analyze')
+    colors, shares = cluster_histogram(*histogram.colors(), n_colors, threads, quality, max_colors, space)
+    return (*postprocess_palette(colors, shares, merge_delta_e, min_percent), frame_palettes)
+
+
+# Function to get the dominant colors of an image too large to decode at once, tiles being
+# an iterable of (x, y, BGR(A) tile) pieces covering a width x height image, consumed once.
+# Every step-th pixel of the region is counted, step being chosen so that about
+# TILED_SAMPLE_PIXELS pixels are, into a color histogram clustered at the end. The crop box
+# and the mask (stretched over the image) are in pixels of the full image; trim would
+# need the whole image first and is not supported.
+def extract_tiled_palette(tiles, width, height, n_colors, threads=None, quality=None, max_colors=13, space=None,
+                          merge_delta_e=None, min_percent=None, crop=None, trim=False, mask=None):
+    if trim:
+        raise PaletteError('trim is not supported for images this large')
+    left, top, right, bottom = 0, 0, width, height
+    if crop:
+        x, y, w, h = crop
+        left, top, right, bottom = x, y, min(x + w, width), min(y + h, height)
+    if left >= right or top >= bottom:
+        raise PaletteError('The selected region is empty')
+    step = max(1, int(((right - left) * (bottom - top) / TILED_SAMPLE_PIXELS) ** 0.5))
+
+    histogram = FrameHistogram()
+    decoded = 0
+    for x, y, tile in tiles:
+        decoded += 1
+        # Part of the tile inside the region, starting on the sampling grid
+        rows = np.arange(max(y, top), min(y + tile.shape[0], bottom))
+        cols = np.arange(max(x, left), min(x + tile.shape[1], right))
+        rows, cols = rows[(rows - top) % step == 0], cols[(cols - left) % step == 0]
+        if not len(rows) or not len(cols):
+            continue
+        sample = tile[rows[0] - y:rows[-1] - y + 1:step, cols[0] - x:cols[-1] - x + 1:step]
+
+        keep = sample[:, :, 3] > 30 if sample.shape[2] == 4 else None
+        if mask is not None:
+            selected = mask[np.ix_(rows * mask.shape[0] // height, cols * mask.shape[1] // width)] > 0
+            keep = selected if keep is None else keep & selected
+        pixels = sample[:, :, 2::-1]  # BGR to RGB
+        histogram.add(pixels[keep] if keep is not None else pixels.reshape(-1, 3))
+
+    if not decoded:
+        raise PaletteError('The image could not be decoded')
+    if not histogram.counts.any():
+        raise PaletteError('No pixels left to analyze')
+    colors, shares = cluster_histogram(*histogram.colors(), n_colors, threads, quality, max_colors, space)
+    return postprocess_palette(colors, shares, merge_delta_e, min_percent)
+
+
+def postprocess_palette(colors, shares, merge_delta_e=None, min_percent=None):
+    """Merge near duplicate swatches, drop negligible ones and sort by share, largest first.
+
+    Swatches closer than merge_delta_e (default MERGE_DELTA_E) are merged into their share
+    weighted average. Swatches under min_percent (default MIN_PERCENT) of the pixels are
+    dropped and the remaining shares rescaled to add up to 1 again; the largest swatch is
+    always kept. 0 disables either step.
+    """
+    merge_delta_e = MERGE_DELTA_E if merge_delta_e is None else merge_delta_e
+    min_percent = MIN_PERCENT if min_percent is None else min_percent
+
+    if merge_delta_e > 0:
+        colors, shares, _ = merge_similar_colors(colors, shares, merge_delta_e)
+
+    order = np.argsort(-shares, kind='stable')
+    colors, shares = colors[order], shares[order]
+
+    keep = shares * 100 >= min_percent
+    keep[0] = True
+    colors, shares = colors[keep], shares[keep]
+    return colors, shares / shares.sum()
+
+
+# Function to get color palette from image
+def get_color_palette(image, n_colors, **options):
+    return palette_rows(*extract_palette(image, n_colors, **options))
+
+
+# Vectorized color space conversions for (..., 3) arrays of sRGB values in 0-255
+
+RGB_TO_XYZ = np.array([
+    [0.4124564, 0.3575761, 0.1804375],
+    [0.2126729, 0.7151522, 0.0721750],
+    [0.0193339, 0.1191920, 0.9503041],
+])
+XYZ_TO_RGB = np.linalg.inv(RGB_TO_XYZ)
+D65_WHITE = np.array([0.95047, 1.0, 1.08883])
+
+LINEAR_TO_LMS = np.array([
+    [0.4122214708, 0.5363325363, 0.0514459929],
+    [0.2119034982, 0.6806995451, 0.1073969566],
+    [0.0883024619, 0.2817188376, 0.6299787005],
+])
+LMS_TO_OKLAB = np.array([
+    [0.2104542553, 0.7936177850, -0.0040720468],
+    [1.9779984951, -2.4285922050, 0.4505937099],
+    [0.0259040371, 0.7827717662, -0.8086757660],
+])
+OKLAB_TO_LMS = np.linalg.inv(LMS_TO_OKLAB)
+LMS_TO_LINEAR = np.linalg.inv(LINEAR_TO_LMS)
+
+
+def _srgb_to_linear(values):
+    return np.where(values > 0.04045, ((values + 0.055) / 1.055) ** 2.4, values / 12.92)
+
+
+# Linear value of each 8-bit channel value, decoding image pixels is a table lookup
+SRGB_TO_LINEAR_LUT = _srgb_to_linear(np.arange(256) / 255)
+
+
+def srgb_to_linear(rgb):
+    rgb = np.asarray(rgb)
+    if rgb.dtype == np.uint8:
+        return SRGB_TO_LINEAR_LUT[rgb]
+    return _srgb_to_linear(rgb.astype(np.float64) / 255)
+
+
+def linear_to_srgb(linear):
+    linear = np.clip(linear, 0, 1)
+    srgb = np.where(linear > 0.0031308, 1.055 * linear ** (1 / 2.4) - 0.055, linear * 12.92)
+    return srgb * 255
+
+
+def rgb_to_lab(rgb):
+    """CIE Lab, D65 like colormath's conversion."""
+    xyz = srgb_to_linear(rgb) @ RGB_TO_XYZ.T / D65_WHITE
+    f = np.where(xyz > 216 / 24389, np.cbrt(xyz), (24389 / 27 * xyz + 16) / 116)
+    return np.stack([116 * f[..., 1] - 16, 500 * (f[..., 0] - f[..., 1]), 200 * (f[..., 1] - f[..., 2])], axis=-1)
+
+
+def lab_to_rgb(lab):
+    lab = np.asarray(lab, dtype=np.float64)
+    fy = (lab[..., 0] + 16) / 116
+    f = np.stack([fy + lab[..., 1] / 500, fy, fy - lab[..., 2] / 200], axis=-1)
+    xyz = np.where(f > 6 / 29, f ** 3, (116 * f - 16) * 27 / 24389) * D65_WHITE
+    return linear_to_srgb(xyz @ XYZ_TO_RGB.T)
+
+
+def rgb_to_oklab(rgb):
+    return np.cbrt(srgb_to_linear(rgb) @ LINEAR_TO_LMS.T) @ LMS_TO_OKLAB.T
+
+
+def oklab_to_rgb(oklab):
+    lms = (np.asarray(oklab, dtype=np.float64) @ OKLAB_TO_LMS.T) ** 3
+    return linear_to_srgb(lms @ LMS_TO_LINEAR.T)
+
+
+# Spaces pixels can be clustered in: name -> (from sRGB, to sRGB), None for sRGB itself
+COLOR_SPACES = {
+    'rgb': None,
+    'lab': (rgb_to_lab, lab_to_rgb),
+    'oklab': (rgb_to_oklab, oklab_to_rgb),
+}
+
+
+def palette_delta_e(colors, percents, reference_colors):
+    """Pixel share weighted mean ΔE (CIE76) from each color to its nearest reference color."""
+    distances = np.linalg.norm(rgb_to_lab(colors)[:, None, :] - rgb_to_lab(reference_colors)[None, :, :], axis=2)
+    return float(np.sum(distances.min(axis=1) * percents) / np.sum(percents))
+
+
+# Palette signatures: fixed length soft histograms over a coarse Lab grid, so that palettes
+# can be compared (and indexed) as plain vectors whatever their number of swatches
+SIGNATURE_CENTERS = np.array([[l, a, b] for l in (20, 50, 80) for a in (-60, -20, 20, 60) for b in (-60, -20, 20, 60)], np.float64)
+SIGNATURE_SIGMA = 20.0
+
+
+def palette_signature(colors, shares):
+    """Signature vector of a palette, 48 values whose Euclidean distances compare palettes.
+
+    Every swatch spreads its share over the grid cells with Gaussian weights of how much
+    farther they are than the nearest cell (saturated colors lie outside the grid), and the
+    square root of the histogram makes Euclidean distance the Hellinger distance between them.
+    """
+    distances = np.linalg.norm(rgb_to_lab(np.asarray(colors, np.float64))[:, None, :] - SIGNATURE_CENTERS[None, :, :], axis=2)
+    weights = np.exp(-(distances - distances.min(axis=1, keepdims=True)) ** 2 / (2 * SIGNATURE_SIGMA ** 2))
+    weights /= weights.sum(axis=1, keepdims=True)
+    histogram = (weights * np.asarray(shares, np.float64)[:, None]).sum(axis=0)
+    return np.sqrt(histogram / histogram.sum())
+
+
+# Earth mover's distance between palettes: the least share weighted ΔE (CIE76) the swatches
+# of one palette have to be moved by to turn into the other. Exact with a linear program,
+# or approximated with entropy regularized transport (Sinkhorn) for many palettes at once.
+SINKHORN_EPSILON = 5.0
+SINKHORN_ITERATIONS = 50
+
+
+def _palette_lab(colors, shares):
+    shares = np.asarray(shares, np.float64)
+    return rgb_to_lab(np.asarray(colors, np.float64).reshape(-1, 3)), shares / shares.sum()
+
+
+def palette_emd(colors, shares, other_colors, other_shares):
+    """Exact earth mover's distance between two palettes, in ΔE. Shares need not sum to 1."""
+    lab, weights = _palette_lab(colors, shares)
+    other_lab, other_weights = _palette_lab(other_colors, other_shares)
+    cost = np.linalg.norm(lab[:, None, :] - other_lab[None, :, :], axis=2)
+    m, n = cost.shape
+    # Flows out of each swatch sum to its share, flows into each other swatch to its share
+    constraints = np.vstack([np.kron(np.eye(m), np.ones(n)), np.kron(np.ones(m), np.eye(n))])
+    result = linprog(cost.ravel(), A_eq=constraints, b_eq=np.concatenate([weights, other_weights]),
+                     bounds=(0, None), method='highs')
+    return float(result.fun)
+
+
+def sinkhorn_emd(colors, shares, candidates, epsilon=SINKHORN_EPSILON, iterations=SINKHORN_ITERATIONS):
+    """Approximate palette_emd from one palette to each (colors, shares) of candidates.
+
+    All candidates are solved together, padded to the largest palette with empty swatches.
+    Smaller epsilon (in ΔE) is closer to the exact distance but needs more iterations.
+    """
+    lab, weights = _palette_lab(colors, shares)
+    size = max(len(candidate_shares) for _, candidate_shares in candidates)
+    other_lab = np.zeros((len(candidates), size, 3))
+    other_weights = np.zeros((len(candidates), size))
+    for index, (candidate_colors, candidate_shares) in enumerate(candidates):
+        candidate_lab, candidate_weights = _palette_lab(candidate_colors, candidate_shares)
+        other_lab[index, :len(candidate_weights)] = candidate_lab
+        other_weights[index, :len(candidate_weights)] = candidate_weights
+
+    cost = np.linalg.norm(lab[None, :, None, :] - other_lab[:, None, :, :], axis=3)
+    # Alternate scalings of the kernel to each marginal. ΔE stays under 400, so the kernel
+    # does not underflow for epsilon of 1 and more and the plain (not log domain) updates are stable.
+    kernel = np.exp(-cost / epsilon)
+    u = np.ones((len(candidates), len(weights)))
+    for _ in range(iterations):
+        v = other_weights / np.einsum('bij,bi->bj', kernel, u)
+        u = weights / np.einsum('bij,bj->bi', kernel, v)
+    plan = u[:, :, None] * kernel * v[:, None, :]
+    return (plan * cost).sum(axis=(1, 2))
@@ -0,0 +1,267 @@
+# Header-only image probing
+#
+# Reads the container headers of JPEG, PNG, WebP, GIF, TIFF and BMP files to find their size
+# without decoding any pixel data, so that decompression bombs can be rejected and the
+# decode planned before cv2.imdecode allocates anything. Every parser works on a bytes-like
+# buffer (bytes, memoryview or mmap) and only touches the bytes it needs.
+import struct
+
+# TIFF tags
+NEW_SUBFILE_TYPE, IMAGE_WIDTH, IMAGE_LENGTH, BITS_PER_SAMPLE, SAMPLES_PER_PIXEL = 254, 256, 257, 258, 277
+TIFF_TAGS = {NEW_SUBFILE_TYPE, IMAGE_WIDTH, IMAGE_LENGTH, BITS_PER_SAMPLE, SAMPLES_PER_PIXEL}
+TIFF_TYPES = {3: ('H', 2), 4: ('I', 4), 16: ('Q', 8)}  # SHORT, LONG, LONG8
+# NewSubfileType bit of reduced resolution versions (thumbnails, overviews) of another page
+REDUCED_RESOLUTION = 1
+# Directory layout by version, classic TIFF (42) or BigTIFF (43): struct code and size of
+# the offsets, of the entry counts, and the size of an entry
+TIFF_LAYOUTS = {42: ('I', 4, 'H', 2, 12), 43: ('Q', 8, 'Q', 8, 20)}
+
+# JPEG start of frame markers, the others in C0..CF are DHT, JPG and DAC
+JPEG_SOF = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+PNG_CHANNELS = {0: 1, 2: 3, 3: 3, 4: 2, 6: 4}
+
+# Bound on the frames and directories walked, against crafted files with cycles or millions of empty frames
+MAX_FRAMES = 100000
+
+
+class ProbeError(ValueError):
+    # The header announces a supported format but is truncated or inconsistent
+    pass
+
+
+def image_info(format, width, height, channels, bit_depth=8, frames=1):
+    return {'format': format, 'width': width, 'height': height, 'channels': channels,
+            'bit_depth': bit_depth, 'frames': frames}
+
+
+def probe_png(buffer):
+    if len(buffer) < 33 or bytes(buffer[12:16]) != b'IHDR':
+        raise ProbeError('Truncated PNG header')
+    width, height, bit_depth, color_type = struct.unpack_from('>IIBB', buffer, 16)
+    channels = PNG_CHANNELS.get(color_type)
+    if channels is None:
+        raise ProbeError(f'Invalid PNG color type {color_type}')
+
+    # Chunk headers up to the image data: tRNS adds an alpha channel, acTL makes it an animation
+    frames, offset = 1, 33
+    while offset + 8 <= len(buffer):
+        length, kind = struct.unpack_from('>I4s', buffer, offset)
+        if kind == b'IDAT':
+            break
+        if kind == b'tRNS' and channels in (1, 3):
+            channels += 1
+        elif kind == b'acTL' and offset + 12 <= len(buffer):
+            frames = struct.unpack_from('>I', buffer, offset + 8)[0]
+        offset += 12 + length
+    return image_info('png', width, height, channels, bit_depth, frames)
+
+
+def probe_jpeg(buffer):
+    offset = 2
+    while offset + 4 <= len(buffer):
+        if buffer[offset] != 0xFF:
+            raise ProbeError('Invalid JPEG marker')
+        marker = buffer[offset + 1]
+        if marker == 0xFF:  # fill byte
+            offset += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD9:  # markers without a length
+            offset += 2
+            continue
+        length = struct.unpack_from('>H', buffer, offset + 2)[0]
+        if marker in JPEG_SOF:
+            if offset + 10 > len(buffer):
+                break
+            bit_depth, height, width, channels = struct.unpack_from('>BHHB', buffer, offset + 4)
+            return image_info('jpeg', width, height, channels, bit_depth)
+        offset += 2 + length
+    raise ProbeError('JPEG without a frame header')
+
+
+def probe_gif(buffer):
+    if len(buffer) < 13:
+        raise ProbeError('Truncated GIF header')
+    width, height, flags = struct.unpack_from('<HHB', buffer, 6)
+    offset = 13
+    if flags & 0x80:  # global color table
+        offset += 3 << ((flags & 0x07) + 1)
+
+    def skip_sub_blocks(offset):
+        while offset < len(buffer) and buffer[offset]:
+            offset += buffer[offset] + 1
+        return offset + 1
+
+    # Count the image descriptors, skipping over extensions and image data sub-blocks
+    frames = 0
+    while offset < len(buffer) and frames < MAX_FRAMES:
+        block = buffer[offset]
+        if block == 0x3B:  # trailer
+            break
+        if block == 0x21:  # extension
+            offset = skip_sub_blocks(offset + 2)
+        elif block == 0x2C:  # image descriptor
+            frames += 1
+            if offset + 10 > len(buffer):
+                break
+            flags = buffer[offset + 9]
+            offset += 10
+            if flags & 0x80:  # local color table
+                offset += 3 << ((flags & 0x07) + 1)
+            offset = skip_sub_blocks(offset + 1)  # after the LZW minimum code size
+        else:
+            raise ProbeError('Invalid GIF block')
+    return image_info('gif', width, height, 3, 8, max(frames, 1))
+
+
+def probe_webp(buffer):
+    offset, width, height, channels, frames = 12, None, None, 3, 0
+    while offset + 8 <= len(buffer):
+        kind, length = struct.unpack_from('<4sI', buffer, offset)
+        data = offset + 8
+        if kind == b'VP8X' and data + 10 <= len(buffer):
+            flags = buffer[data]
+            channels = 4 if flags & 0x10 else 3
+            width = int.from_bytes(bytes(buffer[data + 4:data + 7]), 'little') + 1
+            height = int.from_bytes(bytes(buffer[data + 7:data + 10]), 'little') + 1
+            if not flags & 0x02:  # not animated, the canvas is the image
+                return image_info('webp', width, height, channels)
+        elif kind == b'ANMF':
+            frames += 1
+            if frames >= MAX_FRAMES:
+                break
+        elif kind == b'VP8 ' and width is None and data + 10 <= len(buffer):
+            width, height = struct.unpack_from('<HH', buffer, data + 6)
+            return image_info('webp', width & 0x3FFF, height & 0x3FFF, channels)
+        elif kind == b'VP8L' and width is None and data + 5 <= len(buffer):
+            bits = int.from_bytes(bytes(buffer[data + 1:data + 5]), 'little')
+            channels = 4 if bits >> 28 & 1 else 3
+            return image_info('webp', (bits & 0x3FFF) + 1, (bits >> 14 & 0x3FFF) + 1, channels)
+        offset = data + length + (length & 1)  # chunks are padded to an even size
+    if width is None:
+        raise ProbeError('WebP without an image chunk')
+    return image_info('webp', width, height, channels, 8, max(frames, 1))
+
+
+def probe_tiff(buffer):
+    endian = '<' if bytes(buffer[:2]) == b'II' else '>'
+    if len(buffer) < 16:
+        raise ProbeError('Truncated TIFF header')
+    version = struct.unpack_from(endian + 'H', buffer, 2)[0]
+    offset_code, offset_size, count_code, count_size, entry_size = TIFF_LAYOUTS[version]
+    # The first directory's offset follows the version, after the offset size and a zero in BigTIFF
+    offset = struct.unpack_from(endian + offset_code, buffer, 8 if version == 43 else 4)[0]
+
+    # Directories are pages, except the reduced resolution ones (thumbnails, pyramid levels)
+    # of another page; the first full resolution page describes the image
+    info, frames, directories, seen = None, 0, 0, set()
+    while offset and offset not in seen and offset + count_size <= len(buffer) and directories < MAX_FRAMES:
+        seen.add(offset)
+        directories += 1
+        count = struct.unpack_from(endian + count_code, buffer, offset)[0]
+        entries = offset + count_size
+        tags = {}
+        for entry in range(entries, min(entries + entry_size * count, len(buffer) - entry_size + 1), entry_size):
+            tag, kind, values = struct.unpack_from(endian + 'HH' + offset_code, buffer, entry)
+            if kind in TIFF_TYPES and tag in TIFF_TAGS:
+                code, size = TIFF_TYPES[kind]
+                # Values that do not fit in the entry are stored elsewhere, the first one is enough
+                value_offset = entry + 4 + offset_size
+                if values * size > offset_size:
+                    value_offset = struct.unpack_from(endian + offset_code, buffer, value_offset)[0]
+                if value_offset + size <= len(buffer):
+                    tags[tag] = struct.unpack_from(endian + code, buffer, value_offset)[0]
+        if not tags.get(NEW_SUBFILE_TYPE, 0) & REDUCED_RESOLUTION:
+            if info is None:
+                if IMAGE_WIDTH not in tags or IMAGE_LENGTH not in tags:
+                    raise ProbeError('TIFF without image dimensions')
+                info = image_info('tiff', tags[IMAGE_WIDTH], tags[IMAGE_LENGTH],
+                                  tags.get(SAMPLES_PER_PIXEL, 1), tags.get(BITS_PER_SAMPLE, 1))
+            frames += 1
+        next_offset = entries + entry_size * count
+        offset = 0
+        if next_offset + offset_size <= len(buffer):
+            offset = struct.unpack_from(endian + offset_code, buffer, next_offset)[0]
+    if info is None:
+        raise ProbeError('TIFF without an image directory')
+    info['frames'] = frames
+    return info
+
+
+def probe_bmp(buffer):
+    if len(buffer) < 30:
+        raise ProbeError('Truncated BMP header')
+    if struct.unpack_from('<I', buffer, 14)[0] == 12:  # OS/2 BITMAPCOREHEADER
+        width, height, _, bit_depth = struct.unpack_from('<HHHH', buffer, 18)
+    else:
+        width, height, _, bit_depth = struct.unpack_from('<iiHH', buffer, 18)
+    # A negative height stores the rows top-down, palette images decode to BGR
+    return image_info('bmp', abs(width), abs(height), 4 if bit_depth == 32 else 3)
+
+
+# ISO base media brands of HEIF and AVIF images
+HEIF_BRANDS = {b'heic', b'heix', b'heim', b'heis', b'hevc', b'hevx', b'mif1', b'msf1'}
+AVIF_BRANDS = {b'avif', b'avis'}
+
+
+def detect_format(buffer):
+    """Image format from the magic bytes at the start of buffer, or None."""
+    header = bytes(buffer[:16])
+    if header.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'png'
+    if header.startswith(b'\xff\xd8'):
+        return 'jpeg'
+    if header[:6] in (b'GIF87a', b'GIF89a'):
+        return 'gif'
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return 'webp'
+    if header[:4] in (b'II*\x00', b'MM\x00*', b'II+\x00', b'MM\x00+'):  # classic and BigTIFF
+        return 'tiff'
+    if header[:2] == b'BM':
+        return 'bmp'
+    if header[4:8] == b'ftyp':
+        if header[8:12] in AVIF_BRANDS:
+            return 'avif'
+        if header[8:12] in HEIF_BRANDS:
+            return 'heif'
+        return 'video'  # MP4, MOV, 3GP and the other ISO base media files
+    if header[:4] == b'\x1aE\xdf\xa3' or header[:4] == b'RIFF' and header[8:12] == b'AVI ':
+        return 'video'  # Matroska / WebM, AVI
+    return None
+
+
+PROBES = {'png': probe_png, 'jpeg': probe_jpeg, 'gif': probe_gif, 'webp': probe_webp, 'tiff': probe_tiff,
+          'bmp': probe_bmp}
+
+
+def probe_image(buffer):
+    """Format, width, height, channels, bit_depth and frames of an encoded image, from its header.
+
+    Returns None for formats that are not probed (they may still be decodable) and
+    raises ProbeError for probed but malformed headers.
+    """
+    probe = PROBES.get(detect_format(buffer))
+    if probe is None:
+        return None
+    try:
+        return probe(buffer)
+    except (struct.error, IndexError) as error:
+        raise ProbeError(f'Truncated image header: {error}')
+
+
+def reduced_decode_scale(info, target, crop=None):
+    """Largest of 8, 4 or 2 the image can be shrunk by at decode time and stay at least target a side.
+
+    With a crop box (x, y, w, h) it is the box that must stay at least target a side.
+    1 when it cannot: unknown or small images, and images with an alpha channel since
+    the reduced cv2 decode modes drop it.
+    """
+    if info is None or info['channels'] in (2, 4):
+        return 1
+    width, height = info['width'], info['height']
+    if crop:
+        width, height = min(crop[2], width), min(crop[3], height)
+    for scale in (8, 4, 2):
+        if min(width, height) // scale >= target:
+            return scale
+    return 1
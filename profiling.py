@@ -0,0 +1,55 @@
+# Opt-in per request profiling
+import cProfile
+import functools
+import hmac
+import io
+import logging
+import os
+import pstats
+import uuid
+
+from flask import request, make_response
+
+
+def profile_requested(secret):
+    # The secret can be sent as the X-Profile header or the ?profile= query parameter
+    token = request.headers.get('X-Profile') or request.args.get('profile')
+    return token is not None and hmac.compare_digest(token.encode(), secret.encode())
+
+
+def profiled(view):
+    """Run the wrapped view under cProfile when the request carries the profiling secret.
+
+    Without PROFILE_SECRET configured the view is returned unwrapped, so normal
+    requests pay nothing. The profile is saved to PROFILE_DIR/<request id>.prof;
+    with ?profile_output=text the pstats summary is returned instead of the view's response.
+    """
+    secret = os.getenv("PROFILE_SECRET")
+    profile_dir = os.getenv("PROFILE_DIR") or "/tmp/profiles"
+    if not secret:
+        return view
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if not profile_requested(secret):
+            return view(*args, **kwargs)
+
+        request_id = request.headers.get('X-Request-ID') or uuid.uuid4().hex
+        profiler = cProfile.Profile()
+        response = make_response(profiler.runcall(view, *args, **kwargs))
+
+        os.makedirs(profile_dir, exist_ok=True)
+        path = os.path.join(profile_dir, f'{os.path.basename(request_id)}.prof')
+        profiler.dump_stats(path)
+        logging.info('Saved profile for %s %s to %s', request.path, request_id, path)
+
+        if request.args.get('profile_output') == 'text':
+            stream = io.StringIO()
+            pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(50)
+            response = make_response(stream.getvalue(), 200, {'Content-Type': 'text/plain'})
+
+        response.headers['X-Request-ID'] = request_id
+        response.headers['X-Profile-Path'] = path
+        return response
+
+    return wrapper
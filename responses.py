@@ -0,0 +1,131 @@
+# Response serialization helpers
+import decimal
+import io
+import json
+
+import numpy as np
+from flask import Response, request
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, fall back to the standard library encoder
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None
+
+MSGPACK_MIMETYPE = 'application/msgpack'
+ARROW_MIMETYPE = 'application/vnd.apache.arrow.stream'
+
+
+def _default(obj):
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, decimal.Decimal):
+        # Same representation Flask's jsonify uses
+        return str(obj)
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+
+def dumps(obj, sort_keys=False):
+    """Serialize obj to JSON bytes, with orjson when it is installed."""
+    if orjson is not None:
+        option = orjson.OPT_SERIALIZE_NUMPY
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=_default, option=option)
+    return json.dumps(obj, default=_default, sort_keys=sort_keys, separators=(',', ':')).encode()
+
+
+def json_response(obj, status=200, sort_keys=False):
+    response = Response(dumps(obj, sort_keys=sort_keys), status=status, mimetype='application/json')
+    # JSON is the fallback of content negotiation, see binary_mimetype
+    response.vary.add('Accept')
+    return response
+
+
+def hex_codes(rgb):
+    # rgb is an (n, 3) integer array
+    return ['#%02x%02x%02x' % tuple(color) for color in rgb.tolist()]
+
+
+def palette_columns(colors, percents):
+    """Palette as parallel arrays: {'r': [...], 'g': [...], 'b': [...], 'html_code': [...], 'percent': [...]}.
+
+    r, g and b are uint8 arrays and percent a float64 array, so the binary encoders
+    can emit them as typed buffers.
+    """
+    rgb = colors.astype(np.uint8)
+    return {
+        'r': rgb[:, 0],
+        'g': rgb[:, 1],
+        'b': rgb[:, 2],
+        'html_code': hex_codes(rgb),
+        'percent': np.asarray(percents, dtype=np.float64) * 100,
+    }
+
+
+def palette_rows(colors, percents):
+    """Palette as a list of {'r', 'g', 'b', 'html_code', 'percent'} dicts, one per color."""
+    columns = palette_columns(colors, percents)
+    return [
+        {'r': r, 'g': g, 'b': b, 'html_code': html_code, 'percent': percent}
+        for r, g, b, html_code, percent in zip(
+            columns['r'].tolist(), columns['g'].tolist(), columns['b'].tolist(),
+            columns['html_code'], columns['percent'].tolist())
+    ]
+
+
+def _msgpack_default(obj):
+    if isinstance(obj, np.ndarray):
+        # Typed buffer: the client rebuilds it with e.g. np.frombuffer(data, dtype)
+        return {'dtype': obj.dtype.str, 'shape': list(obj.shape), 'data': obj.tobytes()}
+    return _default(obj)
+
+
+def encode_msgpack(columns):
+    return msgpack.packb(columns, default=_msgpack_default)
+
+
+def encode_arrow(columns):
+    batch = pyarrow.RecordBatch.from_pydict(columns)
+    sink = io.BytesIO()
+    with pyarrow.ipc.new_stream(sink, batch.schema) as writer:
+        writer.write_batch(batch)
+    return sink.getvalue()
+
+
+# Binary table encoders by mimetype, only for the libraries that are installed
+BINARY_ENCODERS = {}
+if msgpack is not None:
+    BINARY_ENCODERS[MSGPACK_MIMETYPE] = encode_msgpack
+if pyarrow is not None:
+    BINARY_ENCODERS[ARROW_MIMETYPE] = encode_arrow
+
+
+def binary_mimetype():
+    """Binary mimetype the client prefers over JSON according to its Accept header, or None."""
+    best = request.accept_mimetypes.best_match(['application/json', *BINARY_ENCODERS])
+    return best if best in BINARY_ENCODERS else None
+
+
+def table_response(columns, mimetype, status=200):
+    """Encode a table of equal length columns in a binary format from BINARY_ENCODERS."""
+    response = Response(BINARY_ENCODERS[mimetype](columns), status=status, mimetype=mimetype)
+    response.vary.add('Accept')
+    return response
+
+
+def record_columns(record):
+    # A single result row as a one row table
+    return {key: [value] for key, value in record.items()}
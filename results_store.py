@@ -0,0 +1,278 @@
+# Durable palette results in Postgres, a second level cache behind palette_cache
+#
+# Results are keyed by the same key as palette_cache (content hash plus options). Lookups
+# run in the request, writes are queued and inserted in batches by a background thread so
+# they never add latency to a request. Failures of the store are logged and otherwise
+# ignored: without it, images are simply analyzed again. The tables are created by migrate,
+# once at startup, never on the request path.
+import contextlib
+import logging
+import queue
+import threading
+
+import numpy as np
+import psycopg2
+import psycopg2.extras
+import psycopg2.pool
+
+from palette import palette_emd, palette_signature, rgb_to_lab, sinkhorn_emd
+
+# Colors are sRGB as clustered (not rounded), percents the shares of the pixels in 0-1.
+# lab holds the same colors as cube points, for distance queries over stored palettes.
+SCHEMA = """
+    CREATE EXTENSION IF NOT EXISTS cube;
+    CREATE TABLE IF NOT EXISTS palette_results (
+        cache_key text PRIMARY KEY,
+        image_sha256 text NOT NULL,
+        params jsonb NOT NULL,
+        colors double precision[][] NOT NULL,
+        percents double precision[] NOT NULL,
+        lab cube[] NOT NULL,
+        frames jsonb,
+        analysis_s real,
+        created_at timestamptz NOT NULL DEFAULT now()
+    );
+    CREATE INDEX IF NOT EXISTS palette_results_image_sha256 ON palette_results (image_sha256);
+    ALTER TABLE palette_results ADD COLUMN IF NOT EXISTS signature cube;
+    CREATE INDEX IF NOT EXISTS palette_results_signature ON palette_results USING gist (signature);
+    CREATE TABLE IF NOT EXISTS palette_swatches (
+        cache_key text NOT NULL REFERENCES palette_results ON DELETE CASCADE,
+        lab cube NOT NULL,
+        percent real NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS palette_swatches_lab ON palette_swatches USING gist (lab);
+"""
+
+INSERT = """
+    INSERT INTO palette_results (cache_key, image_sha256, params, colors, percents, lab, frames, analysis_s, signature)
+    VALUES %s
+    ON CONFLICT (cache_key) DO NOTHING
+    RETURNING cache_key
+"""
+INSERT_TEMPLATE = '(%s, %s, %s, %s, %s, %s::text[]::cube[], %s, %s, cube(%s::float8[]))'
+# One row per swatch of the inserted results, unnested from their lab and percents columns
+INSERT_SWATCHES = """
+    INSERT INTO palette_swatches (cache_key, lab, percent)
+    SELECT cache_key, unnest(lab), unnest(percents) * 100
+    FROM palette_results
+    WHERE cache_key = ANY(%s)
+"""
+
+# Nearest neighbours in the GiST indexes. Several rows can belong to the same image (one
+# per swatch, or per set of options), so candidates are over-fetched and reduced to the
+# closest row of each image.
+SEARCH_CANDIDATES = 8
+# Palettes closest by signature that are ranked by earth mover's distance, at least
+RERANK_CANDIDATES = 500
+SEARCH_BY_COLOR = """
+    SELECT DISTINCT ON (r.image_sha256) r.image_sha256, r.colors, r.percents, r.params, s.distance
+    FROM (
+        SELECT cache_key, lab <-> cube(%(lab)s::float8[]) AS distance
+        FROM palette_swatches
+        WHERE percent >= %(min_percent)s
+        ORDER BY lab <-> cube(%(lab)s::float8[])
+        LIMIT %(candidates)s
+    ) s
+    JOIN palette_results r USING (cache_key)
+    ORDER BY r.image_sha256, s.distance
+"""
+SEARCH_BY_PALETTE = """
+    SELECT DISTINCT ON (image_sha256) image_sha256, colors, percents, params, distance
+    FROM (
+        SELECT image_sha256, colors, percents, params, signature <-> cube(%(signature)s::float8[]) AS distance
+        FROM palette_results
+        WHERE signature IS NOT NULL
+        ORDER BY signature <-> cube(%(signature)s::float8[])
+        LIMIT %(candidates)s
+    ) candidates
+    ORDER BY image_sha256, distance
+"""
+
+
+def connection_pool(max_connections=8, connect_timeout=2, **params):
+    """Pool of up to max_connections connections to the database of params (psycopg2.connect's).
+
+    Connections are opened on demand, so the pool can be created before the workers fork,
+    and give up after connect_timeout seconds so that an unreachable database delays
+    requests by that much at most. Beyond max_connections in use, getconn raises
+    psycopg2.pool.PoolError, which lookups treat like any other database error.
+    """
+    return psycopg2.pool.ThreadedConnectionPool(0, max_connections, connect_timeout=connect_timeout, **params)
+
+
+class ResultsStore:
+    """Palette results table with synchronous lookups and batched background inserts.
+
+    pool hands out psycopg2 connections, like psycopg2.pool.ThreadedConnectionPool (see
+    connection_pool); the writer keeps one of them. Up to batch_size results are inserted
+    together, waiting at most flush_interval seconds for a batch to fill; results beyond
+    max_pending queued ones are dropped rather than blocking requests.
+    """
+
+    def __init__(self, pool, batch_size=100, flush_interval=1.0, max_pending=10000):
+        self.pool = pool
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(max_pending)
+        self.lock = threading.Lock()
+        self.writer = None
+        self.counts = {'hits': 0, 'misses': 0, 'errors': 0, 'written': 0, 'dropped': 0}
+
+    def _count(self, name, value=1):
+        with self.lock:
+            self.counts[name] += value
+
+    def migrate(self):
+        """Create the extension, tables and indexes that are missing, and return whether it worked.
+
+        The connection is closed afterwards rather than pooled, so that none is shared by
+        the workers forked after a migration in the parent process.
+        """
+        conn = None
+        try:
+            conn = self.pool.getconn()
+            with conn.cursor() as cur:
+                cur.execute(SCHEMA)
+            conn.commit()
+        except psycopg2.Error as error:
+            logging.warning('Results store migration failed: %s', error)
+            return False
+        finally:
+            if conn is not None:
+                self.pool.putconn(conn, close=True)
+        return True
+
+    @contextlib.contextmanager
+    def _connection(self):
+        # A connection of the pool, closed rather than returned after a failure (the server
+        # may have restarted, leaving the pooled connections broken)
+        conn = self.pool.getconn()
+        try:
+            yield conn
+            conn.rollback()  # ends the read transaction, pooled connections stay idle
+        except BaseException:
+            self.pool.putconn(conn, close=True)
+            raise
+        self.pool.putconn(conn)
+
+    def get(self, key):
+        """(colors, percents, frame_palettes) stored under key, or None."""
+        try:
+            with self._connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute('SELECT colors, percents, frames FROM palette_results WHERE cache_key = %s', (key,))
+                    row = cur.fetchone()
+        except psycopg2.Error as error:
+            logging.warning('Results store lookup failed: %s', error)
+            self._count('errors')
+            return None
+        if row is None:
+            self._count('misses')
+            return None
+        self._count('hits')
+        colors, percents, frames = row
+        if frames is not None:
+            frames = [(np.array(frame_colors, np.float64).reshape(-1, 3), np.array(frame_percents, np.float64))
+                      for frame_colors, frame_percents in frames]
+        return np.array(colors, np.float64).reshape(-1, 3), np.array(percents, np.float64), frames
+
+    def put(self, key, image_sha256, params, result, analysis_s=None):
+        """Queue result, as returned by get, for insertion under key."""
+        colors, percents, frames = result
+        colors = np.asarray(colors, np.float64)
+        lab = ['(%r, %r, %r)' % tuple(point) for point in rgb_to_lab(colors).tolist()]
+        if frames is not None:
+            frames = psycopg2.extras.Json([(np.asarray(frame_colors).tolist(), np.asarray(frame_percents).tolist())
+                                           for frame_colors, frame_percents in frames])
+        row = (key, image_sha256, psycopg2.extras.Json(params), colors.tolist(),
+               np.asarray(percents, np.float64).tolist(), lab, frames, analysis_s,
+               palette_signature(colors, percents).tolist())
+        self._start_writer()
+        try:
+            self.queue.put_nowait(row)
+        except queue.Full:
+            self._count('dropped')
+
+    def _start_writer(self):
+        # Started on first use so that it runs in the worker process, not in a
+        # preloading parent that forks the workers afterwards
+        with self.lock:
+            if self.writer is None or not self.writer.is_alive():
+                self.writer = threading.Thread(target=self._write_loop, name='results-store', daemon=True)
+                self.writer.start()
+
+    def _next_batch(self):
+        batch = [self.queue.get()]
+        try:
+            while len(batch) < self.batch_size:
+                batch.append(self.queue.get(timeout=self.flush_interval))
+        except queue.Empty:
+            pass
+        return batch
+
+    def _write_loop(self):
+        conn = None
+        while True:
+            batch = self._next_batch()
+            try:
+                if conn is None or conn.closed:
+                    conn = self.pool.getconn()
+                with conn.cursor() as cur:
+                    inserted = psycopg2.extras.execute_values(cur, INSERT, batch, template=INSERT_TEMPLATE, fetch=True)
+                    cur.execute(INSERT_SWATCHES, ([key for key, in inserted],))
+                conn.commit()
+                self._count('written', len(batch))
+            except Exception as error:  # the writer must survive anything, results are only a cache
+                logging.warning('Results store dropped %s results: %s', len(batch), error)
+                self._count('errors')
+                self._count('dropped', len(batch))
+                if conn is not None:
+                    self.pool.putconn(conn, close=True)
+                conn = None
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def _search(self, query, params, candidates):
+        # The closest row of each image among the candidates, closest first
+        with self._connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(query, dict(params, candidates=candidates))
+                rows = cur.fetchall()
+        return [{'image_sha256': image_sha256, 'colors': np.array(colors, np.float64).reshape(-1, 3),
+                 'percents': np.array(percents, np.float64), 'params': row_params, 'distance': distance}
+                for image_sha256, colors, percents, row_params, distance in sorted(rows, key=lambda row: row[4])]
+
+    def search_by_color(self, rgb, k=10, min_percent=0):
+        """Up to k images with a swatch close to rgb covering at least min_percent, closest first.
+
+        Each result is a dict of image_sha256, colors, percents, params and distance (the ΔE
+        of the closest swatch). Raises psycopg2.Error when the database is unavailable.
+        """
+        lab = rgb_to_lab(np.asarray(rgb, np.float64)).tolist()
+        return self._search(SEARCH_BY_COLOR, {'lab': lab, 'min_percent': min_percent}, k * SEARCH_CANDIDATES)[:k]
+
+    def search_by_palette(self, colors, shares, k=10):
+        """Up to k images with the palettes closest to colors and shares, by earth mover's distance.
+
+        The images with the closest palette signatures are ranked by the Sinkhorn approximation,
+        and the exact distance is only computed for the k best of them. Results are like
+        search_by_color's, distance is the earth mover's distance in ΔE.
+        """
+        candidates = self._search(SEARCH_BY_PALETTE, {'signature': palette_signature(colors, shares).tolist()},
+                                  max(k * SEARCH_CANDIDATES, RERANK_CANDIDATES))
+        if not candidates:
+            return []
+        approximate = sinkhorn_emd(colors, shares, [(result['colors'], result['percents']) for result in candidates])
+        results = [candidates[index] for index in np.argsort(approximate)[:k]]
+        for result in results:
+            result['distance'] = palette_emd(colors, shares, result['colors'], result['percents'])
+        return sorted(results, key=lambda result: result['distance'])
+
+    def flush(self):
+        """Wait until every queued result is written (or dropped)."""
+        self.queue.join()
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counts, pending=self.queue.qsize())
@@ -1,9 +1,76 @@
+import functools
+import http.server
+import io
 import json
+import os
+import struct
+import tempfile
+import threading
 import unittest
+import zlib
+from unittest import mock
+import cv2
+import msgpack
+import numpy as np
+import psycopg2
+from flask import Flask
 from flask_testing import TestCase
-from app import app  # Import the Flask app
+from sklearn.cluster import KMeans
+from threadpoolctl import threadpool_limits
+from app import app, closest_color_cache, color_etag, palette_cache  # Import the Flask app
+import analysis
+import bulk
+import decoders
+import fetch
+import results_store
+from benchmark import compare_to_baseline, make_image
+from cache import LRUCache, RedisCache, SharedMemoryCache, pack, redis, unpack
+from decoders import DECODERS, FRAME_READERS, can_decode_tiles, decode_frames, decode_image, decoder_stats
+from log_config import RouteSamplingFilter, parse_sample_rates
+from palette import (COLOR_SPACES, FrameHistogram, PaletteError, color_histogram, distinct_seeds, extract_palette,
+                     extract_tiled_palette, image_pixels, merge_similar_colors, palette_emd, palette_signature,
+                     postprocess_palette, rgb_to_lab, seed_cache, select_region, sinkhorn_emd, trim_box)
+from probe import ProbeError, image_info, probe_image, reduced_decode_scale
+from profiling import profiled
+from responses import dumps, encode_arrow, palette_columns, palette_rows, record_columns
+from results_store import ResultsStore
 import logging
 
+try:
+    import PIL.Image
+except ImportError:  # Pillow is optional
+    PIL = None
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:  # only needed for Arrow responses
+    pyarrow = None
+
+class FakeCursor:
+    def __init__(self, row):
+        self.row = row
+
+    def execute(self, query, params):
+        pass
+
+    def fetchone(self):
+        return self.row
+
+    def close(self):
+        pass
+
+class FakeConnection:
+    # Stands in for psycopg2 connections so the closest color routes can run without a database
+    def __init__(self, row):
+        self.row = row
+
+    def cursor(self, cursor_factory=None):
+        return FakeCursor(self.row)
+
+    def close(self):
+        pass
+
 class FlaskAppTest(TestCase):
     def create_app(self):
         app.config['TESTING'] = True
@@ -12,6 +79,8 @@ class FlaskAppTest(TestCase):
     def setUp(self):
         logging.basicConfig(level=logging.INFO)
         logging.info("Setting up the test case")
+        closest_color_cache.clear()
+        palette_cache.clear()
 
     def tearDown(self):
         logging.info("Tearing down the test case")
@@ -25,6 +94,313 @@ class FlaskAppTest(TestCase):
         self.assertEqual(response.status_code, 400)
         self.assertEqual(response.data, b'No file part')
 
+    def test_analyze_palette(self):
+        image = make_image('poster', 0.05)
+        _, encoded = cv2.imencode('.png', image)
+
+        response = self.client.post('/analyze', query_string={'threads': 1},
+                                    data={'image': (io.BytesIO(encoded.tobytes()), 'poster.png')})
+        self.assertEqual(response.status_code, 200)
+        palette = json.loads(response.data)
+        self.assertEqual(len(palette), 13)
+        self.assertEqual(set(palette[0]), {'r', 'g', 'b', 'html_code', 'percent'})
+        self.assertAlmostEqual(sum(color['percent'] for color in palette), 100)
+
+        response = self.client.post('/analyze', query_string={'format': 'columnar'},
+                                    data={'image': (io.BytesIO(encoded.tobytes()), 'poster.png')})
+        columns = json.loads(response.data)
+        self.assertEqual(len(columns['html_code']), 13)
+        self.assertAlmostEqual(sum(columns['percent']), 100)
+        # The second upload of the same image is answered from the palette cache
+        self.assertEqual(columns['html_code'], [color['html_code'] for color in palette])
+
+        # Dropping the swatches of the blended edges between the poster's five flat colors
+        response = self.client.post('/analyze', query_string={'min_percent': 1},
+                                    data={'image': (io.BytesIO(encoded.tobytes()), 'poster.png')})
+        percents = [color['percent'] for color in json.loads(response.data)]
+        self.assertEqual(len(percents), 5)
+        self.assertEqual(percents, sorted(percents, reverse=True))
+        self.assertAlmostEqual(sum(percents), 100)
+
+    def test_analyze_msgpack(self):
+        _, encoded = cv2.imencode('.png', make_image('poster', 0.05))
+
+        response = self.client.post('/analyze', headers={'Accept': 'application/msgpack'},
+                                    data={'image': (io.BytesIO(encoded.tobytes()), 'poster.png')})
+        self.assertEqual(response.mimetype, 'application/msgpack')
+        columns = msgpack.unpackb(response.data)
+        percent = np.frombuffer(columns['percent']['data'], columns['percent']['dtype'])
+        self.assertEqual(len(percent), 13)
+        self.assertAlmostEqual(percent.sum(), 100)
+
+    def test_analyze_adaptive_n_colors(self):
+        # A two color logo with anti-aliased edges
+        image = np.full((200, 300, 3), 255, np.uint8)
+        cv2.circle(image, (150, 100), 60, (30, 40, 200), -1, lineType=cv2.LINE_AA)
+        _, encoded = cv2.imencode('.png', image)
+
+        response = self.client.post('/analyze', query_string={'n_colors': 'auto'},
+                                    data={'image': (io.BytesIO(encoded.tobytes()), 'logo.png')})
+        palette = json.loads(response.data)
+        self.assertEqual(len(palette), 2)
+        self.assertGreater(max(color['g'] for color in palette), 250)
+
+        response = self.client.post('/analyze', query_string={'n_colors': 'many'},
+                                    data={'image': (io.BytesIO(encoded.tobytes()), 'logo.png')})
+        self.assertEqual(response.status_code, 400)
+
+    def test_analyze_crop_and_mask(self):
+        # Left half red, right half blue
+        image = np.zeros((100, 200, 3), np.uint8)
+        image[:, :100] = (0, 0, 255)
+        image[:, 100:] = (255, 0, 0)
+        _, encoded = cv2.imencode('.png', image)
+
+        response = self.client.post('/analyze', query_string={'crop': '120,10,50,50', 'n_colors': 'auto'},
+                                    data={'image': (io.BytesIO(encoded.tobytes()), 'image.png')})
+        self.assertEqual([color['html_code'] for color in json.loads(response.data)], ['#0000ff'])
+
+        mask = np.zeros((100, 200), np.uint8)
+        mask[:, :50] = 255
+        _, encoded_mask = cv2.imencode('.png', mask)
+        response = self.client.post('/analyze', query_string={'n_colors': 'auto'},
+                                    data={'image': (io.BytesIO(encoded.tobytes()), 'image.png'),
+                                          'mask': (io.BytesIO(encoded_mask.tobytes()), 'mask.png')})
+        self.assertEqual([color['html_code'] for color in json.loads(response.data)], ['#ff0000'])
+
+        # Masks are probed and limited like the image, a tiny PNG of 4 MP never gets decoded
+        _, bomb = cv2.imencode('.png', np.zeros((2000, 2000), np.uint8))
+        with mock.patch('analysis.MAX_IMAGE_PIXELS', 100000), mock.patch('analysis.decode_image', wraps=decode_image) as decode:
+            response = self.client.post('/analyze', data={'image': (io.BytesIO(encoded.tobytes()), 'image.png'),
+                                                          'mask': (io.BytesIO(bomb.tobytes()), 'mask.png')})
+        self.assertEqual(response.status_code, 413)
+        self.assertIn('Masks are limited', json.loads(response.data)['error'])
+        self.assertEqual(decode.call_count, 0)
+
+        response = self.client.post('/analyze', query_string={'crop': '10,10'},
+                                    data={'image': (io.BytesIO(encoded.tobytes()), 'image.png')})
+        self.assertEqual(response.status_code, 400)
+
+    def test_analyze_large_upload(self):
+        # Noise does not compress, so this is spooled to a temporary file and memory mapped
+        _, encoded = cv2.imencode('.png', make_image('noise', 0.3))
+        self.assertGreater(len(encoded), 500 * 1024)
+        response = self.client.post('/analyze', query_string={'n_colors': 3, 'quality': 'fast'},
+                                    data={'image': (io.BytesIO(encoded.tobytes()), 'noise.png')})
+        self.assertEqual(len(json.loads(response.data)), 3)
+
+        response = self.client.post('/analyze', data={'image': (io.BytesIO(b'not an image'), 'image.png')})
+        self.assertEqual(response.status_code, 400)
+
+    def test_analyze_too_large(self):
+        limit = app.config['MAX_CONTENT_LENGTH']
+        app.config['MAX_CONTENT_LENGTH'] = 1024
+        try:
+            response = self.client.post('/analyze', data={'image': (io.BytesIO(bytes(4096)), 'image.png')})
+        finally:
+            app.config['MAX_CONTENT_LENGTH'] = limit
+        self.assertEqual(response.status_code, 413)
+        self.assertIn('1024 bytes', json.loads(response.data)['error'])
+
+    def test_analyze_decompression_bomb(self):
+        def chunk(kind, data):
+            return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+        # A few hundred bytes announcing a 50000 x 50000 image
+        header = struct.pack('>IIBBBBB', 50000, 50000, 8, 2, 0, 0, 0)
+        png = b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) + chunk(b'IDAT', zlib.compress(bytes(1000))) + chunk(b'IEND', b'')
+        response = self.client.post('/analyze', data={'image': (io.BytesIO(png), 'bomb.png')})
+        self.assertEqual(response.status_code, 413)
+
+    def test_analyze_reduced_decode(self):
+        _, encoded = cv2.imencode('.jpg', make_image('poster', 4))
+        response = self.client.post('/analyze', query_string={'n_colors': 'auto', 'crop': '0,0,2000,1500'},
+                                    data={'image': (io.BytesIO(encoded.tobytes()), 'poster.jpg')})
+        self.assertEqual(response.status_code, 200)
+        self.assertLessEqual(len(json.loads(response.data)), 5)
+
+    def test_analyze_animation(self):
+        # Red, green, blue and red again frames
+        animation = cv2.Animation()
+        animation.frames = [np.full((60, 80, 3), color, np.uint8) for color in [(0, 0, 255), (0, 255, 0), (255, 0, 0), (0, 0, 255)]]
+        animation.durations = [100] * 4
+        _, encoded = cv2.imencodeanimation('.gif', animation)
+
+        response = self.client.post('/analyze', query_string={'n_colors': 'auto'},
+                                    data={'image': (io.BytesIO(encoded.tobytes()), 'animation.gif')})
+        palette = json.loads(response.data)
+        self.assertEqual([round(color['percent']) for color in palette], [50, 25, 25])
+
+        response = self.client.post('/analyze', query_string={'n_colors': 'auto', 'frame_stride': 2, 'per_frame': 1},
+                                    data={'image': (io.BytesIO(encoded.tobytes()), 'animation.gif')})
+        data = json.loads(response.data)
+        self.assertEqual(len(data['palette']), 2)
+        self.assertEqual([len(frame) for frame in data['frames']], [1, 1])
+        self.assertGreater(data['frames'][1][0]['b'], 250)
+
+    def test_analyze_video(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'clip.mp4')
+            writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), 10, (80, 60))
+            for color in [(0, 0, 255), (255, 0, 0)] * 5:
+                writer.write(np.full((60, 80, 3), color, np.uint8))
+            writer.release()
+            if not os.path.getsize(path):
+                self.skipTest('OpenCV was built without an MP4 encoder')
+            with open(path, 'rb') as f:
+                clip = f.read()
+
+        response = self.client.post('/analyze', query_string={'n_colors': 'auto'},
+                                    data={'image': (io.BytesIO(clip), 'clip.mp4')})
+        palette = json.loads(response.data)
+        self.assertEqual([round(color['percent']) for color in palette], [50, 50])
+
+    def test_analyze_tiled(self):
+        if not can_decode_tiles('tiff'):
+            self.skipTest('Neither tifffile nor pyvips is installed')
+        _, encoded = cv2.imencode('.tiff', make_image('poster', 0.5))
+        whole = self.client.post('/analyze', query_string={'n_colors': 'auto', 'crop': '100,50,400,300'},
+                                 data={'image': (io.BytesIO(encoded.tobytes()), 'scan.tiff')})
+
+        palette_cache.clear()
+        calls = sum(stats['calls'] for name, stats in decoder_stats().items() if name != 'cv2')
+        with mock.patch('analysis.TILED_MIN_PIXELS', 1):
+            tiled = self.client.post('/analyze', query_string={'n_colors': 'auto', 'crop': '100,50,400,300'},
+                                     data={'image': (io.BytesIO(encoded.tobytes()), 'scan.tiff')})
+            trimmed = self.client.post('/analyze', query_string={'trim': 1},
+                                       data={'image': (io.BytesIO(encoded.tobytes()), 'scan.tiff')})
+        self.assertEqual(sum(stats['calls'] for name, stats in decoder_stats().items() if name != 'cv2'), calls + 1)
+        # The same swatches, up to the blending of the whole image's resize
+        tiled, whole = json.loads(tiled.data), json.loads(whole.data)
+        self.assertEqual(len(tiled), len(whole))
+        for tiled_color, whole_color in zip(tiled, whole):
+            for channel in 'rgb':
+                self.assertLessEqual(abs(tiled_color[channel] - whole_color[channel]), 2)
+        self.assertEqual(trimmed.status_code, 400)
+
+        # Files no tile reader can read are decoded whole when they are within MAX_IMAGE_PIXELS
+        def unreadable(buffer):
+            raise ValueError('Unsupported TIFF')
+            yield
+
+        palette_cache.clear()
+        with mock.patch('analysis.TILED_MIN_PIXELS', 1), mock.patch.dict('decoders.TILE_READERS', {'tifffile': unreadable, 'pyvips': unreadable}):
+            fallback = self.client.post('/analyze', query_string={'n_colors': 'auto', 'crop': '100,50,400,300'},
+                                        data={'image': (io.BytesIO(encoded.tobytes()), 'scan.tiff')})
+            with mock.patch('analysis.MAX_IMAGE_PIXELS', 1000):
+                palette_cache.clear()
+                too_large = self.client.post('/analyze', data={'image': (io.BytesIO(encoded.tobytes()), 'scan.tiff')})
+        self.assertEqual(json.loads(fallback.data), whole)
+        self.assertEqual(too_large.status_code, 413)
+
+    def test_analyze_urls(self):
+        class QuietHandler(http.server.SimpleHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+        with tempfile.TemporaryDirectory() as directory:
+            # Served as file://, as http:// and as the bucket of an S3-compatible endpoint
+            os.mkdir(os.path.join(directory, 'bucket'))
+            for name, color in [('red.png', (0, 0, 255)), ('bucket/blue.png', (255, 0, 0))]:
+                cv2.imwrite(os.path.join(directory, name), np.full((60, 80, 3), color, np.uint8))
+            server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(QuietHandler, directory=directory))
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            host = f'127.0.0.1:{server.server_address[1]}'
+            uris = [f'file://{directory}/red.png', f'http://{host}/bucket/blue.png', f'http://{host}/missing.png',
+                    f'file://{directory}/../etc/passwd', 'ftp://example.com/image.png', 'http://[::1/x.png']
+            if fetch.boto3 is not None:
+                uris.append('s3://bucket/blue.png')
+            environment = {'FETCH_FILE_ROOT': directory, 'FETCH_ALLOWED_HOSTS': host, 'S3_ENDPOINT_URL': f'http://{host}',
+                           'AWS_ACCESS_KEY_ID': 'test', 'AWS_SECRET_ACCESS_KEY': 'test', 'AWS_DEFAULT_REGION': 'us-east-1'}
+            try:
+                with mock.patch.dict(os.environ, environment), mock.patch.dict(fetch._clients, clear=True):
+                    response = self.client.post('/analyze_urls', query_string={'n_colors': 'auto'}, json={'uris': uris})
+            finally:
+                server.shutdown()
+                server.server_close()
+
+        self.assertEqual(response.status_code, 200)
+        results = json.loads(response.data)
+        self.assertEqual([result['uri'] for result in results], uris)
+        self.assertEqual(results[0]['palette'][0]['html_code'], '#ff0000')
+        self.assertEqual(results[1]['palette'][0]['html_code'], '#0000ff')
+        self.assertEqual([result.get('status') for result in results[2:6]], [404, 403, 400, 400])
+        if fetch.boto3 is not None:
+            self.assertEqual(results[6]['palette'], results[1]['palette'])
+
+        # Unexpected failures are reported for their URI only
+        with mock.patch('app.fetch', side_effect=[RuntimeError('boom'), b'not an image']):
+            response = self.client.post('/analyze_urls', json={'uris': ['s3://a/1.png', 's3://a/2.png']})
+        self.assertEqual([result['status'] for result in json.loads(response.data)], [500, 400])
+
+        response = self.client.post('/analyze_urls', json={'uris': []})
+        self.assertEqual(response.status_code, 400)
+
+    def test_analyze_results_store(self):
+        class DictStore:
+            # Stands in for ResultsStore, keeps the results in a dict
+            def __init__(self):
+                self.results = {}
+
+            def get(self, key):
+                return self.results.get(key)
+
+            def put(self, key, image_sha256, params, result, analysis_s=None):
+                self.results[key] = result
+
+        _, encoded = cv2.imencode('.png', np.full((60, 80, 3), (0, 0, 255), np.uint8))
+        store = DictStore()
+        with mock.patch('app.results_store', store):
+            first = self.client.post('/analyze', data={'image': (io.BytesIO(encoded.tobytes()), 'red.png')})
+            self.assertEqual(len(store.results), 1)
+            # A fresh worker finds the palette in the store instead of analyzing the image again
+            palette_cache.clear()
+            with mock.patch('analysis.extract_palette') as extract_palette:
+                second = self.client.post('/analyze', data={'image': (io.BytesIO(encoded.tobytes()), 'red.png')})
+            extract_palette.assert_not_called()
+        self.assertEqual(json.loads(first.data), json.loads(second.data))
+
+    def test_search(self):
+        response = self.client.get('/search/by_color', query_string={'hex': 'ff0000'})
+        self.assertEqual(response.status_code, 503)
+
+        store = mock.Mock()
+        store.search_by_palette.return_value = [{'image_sha256': 'abc', 'distance': 0.1, 'params': {'n_colors': 2},
+                                                 'colors': np.array([[255.0, 0, 0]]), 'percents': np.array([1.0])}]
+        palette = [{'r': 250, 'g': 5, 'b': 5, 'percent': 80}, {'r': 0, 'g': 0, 'b': 0, 'percent': 20}]
+        with mock.patch('app.results_store', store):
+            response = self.client.post('/search/by_palette', query_string={'k': 5}, json=palette)
+            invalid = self.client.post('/search/by_palette', json=[{'r': 1}])
+        self.assertEqual(invalid.status_code, 400)
+        self.assertEqual(store.search_by_palette.call_args[0], ([[250.0, 5.0, 5.0], [0.0, 0.0, 0.0]], [80.0, 20.0], 5))
+        results = json.loads(response.data)
+        self.assertEqual(results[0]['image_sha256'], 'abc')
+        self.assertEqual(results[0]['palette'][0]['html_code'], '#ff0000')
+
+    def test_compare_palettes(self):
+        palette = [{'r': 255, 'g': 0, 'b': 0, 'percent': 60}, {'r': 0, 'g': 0, 'b': 255, 'percent': 40}]
+        response = self.client.post('/compare_palettes', json={'a': palette, 'b': palette[::-1]})
+        data = json.loads(response.data)
+        self.assertAlmostEqual(data['emd'], 0)
+        self.assertLess(data['sinkhorn'], 1)
+        response = self.client.post('/compare_palettes', json={'a': palette})
+        self.assertEqual(response.status_code, 400)
+        # NaN and Infinity are valid JSON (for Python) but not palettes
+        for value in ('NaN', 'Infinity'):
+            body = '{"a": [{"r": 255, "g": 0, "b": 0, "percent": %s}], "b": [{"r": 0, "g": 0, "b": 255, "percent": 1}]}' % value
+            response = self.client.post('/compare_palettes', data=body, content_type='application/json')
+            self.assertEqual(response.status_code, 400)
+        # Channels out of 0-255 are rejected too, NaN included (it compares false with both bounds)
+        for channel in (100000, -1, 'NaN'):
+            body = '{"a": [{"r": %s, "g": 0, "b": 0, "percent": 1}], "b": [{"r": 0, "g": 0, "b": 255, "percent": 1}]}' % channel
+            response = self.client.post('/compare_palettes', data=body, content_type='application/json')
+            self.assertEqual(response.status_code, 400)
+
+    def test_analyze_invalid_quality(self):
+        response = self.client.post('/analyze', query_string={'quality': 'perfect'},
+                                    data={'image': (io.BytesIO(b'not an image'), 'image.png')})
+        self.assertEqual(response.status_code, 400)
+
     def test_closest_color_invalid_hex(self):
         response = self.client.get('/closest_color_rgb', query_string={'hex': 'invalid'})
         self.assertEqual(response.status_code, 400)
@@ -36,7 +412,40 @@ class FlaskAppTest(TestCase):
         self.assertEqual(response.status_code, 400)
         data = json.loads(response.data)
         self.assertEqual(data['error'], 'Please provide r, g and b values')
+
+    def test_closest_color_out_of_range(self):
+        # Rejected before an ETag is built, ?r=16&g=256&b=0 and ?r=257&g=0&b=0 would share one
+        for query in ({'r': 16, 'g': 256, 'b': 0}, {'r': 257, 'g': 0, 'b': 0}, {'r': -1, 'g': 0, 'b': 0}):
+            response = self.client.get('/closest_color_lab', query_string=query)
+            self.assertEqual(response.status_code, 400)
+            self.assertNotIn('ETag', response.headers)
     
+    def test_closest_color_not_modified(self):
+        with app.test_request_context('/closest_color_lab'):
+            etag = color_etag(255, 0, 0)
+
+        # Both spellings of the same color revalidate against the same tag without a database query
+        for query in ({'hex': 'FF0000'}, {'r': 255, 'g': 0, 'b': 0}):
+            response = self.client.get('/closest_color_lab', query_string=query, headers={'If-None-Match': f'"{etag}"'})
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.headers['ETag'], f'"{etag}"')
+            self.assertIn('max-age=', response.headers['Cache-Control'])
+
+    def test_closest_color_memoized(self):
+        row = {'color_name': 'Black', 'hex': '000000', 'distance': 0.0}
+        with mock.patch('app.connect_db', return_value=FakeConnection(row)) as connect_db:
+            first = self.client.get('/closest_color_rgb', query_string={'hex': '000000'})
+            second = self.client.get('/closest_color_rgb', query_string={'r': 0, 'g': 0, 'b': 0})
+        self.assertEqual(connect_db.call_count, 1)
+        self.assertEqual(json.loads(first.data), row)
+        self.assertEqual(second.data, first.data)
+        metrics = json.loads(self.client.get('/metrics').data)
+        self.assertEqual(metrics['closest_color_cache']['hits'], 1)
+        self.assertIn('cv2', metrics['decoders'])
+
+    def test_clear_cache_requires_secret(self):
+        self.assertEqual(self.client.post('/cache/clear').status_code, 403)
+
     def test_get_closest_color(self):
         response = self.client.get('/closest_color_lab', query_string={'r': 0, 'g': 0, 'b': 0})
         data = json.loads(response.data.decode())
@@ -48,5 +457,568 @@ class FlaskAppTest(TestCase):
         # Here we assume black has the color name 'Black'
         self.assertEqual(data['color_name'], 'Black')
 
+
+class BenchmarkTest(unittest.TestCase):
+    def test_make_image_shapes(self):
+        self.assertEqual(make_image('poster', 0.3).shape, (474, 632, 3))
+        self.assertEqual(make_image('noise', 0.3, alpha=True).shape, (474, 632, 4))
+
+    def test_compare_to_baseline(self):
+        entry = {'p50_s': 1.0, 'p99_s': 1.0, 'peak_memory_mb': 10}
+        baseline = {'benchmarks': {'case': entry}}
+        self.assertEqual(compare_to_baseline({'benchmarks': {'case': entry}}, baseline, 0.2), [])
+        slower = dict(entry, p99_s=1.5)
+        self.assertEqual(len(compare_to_baseline({'benchmarks': {'case': slower}}, baseline, 0.2)), 1)
+
+class BulkTest(unittest.TestCase):
+    def test_bulk_resumes_from_output(self):
+        with tempfile.TemporaryDirectory() as directory:
+            os.mkdir(os.path.join(directory, 'images'))
+            for seed, kind in enumerate(['poster', 'photo']):
+                cv2.imwrite(os.path.join(directory, 'images', f'{kind}.png'), make_image(kind, 0.1, seed=seed))
+            with open(os.path.join(directory, 'images', 'broken.jpg'), 'wb') as f:
+                f.write(b'\xff\xd8 not a jpeg')
+            output = os.path.join(directory, 'palettes.jsonl')
+            # An interrupted run left one complete record and a partial line
+            with open(output, 'w') as f:
+                f.write(json.dumps({'path': os.path.join(directory, 'images', 'photo.png')}) + '\n{"path": "/trunc')
+
+            files = bulk.find_images([os.path.join(directory, 'images')])
+            report = bulk.run(files, bulk.JsonlOutput(output), {'n_colors': 3}, workers=2, checkpoint_every=1, chunksize=1)
+            self.assertEqual((report['analyzed'], report['errors'], report['already_done']), (2, 1, 1))
+            self.assertEqual(set(report['stage_mean_s']), {'read', 'analyze'})
+            with open(output) as f:
+                records = [json.loads(line) for line in f]
+            self.assertEqual(len(records), 3)
+            by_name = {os.path.basename(record['path']): record for record in records}
+            self.assertEqual(len(by_name['poster.png']['palette']), 3)
+            self.assertIsNotNone(by_name['broken.jpg']['error'])
+
+            if bulk.pyarrow is not None:
+                parquet = os.path.join(directory, 'palettes.parquet')
+                bulk.main([os.path.join(directory, 'images'), '--output', parquet, '--workers', '1', '--n-colors', '3'])
+                self.assertEqual(bulk.ParquetOutput(parquet).done(), {record['path'] for record in records})
+
+    def test_bulk_matches_analyze(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'poster.png')
+            cv2.imwrite(path, make_image('poster', 0.1, seed=1))
+            options = {'n_colors': 3, 'crop': (10, 10, 50, 40)}
+            # Seeded, so that both get the same clustering
+            with mock.patch('palette.KMeans', functools.partial(KMeans, random_state=0)):
+                record = bulk.analyze_file(path, options)
+                with open(path, 'rb') as f:
+                    result, error, _ = analysis.analyze_buffer(f.read(), {**bulk.DEFAULT_OPTIONS, **options}, bulk.DEFAULT_FRAME_OPTIONS)
+            self.assertIsNone(record['error'])
+            self.assertEqual(record['palette'], palette_rows(*result[:2]))
+
+            # Any failure is recorded for the file instead of stopping the run
+            with mock.patch('bulk.analyze_buffer', side_effect=MemoryError):
+                record = bulk.analyze_file(path, options)
+            self.assertEqual((record['palette'], record['error']), (None, 'MemoryError'))
+
+
+class LRUCacheTest(unittest.TestCase):
+    def test_eviction_and_ttl(self):
+        cache = LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual((cache.get('a'), cache.get('c')), (1, 3))
+
+        cache = LRUCache(ttl=10)
+        cache.set('a', 1)
+        with mock.patch('cache.time.monotonic', return_value=cache._data['a'][1] + 1):
+            self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.stats()['hit_ratio'], 0.0)
+
+class SharedCacheTest(unittest.TestCase):
+    def test_pack_roundtrip(self):
+        colors = np.arange(6, dtype=np.float64).reshape(2, 3)
+        unpacked_colors, name = unpack(pack((colors, 'Black')))
+        np.testing.assert_array_equal(unpacked_colors, colors)
+        self.assertEqual(name, 'Black')
+
+    def test_shared_memory_cache_across_instances(self):
+        path = os.path.join(tempfile.mkdtemp(), 'test.cache')
+        writer = SharedMemoryCache(path, slots=8, slot_size=256)
+        reader = SharedMemoryCache(path, slots=8, slot_size=256)
+        writer.set('lab:000000', {'color_name': 'Black'})
+        writer.set('too-big', 'x' * 1024)
+        self.assertEqual(reader.get('lab:000000'), {'color_name': 'Black'})
+        self.assertIsNone(reader.get('too-big'))
+        reader.clear()
+        self.assertIsNone(writer.get('lab:000000'))
+
+        # Entries written for another dataset version are never returned
+        writer.set('lab:000000', {'color_name': 'Black'})
+        self.assertIsNone(SharedMemoryCache(path, slots=8, slot_size=256, version='2').get('lab:000000'))
+
+    def test_shared_memory_cache_fits_free_space(self):
+        path = os.path.join(tempfile.mkdtemp(), 'test.cache')
+        # 64 KiB free: a new file takes a quarter of it, later processes map the file as it is
+        free = mock.Mock(f_bavail=16, f_frsize=4096)
+        with mock.patch('cache.os.statvfs', return_value=free):
+            first = SharedMemoryCache(path, slots=1024, slot_size=256)
+        second = SharedMemoryCache(path, slots=1024, slot_size=256)
+        self.assertEqual((first.slots, second.slots), (64, 64))
+        self.assertEqual(os.path.getsize(path), 64 * 256)
+        first.set('lab:000000', {'color_name': 'Black'})
+        self.assertEqual(second.get('lab:000000'), {'color_name': 'Black'})
+
+    def test_redis_cache_roundtrip(self):
+        if redis is None:
+            self.skipTest('redis is not installed')
+
+        class FakeRedis:
+            # The commands RedisCache uses, on a dict
+            def __init__(self):
+                self.data, self.expiry = {}, {}
+
+            def get(self, key):
+                return self.data.get(key.encode())
+
+            def set(self, key, value, ex=None):
+                self.data[key.encode()] = value
+                self.expiry[key.encode()] = ex
+
+            def scan_iter(self, match, count):
+                return [key for key in list(self.data) if key.decode().startswith(match.rstrip('*'))]
+
+            def delete(self, *keys):
+                for key in keys:
+                    del self.data[key]
+
+        client = FakeRedis()
+        with mock.patch('cache.redis.Redis.from_url', return_value=client) as from_url:
+            cache = RedisCache('redis://cache:6379/0', prefix='image-colors:closest_color:', ttl=60, version='2')
+            old = RedisCache('redis://cache:6379/0', prefix='image-colors:closest_color:', version='1')
+        self.assertEqual(from_url.call_args[1], {'socket_timeout': 0.25, 'socket_connect_timeout': 0.25})
+        colors = np.array([[255.0, 0.0, 0.0]])
+        cache.set('lab:16711680', (colors, 'Red'))
+        cached_colors, name = cache.get('lab:16711680')
+        np.testing.assert_array_equal(cached_colors, colors)
+        self.assertEqual(name, 'Red')
+        self.assertEqual(client.expiry[b'image-colors:closest_color:2:lab:16711680'], 60)
+        # Other versions miss, and clear removes the entries of every version
+        self.assertIsNone(old.get('lab:16711680'))
+        old.set('lab:0', 'Black')
+        client.data[b'image-colors:palette:2:key'] = b'other cache'
+        self.assertTrue(cache.clear())
+        self.assertEqual(list(client.data), [b'image-colors:palette:2:key'])
+        self.assertEqual(cache.stats()['hits'], 1)
+
+    def test_redis_cache_unavailable(self):
+        if redis is None:
+            self.skipTest('redis is not installed')
+        # Nothing listens on port 1: every command fails fast and is reported, not raised
+        cache = RedisCache('redis://127.0.0.1:1/0', prefix='test:', version='1', timeout=0.1)
+        self.assertIsNone(cache.get('lab:000000'))
+        cache.set('lab:000000', {'color_name': 'Black'})
+        self.assertFalse(cache.clear())
+
+class PaletteTest(unittest.TestCase):
+    def test_rgb_to_lab_matches_colormath(self):
+        np.testing.assert_allclose(rgb_to_lab([255, 0, 0]), [53.2390, 80.0905, 67.2014], atol=0.01)
+        np.testing.assert_allclose(rgb_to_lab([[0, 0, 0], [255, 255, 255]]), [[0, 0, 0], [100, 0, 0]], atol=0.01)
+
+    def test_seeded_quality_close_to_best(self):
+        image = make_image('photo', 0.05, alpha=True)
+        pixels = image_pixels(image).astype(np.float64)
+
+        def inertia(colors):
+            return np.min(((pixels[:, None, :] - colors[None, :, :]) ** 2).sum(axis=2), axis=1).sum()
+
+        # Restarts land in different local optima, so compare the clustering objective
+        # rather than the colors themselves
+        reference, _ = extract_palette(image, 8, quality='best')
+        for quality in ('balanced', 'fast'):
+            seed_cache.clear()
+            colors, _ = extract_palette(image, 8, quality=quality)
+            self.assertLess(inertia(colors), inertia(reference) * 1.02)
+        self.assertEqual(seed_cache.stats()['size'], 1)
+
+    def test_color_space_roundtrip(self):
+        colors = np.random.default_rng(0).integers(0, 256, (100, 3)).astype(np.uint8)
+        for to_space, from_space in filter(None, COLOR_SPACES.values()):
+            np.testing.assert_allclose(from_space(to_space(colors)), colors, atol=1e-6)
+
+    def test_cluster_in_lab(self):
+        colors, percents = extract_palette(make_image('poster', 0.05, alpha=True), 5, space='lab')
+        self.assertEqual(colors.shape, (5, 3))
+        self.assertTrue(((colors >= 0) & (colors <= 255)).all())
+        self.assertAlmostEqual(percents.sum(), 1)
+
+    def test_seeds_are_distinct(self):
+        # A poster with fewer distinct colors than clusters: duplicate centers are neither cached nor reused
+        image = make_image('poster', 0.05, alpha=True)
+        seed_cache.clear()
+        extract_palette(image, 13, quality='balanced')
+        self.assertEqual(seed_cache.stats()['size'], 0)
+        seeds = np.array([[0, 0, 0], [0, 0, 0], [255, 255, 255]])
+        self.assertIsNone(distinct_seeds(seeds, 3))
+        self.assertEqual(len(distinct_seeds(seeds, None)), 2)
+        np.testing.assert_array_equal(distinct_seeds(seeds[1:], 2), seeds[1:])
+
+    def test_seeding_honours_thread_limit(self):
+        with mock.patch('palette.threadpool_limits', wraps=threadpool_limits) as limits:
+            seed_cache.clear()
+            extract_palette(make_image('photo', 0.05), 4, threads=1, quality='balanced')
+            extract_palette(make_image('photo', 0.05), None, threads=1, quality='balanced')
+        # histogram_seeds and adaptive_seeds fit under the limit too, not only the final KMeans
+        self.assertEqual(limits.call_count, 4)
+
+    def test_frame_histogram(self):
+        pixels = np.random.default_rng(0).integers(0, 256, (1000, 3))
+        histogram = FrameHistogram()
+        histogram.add(pixels[:400])
+        histogram.add(pixels[400:])
+        for accumulated, direct in zip(histogram.colors(), color_histogram(pixels)):
+            np.testing.assert_allclose(accumulated, direct)
+
+    def test_tiled_palette(self):
+        # Blue left third, green middle, red right third, in BGR
+        image = np.zeros((90, 300, 3), np.uint8)
+        image[:, :100, 0] = image[:, 100:200, 1] = image[:, 200:, 2] = 255
+        mask = np.full((9, 30), 255, np.uint8)
+        mask[:, 20:25] = 0
+        tiles = [(x, y, image[y:y + 32, x:x + 64]) for y in range(0, 90, 32) for x in range(0, 300, 64)]
+
+        colors, percents = extract_tiled_palette(iter(tiles), 300, 90, None, crop=(50, 0, 200, 90), mask=mask)
+        # Half of the blue and all of the green are in the crop box, the mask hides the red
+        self.assertEqual(colors.round().astype(int).tolist(), [[0, 255, 0], [0, 0, 255]])
+        np.testing.assert_allclose(percents, [2 / 3, 1 / 3], atol=0.02)
+
+    def test_palette_signature(self):
+        red_blue = palette_signature([[255, 0, 0], [0, 0, 255]], [0.5, 0.5])
+        self.assertEqual(red_blue.shape, (48,))
+        self.assertAlmostEqual(float(np.sum(red_blue ** 2)), 1.0)
+        similar = palette_signature([[245, 10, 10], [5, 0, 240]], [0.6, 0.4])
+        green = palette_signature([[0, 200, 0]], [1])
+        self.assertLess(np.linalg.norm(red_blue - similar) * 5, np.linalg.norm(red_blue - green))
+
+    def test_palette_emd(self):
+        red, blue = [255, 0, 0], [0, 0, 255]
+        red_to_blue = float(np.linalg.norm(rgb_to_lab(np.array(red, np.float64)) - rgb_to_lab(np.array(blue, np.float64))))
+        # Moving a quarter of the pixels from red to blue
+        self.assertAlmostEqual(palette_emd([red, blue], [50, 50], [red, blue], [75, 25]), red_to_blue / 4)
+        self.assertAlmostEqual(palette_emd([red, blue], [1, 1], [blue, red], [1, 1]), 0)
+
+        rng = np.random.default_rng(0)
+        query = (rng.integers(0, 256, (5, 3)), rng.random(5))
+        candidates = [(rng.integers(0, 256, (size, 3)), rng.random(size)) for size in (1, 3, 5, 8)]
+        approximate = sinkhorn_emd(*query, candidates)
+        exact = [palette_emd(*query, *candidate) for candidate in candidates]
+        np.testing.assert_allclose(approximate, exact, atol=3)
+
+    def test_postprocess_palette(self):
+        colors = np.array([[0, 0, 255], [255, 0, 0], [254, 1, 0], [0, 255, 0]], dtype=np.float64)
+        shares = np.array([0.2, 0.5, 0.2995, 0.0005])
+        colors, shares = postprocess_palette(colors, shares, merge_delta_e=2.3, min_percent=0.1)
+        self.assertEqual(len(colors), 2)
+        np.testing.assert_allclose(colors[1], [0, 0, 255])
+        np.testing.assert_allclose(shares, [0.7995 / 0.9995, 0.2 / 0.9995])
+
+    def test_merge_similar_colors(self):
+        colors, weights, target = merge_similar_colors([[250, 0, 0], [255, 0, 0], [0, 0, 255]], [1, 3, 2], 10)
+        self.assertEqual(colors.tolist(), [[253.75, 0, 0], [0, 0, 255]])
+        self.assertEqual(weights.tolist(), [4, 2])
+        self.assertEqual(target.tolist(), [0, 0, 1])
+
+    def test_trim_box(self):
+        # A painting on a white wall
+        image = np.full((600, 800, 3), 250, np.uint8)
+        cv2.rectangle(image, (200, 100), (599, 399), (20, 90, 160), -1)
+        x, y, w, h = trim_box(image)
+        self.assertLessEqual(abs(x - 200) + abs(y - 100) + abs(w - 400) + abs(h - 300), 16)
+
+    def test_select_region(self):
+        image = np.zeros((100, 200, 3), np.uint8)
+        image[:, 100:] = (255, 0, 0)
+        mask = np.zeros((50, 100), np.uint8)
+        mask[:, :25] = 255
+        region, region_mask = select_region(image, crop=(50, 0, 150, 100), mask=mask)
+        self.assertEqual(region.shape, (100, 150, 3))
+        self.assertEqual(region_mask.shape, (100, 150))
+
+        # Only the masked left half goes into the quantizer
+        colors, percents = extract_palette(image, 1, mask=mask)
+        self.assertEqual(colors.astype(int).tolist(), [[0, 0, 0]])
+        with self.assertRaises(PaletteError):
+            extract_palette(image, 2, crop=(300, 0, 10, 10))
+
+
+class ProbeTest(unittest.TestCase):
+    def test_probe_formats(self):
+        image = np.zeros((30, 40, 3), np.uint8)
+        for extension, format in [('.png', 'png'), ('.jpg', 'jpeg'), ('.webp', 'webp'), ('.tiff', 'tiff'), ('.gif', 'gif')]:
+            _, encoded = cv2.imencode(extension, image)
+            info = probe_image(memoryview(encoded.tobytes()))
+            self.assertEqual((info['format'], info['width'], info['height'], info['frames']), (format, 40, 30, 1))
+
+        _, encoded = cv2.imencode('.png', np.zeros((30, 40, 4), np.uint8))
+        self.assertEqual(probe_image(encoded.tobytes())['channels'], 4)
+        _, encoded = cv2.imencodemulti('.tiff', [image, image, image])
+        self.assertEqual(probe_image(encoded.tobytes())['frames'], 3)
+        # Thumbnails are not pages, in classic TIFF as in BigTIFF (written with tifffile when installed)
+        for bigtiff in (False, True) if decoders.tifffile is not None else ():
+            output = io.BytesIO()
+            with decoders.tifffile.TiffWriter(output, bigtiff=bigtiff) as tiff:
+                tiff.write(image, photometric='rgb')
+                tiff.write(image[::2, ::2], photometric='rgb', subfiletype=1)
+            info = probe_image(output.getvalue())
+            self.assertEqual((info['format'], info['width'], info['frames']), ('tiff', 40, 1))
+        _, encoded = cv2.imencode('.bmp', image)
+        self.assertEqual(probe_image(encoded.tobytes())['width'], 40)
+        self.assertIsNone(probe_image(b'\x00\x00\x00\x18ftypheic not probed'))
+
+    def test_probe_truncated(self):
+        _, encoded = cv2.imencode('.jpg', np.zeros((30, 40, 3), np.uint8))
+        with self.assertRaises(ProbeError):
+            probe_image(encoded.tobytes()[:20])
+
+    def test_reduced_decode_scale(self):
+        self.assertEqual(reduced_decode_scale(image_info('jpeg', 6000, 4000, 3), 700), 4)
+        self.assertEqual(reduced_decode_scale(image_info('jpeg', 6000, 4000, 3), 700, crop=(0, 0, 1500, 1500)), 2)
+        self.assertEqual(reduced_decode_scale(image_info('png', 6000, 4000, 4), 700), 1)
+        self.assertEqual(reduced_decode_scale(None, 700), 1)
+
+
+class DecodersTest(unittest.TestCase):
+    def test_decode_within_max_pixels(self):
+        _, encoded = cv2.imencode('.jpg', make_image('photo', 2))
+        info = probe_image(encoded.tobytes())
+        image, decoder = decode_image(encoded.tobytes(), info['width'] * info['height'] / 16, info)
+        self.assertEqual(decoder, 'cv2')
+        self.assertEqual(image.shape, ((info['height'] + 3) // 4, (info['width'] + 3) // 4, 3))
+
+        # Without the header cv2 decodes everything and resizes
+        image, _ = decode_image(encoded.tobytes(), 10000)
+        self.assertLessEqual(image.shape[0] * image.shape[1], 10000)
+
+    def test_decode_ignores_orientation(self):
+        if PIL is None:
+            self.skipTest('Pillow is not installed')
+        # Rotated by the EXIF orientation, reduced decodes must keep the stored layout as full ones do
+        exif = PIL.Image.Exif()
+        exif[0x0112] = 6
+        output = io.BytesIO()
+        PIL.Image.fromarray(np.zeros((400, 800, 3), np.uint8)).save(output, 'JPEG', exif=exif)
+        encoded = output.getvalue()
+        info = probe_image(encoded)
+        full, _ = decode_image(encoded)
+        reduced, _ = decode_image(encoded, info['width'] * info['height'] / 4, info)
+        self.assertEqual(full.shape[:2], (400, 800))
+        self.assertEqual(reduced.shape[:2], (200, 400))
+
+    def test_decode_gray_and_16_bit(self):
+        _, encoded = cv2.imencode('.png', np.full((10, 20), 1000, np.uint16))
+        image, _ = decode_image(encoded.tobytes())
+        self.assertEqual((image.shape, image.dtype), ((10, 20, 3), np.uint8))
+
+    def test_decode_frames_with_cv2(self):
+        pages = [np.full((10, 20, 3), value, np.uint8) for value in range(0, 250, 50)]
+        _, encoded = cv2.imencodemulti('.tiff', pages)
+        animation = cv2.Animation()
+        animation.frames, animation.durations = pages, [100] * len(pages)
+        _, animated = cv2.imencodeanimation('.png', animation)
+
+        with mock.patch.dict(FRAME_READERS, {'pillow': None}):
+            for data in (encoded.tobytes(), animated.tobytes()):
+                frames = list(decode_frames(data, probe_image(data), stride=2, max_frames=2))
+                self.assertEqual([frame[0, 0, 0] for frame in frames], [0, 100])
+
+    def test_tifffile_tiles_convert_colors(self):
+        if decoders.tifffile is None or PIL is None:
+            self.skipTest('tifffile or Pillow is not installed')
+        image = np.zeros((40, 60, 3), np.uint8)
+        image[:, :30] = (255, 0, 0)
+        image[:, 30:] = (0, 0, 255)
+        for mode, options in [('P', {}), ('CMYK', {}), ('YCbCr', {}), ('RGB', {'compression': 'jpeg'})]:
+            encoded = io.BytesIO()
+            PIL.Image.fromarray(image).convert(mode).save(encoded, 'TIFF', **options)
+            (_, _, tile), = decoders.tifffile_tiles(encoded.getvalue())
+            np.testing.assert_allclose(tile[20, [0, -1]], [[0, 0, 255], [255, 0, 0]], atol=3, err_msg=mode)
+
+    def test_decode_fallback_and_stats(self):
+        if 'pillow' not in DECODERS:
+            self.skipTest('Pillow is not installed')
+        _, encoded = cv2.imencode('.png', np.dstack([np.zeros((10, 20, 3), np.uint8), np.full((10, 20), 128, np.uint8)]))
+        failures = decoder_stats()['cv2']['failures']
+        with mock.patch.dict(DECODERS, {'cv2': lambda buffer, max_pixels, info: None}):
+            image, decoder = decode_image(encoded.tobytes())
+        self.assertEqual(decoder, 'pillow')
+        self.assertEqual(image.shape, (10, 20, 4))
+        self.assertEqual(image[0, 0].tolist(), [0, 0, 0, 128])
+        self.assertEqual(decoder_stats()['cv2']['failures'], failures + 1)
+        self.assertEqual(decode_image(b'not an image'), (None, None))
+
+
+class ResultsStoreTest(unittest.TestCase):
+    def test_batched_writes_and_lookup(self):
+        class StoreCursor(FakeCursor):
+            def execute(self, query, params=None):
+                pass
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args):
+                pass
+
+        class StoreConnection(FakeConnection):
+            closed = False
+
+            def cursor(self, cursor_factory=None):
+                return StoreCursor(self.row)
+
+            def commit(self):
+                pass
+
+            def rollback(self):
+                pass
+
+        class StorePool:
+            def getconn(self):
+                return StoreConnection(row)
+
+            def putconn(self, conn, close=False):
+                pass
+
+        colors, percents = np.array([[255.0, 0.0, 0.0], [0.0, 0.0, 254.6]]), np.array([0.75, 0.25])
+        row = (colors.tolist(), percents.tolist(), [[colors.tolist(), percents.tolist()]])
+        store = ResultsStore(StorePool(), batch_size=2, flush_interval=0.05)
+        batches = []
+        with mock.patch('results_store.psycopg2.extras.execute_values',
+                        lambda cur, query, rows, template, fetch: batches.append(rows) or [(row[0],) for row in rows]):
+            for index in range(3):
+                store.put(f'key{index}', 'sha', {'n_colors': 2}, (colors, percents, None), 0.1)
+            store.flush()
+        self.assertEqual(sorted(len(batch) for batch in batches), [1, 2])
+        # Lab cube literals of the colors, red is L=53.24
+        self.assertAlmostEqual(float(batches[0][0][5][0].strip('()').split(',')[0]), 53.24, places=1)
+        self.assertEqual(store.stats()['written'], 3)
+
+        stored_colors, stored_percents, frames = store.get('key0')
+        np.testing.assert_array_equal(stored_colors, colors)
+        np.testing.assert_array_equal(frames[0][1], percents)
+        self.assertEqual(store.stats()['hits'], 1)
+
+    def test_search_keeps_closest_row_per_image(self):
+        rows = [('b', [[0, 0, 255]], [1.0], {}, 3.0), ('a', [[255, 0, 0]], [1.0], {'n_colors': 1}, 1.0), ('c', [[0, 255, 0]], [1.0], {}, 2.0)]
+        cursor = mock.MagicMock()
+        cursor.__enter__.return_value.fetchall.return_value = rows
+        connection = mock.MagicMock()
+        connection.cursor.return_value = cursor
+        pool = mock.MagicMock()
+        pool.getconn.return_value = connection
+        store = ResultsStore(pool)
+        results = store.search_by_color((255, 0, 0), k=2, min_percent=5)
+        pool.putconn.assert_called_once_with(connection)
+        self.assertEqual([result['image_sha256'] for result in results], ['a', 'c'])
+        self.assertEqual(results[0]['params'], {'n_colors': 1})
+        # A single query, the schema is left to migrate
+        cursor.__enter__.return_value.execute.assert_called_once()
+        query, params = cursor.__enter__.return_value.execute.call_args[0]
+        self.assertEqual(params['candidates'], 16)
+        self.assertAlmostEqual(params['lab'][0], 53.24, places=1)
+        np.testing.assert_array_equal(results[0]['colors'], [[255, 0, 0]])
+
+    def test_failed_lookup_discards_connection(self):
+        # Left broken by a database restart, the connection is closed instead of pooled again
+        connection = mock.MagicMock()
+        connection.cursor.side_effect = psycopg2.OperationalError('server closed the connection unexpectedly')
+        pool = mock.MagicMock()
+        pool.getconn.return_value = connection
+        store = ResultsStore(pool)
+        self.assertIsNone(store.get('key'))
+        pool.putconn.assert_called_once_with(connection, close=True)
+        self.assertEqual(store.stats()['errors'], 1)
+
+    def test_migrate(self):
+        connection = mock.MagicMock()
+        pool = mock.MagicMock()
+        pool.getconn.return_value = connection
+        store = ResultsStore(pool)
+        self.assertTrue(store.migrate())
+        connection.cursor.return_value.__enter__.return_value.execute.assert_called_once_with(results_store.SCHEMA)
+        connection.commit.assert_called_once()
+        # Not pooled, it may have been opened before the workers fork
+        pool.putconn.assert_called_once_with(connection, close=True)
+
+        pool.getconn.side_effect = psycopg2.OperationalError('could not connect to server')
+        self.assertFalse(store.migrate())
+
+    def test_search_by_palette_reranks_by_emd(self):
+        # In signature order, the second palette is the closest by earth mover's distance
+        rows = [('far', [[255, 0, 0]], [1.0], {}, 0.1), ('near', [[0, 0, 250], [250, 0, 0]], [0.9, 0.1], {}, 0.2),
+                ('other', [[0, 255, 0]], [1.0], {}, 0.3)]
+        store = ResultsStore(None)
+        with mock.patch.object(store, '_search', return_value=[
+                {'image_sha256': sha, 'colors': np.array(colors, np.float64), 'percents': np.array(percents),
+                 'params': params, 'distance': distance} for sha, colors, percents, params, distance in rows]):
+            results = store.search_by_palette([[0, 0, 255]], [1], k=2)
+        self.assertEqual([result['image_sha256'] for result in results], ['near', 'far'])
+        self.assertLess(results[0]['distance'], 20)
+
+
+class ResponsesTest(unittest.TestCase):
+    def test_palette_rows_match_columns(self):
+        colors = np.array([[255.0, 0.4, 16.9], [0.0, 128.5, 255.0]])
+        percents = np.array([0.75, 0.25])
+        rows = palette_rows(colors, percents)
+        self.assertEqual(rows[0], {'r': 255, 'g': 0, 'b': 16, 'html_code': '#ff0010', 'percent': 75.0})
+        self.assertEqual(json.loads(dumps(palette_columns(colors, percents)))['g'], [0, 128])
+
+    def test_encode_arrow(self):
+        if pyarrow is None:
+            self.skipTest('pyarrow is not installed')
+        table = pyarrow.ipc.open_stream(encode_arrow(record_columns({'color_name': 'Black', 'distance': 0.5}))).read_all()
+        self.assertEqual(table.to_pylist(), [{'color_name': 'Black', 'distance': 0.5}])
+
+class ProfilingTest(unittest.TestCase):
+    def test_profiled_only_with_secret(self):
+        def view():
+            return 'ok'
+
+        with mock.patch.dict(os.environ, {'PROFILE_SECRET': ''}):
+            self.assertIs(profiled(view), view)
+
+        profile_dir = tempfile.mkdtemp()
+        with mock.patch.dict(os.environ, {'PROFILE_SECRET': 's3cret', 'PROFILE_DIR': profile_dir}):
+            test_app = Flask(__name__)
+            test_app.route('/view')(profiled(view))
+        client = test_app.test_client()
+
+        self.assertNotIn('X-Profile-Path', client.get('/view', headers={'X-Profile': 'wrong'}).headers)
+        response = client.get('/view', headers={'X-Profile': 's3cret', 'X-Request-ID': 'abc'})
+        self.assertEqual(response.data, b'ok')
+        self.assertTrue(os.path.exists(os.path.join(profile_dir, 'abc.prof')))
+
+class LoggingTest(unittest.TestCase):
+    def test_parse_sample_rates(self):
+        self.assertEqual(parse_sample_rates('/analyze=1, *=0.25'), {'/analyze': 1.0, '*': 0.25})
+        self.assertEqual(parse_sample_rates(None), {})
+
+    def test_route_sampling_keeps_warnings(self):
+        sampler = RouteSamplingFilter({'/closest_color_lab': 0.0})
+        info = logging.LogRecord('app', logging.INFO, __file__, 1, 'msg', None, None)
+        warning = logging.LogRecord('app', logging.WARNING, __file__, 1, 'msg', None, None)
+        with app.test_request_context('/closest_color_lab'):
+            self.assertFalse(sampler.filter(info))
+            self.assertTrue(sampler.filter(warning))
+        with app.test_request_context('/analyze'):
+            self.assertTrue(sampler.filter(info))
+
+    def test_route_sampling_decides_per_request(self):
+        sampler = RouteSamplingFilter({'*': 0.5})
+        records = [logging.LogRecord('app', logging.INFO, __file__, line, 'msg', None, None) for line in range(20)]
+        for draw, kept in ((0.9, False), (0.1, True)):
+            with app.test_request_context('/analyze'), mock.patch('log_config.random.random', return_value=draw) as random:
+                self.assertEqual([sampler.filter(record) for record in records], [kept] * len(records))
+                random.assert_called_once()
+
 if __name__ == '__main__':
     unittest.main()